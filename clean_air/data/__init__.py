@@ -1 +1,2 @@
 from .data_subset import DataSubset
+from .file_index import FileIndex
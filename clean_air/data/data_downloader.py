@@ -2,15 +2,286 @@
 These can be full datasets or specified data subsets
 For subset requests, these must first be filtered by calling the DataHandler before the download can be completed """
 
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
+import os
+import re
+import shutil
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import iris
+import iris.fileformats.netcdf
+
 from .data_downloader_interface import DataDownloaderInterface
+from .data_subset import DataSubset
 
 
 class DataDownloader(DataDownloaderInterface):
+    """
+    Downloads datasets over HTTP(S), streaming them straight to disk.
+
+    Files are first written alongside their destination, with a ".part"
+    suffix, and only moved into place once complete (and verified, if a
+    checksum is given).  If a download is interrupted, whether by a dropped
+    connection or by the whole process stopping, the next attempt carries on
+    from the end of the partial file, provided the server supports ranged
+    requests.  The file's ETag or modification time is kept alongside the
+    partial file, with a ".part.validator" suffix, so that a download is
+    only resumed if the file has not changed on the server since.
+    """
+
+    def __init__(self, base_url=None, max_workers=None,
+                 chunk_size=1024 * 1024, retries=3, timeout=60):
+        """
+        Args:
+            base_url (str?): URL that dataset names are relative to.  If not
+                given, names should be full URLs.
+            max_workers (int?): maximum number of files to download at
+                once.  Defaults to the CLEAN_AIR_DOWNLOAD_WORKERS environment
+                variable, or 4.
+            chunk_size (int): number of bytes to read and write at a time
+            retries (int): number of times to resume a download after it
+                fails part way through
+            timeout (float): timeout for each request, in seconds
+        """
+        if max_workers is None:
+            max_workers = int(os.environ.get("CLEAN_AIR_DOWNLOAD_WORKERS", 4))
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    def download_obs(self, name, path, checksum=None):
+        """
+        Download an observation dataset.
+
+        Args:
+            name (str): URL of the dataset, or its location relative to
+                `base_url`
+            path (str): file to save to, or a directory to save it in
+            checksum (str?): expected checksum of the file, as
+                "<algorithm>:<hex digest>", eg "sha256:2c26b4...".  The
+                algorithm may be omitted, in which case it is taken to be
+                sha256.
+
+        Returns:
+            (str): path of the downloaded file
+        """
+        return self._download(name, path, checksum)
+
+    def download_gridded(self, name, path, checksum=None, time_chunk=1,
+                         chunksizes=None, complevel=4):
+        """
+        Download a gridded dataset, or save a subset of one.
+
+        A DataSubset is written to a NetCDF4 file one chunk of time steps
+        at a time, so the memory used does not depend on the length of the
+        requested period.  Otherwise, arguments are as for `download_obs`.
+
+        Args:
+            name (str or DataSubset): dataset to download
+            path (str): file to save to, or a directory to save it in
+            checksum (str?): expected checksum of a downloaded file (not
+                used for subsets)
+            time_chunk (int): number of time steps of a subset to process at
+                a time
+            chunksizes (tuple of int?): chunk shape to use in the NetCDF
+                file.  Defaults to `time_chunk` time steps of the full
+                extent of every other dimension.
+            complevel (int): level of compression to use in the NetCDF
+                file, from 0 (none) to 9
+
+        Returns:
+            (str): path of the downloaded file
+        """
+        if isinstance(name, DataSubset):
+            return self._save_subset(name, path, time_chunk, chunksizes,
+                                     complevel)
+        return self._download(name, path, checksum)
+
+    def download_many(self, requests):
+        """
+        Download several datasets at once, up to `max_workers` at a time.
+
+        Args:
+            requests: sequence of (name, path) or (name, path, checksum)
+                tuples, as for `download_obs`
+
+        Returns:
+            (list of str): paths of the downloaded files, in the same order
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            futures = [pool.submit(self._download, *request)
+                       for request in requests]
+            return [future.result() for future in futures]
+
+    def _save_subset(self, subset, path, time_chunk, chunksizes, complevel):
+        if os.path.isdir(path):
+            path = os.path.join(path, f"{subset.id or subset.name}.nc")
+
+        # Arrange for the data to be read and written a chunk of time steps
+        # at a time.  Iris streams lazy data to file chunk by chunk.
+        cube = subset.as_cube()
+        chunks = list(cube.shape)
+        if cube.coords("time", dim_coords=True):
+            tdim, = cube.coord_dims(cube.coord("time", dim_coords=True))
+            chunks[tdim] = min(time_chunk, cube.shape[tdim])
+        cube = cube.copy(data=cube.lazy_data().rechunk(chunks))
+        if chunksizes is None:
+            chunksizes = chunks
+
+        # As with downloads, only move the file into place once complete
+        part = path + ".part"
+        iris.fileformats.netcdf.save(
+            cube, part, zlib=complevel > 0, complevel=complevel,
+            chunksizes=chunksizes,
+        )
+        os.replace(part, path)
+        return path
+
+    def _download(self, name, path, checksum=None):
+        url = name
+        if self.base_url:
+            url = urllib.parse.urljoin(self.base_url, name)
+        if os.path.isdir(path):
+            filename = os.path.basename(urllib.parse.urlparse(url).path)
+            path = os.path.join(path, filename)
+
+        part = path + ".part"
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, part)
+                break
+            except urllib.error.HTTPError:
+                # Errors such as 404 will not go away by trying again
+                raise
+            except (urllib.error.URLError, http.client.HTTPException,
+                    OSError):
+                if attempt == self.retries:
+                    raise
+
+        if checksum:
+            try:
+                _verify(part, checksum)
+            except ValueError:
+                # Don't resume from a corrupt file next time
+                os.remove(part)
+                _remove(part + ".validator")
+                raise
+        os.replace(part, path)
+        _remove(part + ".validator")
+        return path
+
+    def _fetch(self, url, part):
+        """
+        Download a URL to a partial file, carrying on from where any
+        previous attempt left off, as long as the file is unchanged.
+        """
+        try:
+            offset = os.path.getsize(part)
+        except FileNotFoundError:
+            offset = 0
+        try:
+            with open(part + ".validator") as f:
+                validator = f.read()
+        except FileNotFoundError:
+            # Without knowing which version of the file the partial one came
+            # from, it cannot safely be carried on from
+            offset = 0
+
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+            request.add_header("If-Range", validator)
+
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            if error.code == 416 and offset:
+                # Range not satisfiable, meaning we already have everything,
+                # unless the partial file is not the size of the whole one
+                if _content_range(error.headers)[2] == offset:
+                    return
+                os.remove(part)
+                return self._fetch(url, part)
+            raise
+
+        with response:
+            # If the server ignored the range, or the file has changed, it
+            # is sending the whole file again, so start over
+            if response.status != 206 or \
+                    _content_range(response.headers)[0] != offset:
+                offset = 0
+            if not offset:
+                _save_validator(response.headers, part + ".validator")
+            with open(part, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                shutil.copyfileobj(response, f, self.chunk_size)
+                size = f.tell()
+
+        # Connections that drop part way through are not always reported as
+        # errors, so check we got everything
+        length = response.headers.get("Content-Length")
+        if length is not None and size < offset + int(length):
+            raise http.client.IncompleteRead(b"", offset + int(length) - size)
+
+
+def _content_range(headers):
+    """
+    Parse the Content-Range header of a response.
+
+    Returns:
+        (start, end, total): positions of the bytes sent, and the size of
+        the whole file, or None for any that are unknown
+    """
+    match = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)",
+                         headers.get("Content-Range", "").strip())
+    if not match:
+        return None, None, None
+    return tuple(None if value in (None, "*") else int(value)
+                 for value in match.groups())
+
+
+def _save_validator(headers, path):
+    """
+    Record the ETag or Last-Modified header of a response, to be sent as
+    If-Range when resuming.  Only strong ETags can be used for this.
+    """
+    validator = headers.get("ETag")
+    if not validator or validator.startswith("W/"):
+        validator = headers.get("Last-Modified")
+    if validator:
+        with open(path, "w") as f:
+            f.write(validator)
+    else:
+        _remove(path)
+
+
+def _remove(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
 
-    def download_obs(self, name, path):
-        # do something
-        pass
+def _verify(path, checksum):
+    """
+    Check a file matches a checksum, given as "<algorithm>:<hex digest>".
 
-    def download_gridded(self, name, path):
-        #do something
-        pass
+    Raises:
+        ValueError: if the file does not match
+    """
+    algorithm, _, expected = checksum.rpartition(":")
+    digest = hashlib.new(algorithm or "sha256")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    if digest.hexdigest() != expected.lower():
+        raise ValueError(
+            f"Checksum mismatch for {path}: expected {expected}, "
+            f"got {digest.hexdigest()}"
+        )
@@ -2,11 +2,53 @@
 Objects representing data subsets
 """
 
+import copy
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+
 import numpy as np
 import iris
-import shapely.geometry, shapely.ops
+import shapely, shapely.geometry, shapely.ops
 
 from clean_air import util
+from clean_air.data.file_index import FileIndex
+
+# Optional index of file contents, used to decide which files to load.
+# This can be set up by assigning a FileIndex here, or via the
+# CLEAN_AIR_FILE_INDEX environment variable, giving the location of its
+# database.
+file_index = None
+if os.environ.get("CLEAN_AIR_FILE_INDEX"):
+    file_index = FileIndex(os.environ["CLEAN_AIR_FILE_INDEX"])
+
+# Optional cache of subsets, shared between DataSubset objects, and between
+# processes if it includes a disk tier.  This can be set up by assigning
+# a cache here (with `get` and `put` methods, such as a util.cache.TieredCache),
+# or via the CLEAN_AIR_RESULT_CACHE (directory), CLEAN_AIR_RESULT_CACHE_SIZE
+# (maximum size, in bytes) and CLEAN_AIR_RESULT_CACHE_TTL (lifetime, in
+# seconds) environment variables, which set up an in-memory cache in front
+# of a directory of NetCDF files.  Subsets are computed and written to the
+# directory in the background, so loading them stays lazy, and their data is
+# only read once.  Subsets found in the directory are read in full, so do not
+# depend on files that may be evicted.
+result_cache = None
+if os.environ.get("CLEAN_AIR_RESULT_CACHE"):
+    _ttl = float(os.environ.get("CLEAN_AIR_RESULT_CACHE_TTL", 0)) or None
+    result_cache = util.cache.TieredCache(
+        util.cache.MemoryCache(max_items=16, ttl=_ttl),
+        util.cache.CubeCache(
+            os.environ["CLEAN_AIR_RESULT_CACHE"],
+            int(os.environ.get("CLEAN_AIR_RESULT_CACHE_SIZE", 0)) or None,
+            _ttl,
+        ),
+    )
+
+# Date stamp in the names of daily files, such as "aqum_hourly_o3_20200520.nc"
+_DATE_STAMP = re.compile(r"(?<!\d)(\d{8})(?!\d)")
 
 
 class DataSubset:
@@ -18,6 +60,8 @@ class DataSubset:
         if cls is DataSubset:
             if "point" in kw:
                 return PointSubset(*args, **kw)
+            if "points" in kw:
+                return MultiPointSubset(*args, **kw)
             if "box" in kw:
                 return BoxSubset(*args, **kw)
             if "track" in kw:
@@ -35,6 +79,7 @@ class DataSubset:
         parameter=None,
         start_time=None,
         end_time=None,
+        daily_files=False,
     ):
         self.id = id
         self.name = name
@@ -43,29 +88,184 @@ class DataSubset:
         self.parameter = parameter
         self.start_time = start_time
         self.end_time = end_time
+        self.daily_files = daily_files
 
         self._cube = None
 
     def as_cube(self):
+        """
+        Load the subset.
+
+        If a `result_cache` has been configured, the result is shared with
+        any other DataSubset with the same specification, so should not be
+        modified.
+
+        Returns:
+            (Cube): the subset
+        """
         if self._cube is not None:
             return self._cube
 
+        files = self._find_files()
+        key = None
+        if result_cache is not None:
+            key = self._cache_key(files)
+            self._cube = result_cache.get(key)
+            if self._cube is not None:
+                return self._cube
+
+        self._cube = self._compute(files)
+        if key is not None:
+            result_cache.put(key, self._cube)
+        return self._cube
+
+    def _compute(self, files):
+        """
+        Load and combine the data from each file, and cut it down to the
+        subset.  Subclasses should extend this for processing that must
+        be done after the files have been combined.
+
+        Args:
+            files (list of str): paths of the files to load, as found by
+                `_find_files`
+        """
         constraints = None
         if self.parameter:
-            constraints = constraints & iris.Constraint(self.parameter)
-        if self.start_time:
-            constraints = constraints & iris.Constraint(
-                time=lambda cell: self.start_time <= cell.point
-            )
-        if self.end_time:
-            constraints = constraints & iris.Constraint(
-                time=lambda cell: cell.point < self.end_time
+            constraints = iris.Constraint(self.parameter)
+
+        # Load each file separately, so that it can be cut down to size
+        # before any data is touched, then combine them all
+        cubes = iris.cube.CubeList()
+        for path in files:
+            for cube in iris.load(path, constraints):
+                if self.start_time or self.end_time:
+                    cube = util.cubes.extract_time(
+                        cube, self.start_time, self.end_time
+                    )
+                if cube is not None:
+                    cube = self._extract(cube)
+                if cube is not None:
+                    cubes.append(cube)
+        if not cubes:
+            raise iris.exceptions.ConstraintMismatchError("no cubes found")
+        return cubes.merge().concatenate_cube()
+
+    def _cache_key(self, files):
+        """
+        Identify the subset by everything that affects its contents,
+        including the modification times of the files it is loaded from.
+
+        Args:
+            files (list of str): paths of the files the subset is loaded from
+
+        Returns:
+            (str): hex digest
+        """
+        stats = []
+        for path in files:
+            stat = os.stat(path)
+            stats.append((os.path.abspath(path), stat.st_mtime, stat.st_size))
+
+        spec = {
+            "type": type(self).__name__,
+            "files": stats,
+            "parameter": self.parameter,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+        }
+        spec.update(self._spec())
+        spec = json.dumps(spec, sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def _spec(self):
+        """
+        Describe the subset's geometry, for use in its cache key.
+
+        Returns:
+            (dict): JSON serialisable description
+        """
+        return {}
+
+    def _find_files(self):
+        """
+        Expand the file globs, skipping any files that cannot contain data
+        for the requested parameter and time range.
+
+        If a `file_index` has been configured, this is used to choose the
+        files.  Otherwise, if `daily_files` is set, files whose names contain
+        a single date stamp, such as "aqum_hourly_o3_20200520.nc", are taken
+        to hold data for that day only, and judged by name so that they need
+        not be opened.  Any other files are always loaded.
+
+        Returns:
+            (list of str): paths of the files to load
+        """
+        patterns = self.files
+        if isinstance(patterns, str):
+            patterns = [patterns]
+
+        paths = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(os.fspath(pattern)))
+            if not matches:
+                raise OSError(f"No files found matching {pattern}")
+            paths.extend(matches)
+        return self._filter_files(paths)
+
+    def _filter_files(self, paths):
+        """
+        Skip any of the given files that cannot contain data for the
+        requested parameter and time range, as described in `_find_files`.
+        """
+        if file_index is not None:
+            file_index.update(paths)
+            return file_index.select(
+                paths, self.parameter, self.start_time, self.end_time
             )
 
-        cube = iris.load_cube(self.files, constraints)
+        if self.daily_files:
+            paths = [path for path in paths if self._may_contain(path)]
+        return paths
 
-        self._cube = cube
-        return self._cube
+    def _may_contain(self, path):
+        """
+        Check, by its name, whether a daily file may hold data for the
+        requested time range.
+        """
+        stamps = _DATE_STAMP.findall(os.path.basename(path))
+        if len(stamps) != 1:
+            return True
+        try:
+            start = datetime.datetime.strptime(stamps[0], "%Y%m%d")
+        except ValueError:
+            # Not a date after all
+            return True
+
+        # Note the end is inclusive, as data for a day may be timestamped at
+        # midnight at the end of it
+        end = start + datetime.timedelta(days=1)
+        if self.end_time and self.end_time <= start:
+            return False
+        if self.start_time and end < self.start_time:
+            return False
+        return True
+
+    def _extract(self, cube):
+        """
+        Cut down a cube loaded from a single file, before it is combined
+        with the others.
+
+        This is applied while the data is still lazy, so it is the place
+        to discard as much of each file as possible.  The default
+        implementation leaves the cube unchanged.
+
+        Args:
+            cube: cube loaded from a single file
+
+        Returns:
+            (Cube or None): the cut down cube, or None to discard it
+        """
+        return cube
 
 
 class PointSubset(DataSubset):
@@ -81,11 +281,11 @@ class PointSubset(DataSubset):
         # or whether to insist a CRS is provided
         self.crs = crs
 
-    def as_cube(self):
-        if self._cube is not None:
-            return self._cube
+    def _spec(self):
+        return {"point": self.point, "crs": _crs_spec(self.crs)}
 
-        cube = super().as_cube()
+    def _compute(self, files):
+        cube = super()._compute(files)
 
         # Ensure coordinate systems match
         crs = cube.coord_system().as_cartopy_crs()
@@ -107,8 +307,49 @@ class PointSubset(DataSubset):
             # stored as attributes instead of coords
             pass
 
-        self._cube = cube
-        return self._cube
+        return cube
+
+
+class MultiPointSubset(DataSubset):
+    """
+    A dataset at a collection of points, such as monitoring sites.
+
+    This is equivalent to a PointSubset for each point, but much faster, as
+    the data is loaded once and all the points are interpolated together.
+    """
+
+    def __init__(self, *args, points, crs=None, **kw):
+        super().__init__(*args, **kw)
+        self.points = np.array(points, dtype=float).reshape(-1, 2)
+
+        # TODO: consider whether to continue treating None as "same as data",
+        # or whether to insist a CRS is provided
+        self.crs = crs
+
+    def _spec(self):
+        return {"points": self.points.tolist(), "crs": _crs_spec(self.crs)}
+
+    def _compute(self, files):
+        """
+        Returns:
+            (Cube): cube with the X and Y dimensions replaced by a trailing
+            "station" dimension, indexing the points in the order given
+        """
+        cube = super()._compute(files)
+
+        # Ensure coordinate systems match
+        xs, ys = self.points.T
+        if self.crs is not None:
+            crs = cube.coord_system().as_cartopy_crs()
+            xs, ys = util.crs.transform_points(xs, ys, self.crs, crs)
+
+        # Interpolate data to all the requested points at once
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        cube = util.cubes.interpolate_points(
+            cube, [(xcoord, xs), (ycoord, ys)], "station"
+        )
+
+        return cube
 
 
 class BoxSubset(DataSubset):
@@ -124,34 +365,150 @@ class BoxSubset(DataSubset):
         # or whether to insist a CRS is provided
         self.crs = crs
 
-    def as_cube(self):
-        if self._cube is not None:
-            return self._cube
-
-        cube = super().as_cube()
+    def _spec(self):
+        return {"box": self.box, "crs": _crs_spec(self.crs)}
 
+    def _extract(self, cube):
         # Ensure coordinate systems match
         crs = cube.coord_system().as_cartopy_crs()
         box = shapely.geometry.box(*self.box)
         if self.crs is not None:
             box = util.crs.transform_shape(box, self.crs, crs)
 
-        cube = util.cubes.extract_box(cube, box.bounds)
-
-        self._cube = cube
-        return self._cube
+        return util.cubes.extract_box(cube, box.bounds)
 
 
 class TrackSubset(DataSubset):
     """
-    A dataset along a (possibly curved) line.
+    A dataset along a (possibly curved) line, such as an aircraft's flight.
     """
 
     def __init__(self, *args, track, crs=None, **kw):
+        """
+        The track is given as a sequence of (x, y, t) samples, or
+        (x, y, z, t) samples to also follow the data's vertical coord,
+        where each t is a datetime.
+        """
         super().__init__(*args, **kw)
+        if len(track) == 0:
+            raise ValueError("track must have at least one sample")
         self.track = track
+
+        # TODO: consider whether to continue treating None as "same as data",
+        # or whether to insist a CRS is provided
         self.crs = crs
 
+    def _spec(self):
+        track = np.asarray(self.track, dtype=object).tolist()
+        return {"track": track, "crs": _crs_spec(self.crs)}
+
+    def _compute(self, files):
+        """
+        Returns:
+            (Cube): cube with the sampled dimensions replaced by a trailing
+            "sample" dimension, following the track in the order given
+        """
+        track = np.asarray(self.track, dtype=object)
+        xs = track[:, 0].astype(float)
+        ys = track[:, 1].astype(float)
+        times = track[:, -1]
+        if isinstance(times[0], np.datetime64):
+            times = times.astype("datetime64[us]").astype(object)
+
+        cube = self._load_around(files, min(times), max(times))
+
+        # Ensure coordinate systems match, transforming the whole track
+        # in one go
+        if self.crs is not None:
+            crs = cube.coord_system().as_cartopy_crs()
+            xs, ys = util.crs.transform_points(xs, ys, self.crs, crs)
+
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        tcoord = cube.coord("time", dim_coords=True)
+        samples = [
+            (xcoord, xs),
+            (ycoord, ys),
+            (tcoord, tcoord.units.date2num(list(times))),
+        ]
+        if track.shape[1] == 4:
+            zcoord = cube.coord(axis="z", dim_coords=True)
+            samples.append((zcoord, track[:, 2].astype(float)))
+
+        # Interpolate to every sample at once.  Only the time slabs the
+        # track passes through will be read.
+        cube = util.cubes.interpolate_points(cube, samples)
+
+        return cube
+
+    def _load_around(self, files, first, last):
+        """
+        Load only the times needed to interpolate between `first` and
+        `last`, within the requested time range, from those of the given
+        files that may hold them.
+
+        The track's own time range is tried first.  If that misses the data
+        point either side of it, as it will for tracks shorter than a time
+        step, it is widened by the data's time step.  Only if that cannot
+        be found, or there is no data within a time step of the track, is
+        the whole requested range loaded.
+        """
+        def narrowed(pad):
+            subset = copy.copy(self)
+            subset.start_time = first - pad
+            if self.start_time is not None:
+                subset.start_time = max(subset.start_time, self.start_time)
+            # The end time is exclusive, and may only be precise to a second
+            subset.end_time = last + pad + datetime.timedelta(seconds=1)
+            if self.end_time is not None:
+                subset.end_time = min(subset.end_time, self.end_time)
+            return subset
+
+        def load(subset):
+            try:
+                return DataSubset._compute(subset, subset._filter_files(files))
+            except iris.exceptions.ConstraintMismatchError:
+                return None
+
+        cube = load(narrowed(datetime.timedelta(0)))
+        if cube is not None:
+            tcoord = cube.coord("time")
+            points = tcoord.points
+            if points.min() <= tcoord.units.date2num(first) and \
+                    tcoord.units.date2num(last) <= points.max():
+                return cube
+
+        step = self._time_step(files)
+        if step is not None:
+            cube = load(narrowed(step))
+            if cube is not None:
+                return cube
+        return super()._compute(files)
+
+    def _time_step(self, files):
+        """
+        Find the data's (largest) time step from the time coords of the
+        first of the files, or as many as it takes to find two times.  Only
+        the coords are read, not the data.
+
+        Returns:
+            (timedelta): the time step, or None if there are not two
+            different times in all the files
+        """
+        constraints = None
+        if self.parameter:
+            constraints = iris.Constraint(self.parameter)
+
+        times = set()
+        for path in files:
+            for cube in iris.load(path, constraints):
+                tcoord = cube.coord("time")
+                times.update(tcoord.units.num2date(tcoord.points.ravel()))
+            if len(times) > 1:
+                times = sorted(times)
+                return max(later - earlier
+                           for earlier, later in zip(times, times[1:]))
+        return None
+
 
 class ShapeSubset(DataSubset):
     """
@@ -166,17 +523,14 @@ class ShapeSubset(DataSubset):
         # or whether to insist a CRS is provided
         self.crs = crs
 
-    def as_cube(self):
-        if self._cube is not None:
-            return self._cube
+        self._weights = None
 
-        cube = super().as_cube()
+    def _spec(self):
+        shape = shapely.to_wkb(self.shape, hex=True)
+        return {"shape": shape, "crs": _crs_spec(self.crs)}
 
-        # Ensure coordinate systems match
-        crs = cube.coord_system().as_cartopy_crs()
-        shape = self.shape
-        if self.crs is not None:
-            shape = util.crs.transform_shape(shape, self.crs, crs)
+    def _extract(self, cube):
+        shape = self._transformed_shape(cube)
 
         # The cells must have bounds for shape intersections to have much
         # meaning, especially for shapes that are small compared to the
@@ -188,16 +542,52 @@ class ShapeSubset(DataSubset):
             ycoord.guess_bounds()
 
         # Extract bounding box
-        cube = util.cubes.extract_box(cube, shape.bounds)
+        return util.cubes.extract_box(cube, shape.bounds)
+
+    def _transformed_shape(self, cube):
+        """
+        Transform the shape to match the coordinate system of a cube.
+        """
+        crs = cube.coord_system().as_cartopy_crs()
+        shape = self.shape
+        if self.crs is not None:
+            shape = util.crs.transform_shape(shape, self.crs, crs)
+        return shape
+
+    def _compute(self, files):
+        cube = super()._compute(files)
+        shape = self._transformed_shape(cube)
 
         # Mask points outside the actual shape
-        # Note we need to do the broadcasting manually: numpy is strangely
-        # reluctant to do it, no matter which of the many ways of creating
-        # a masked array we try
-        weights = util.cubes.get_intersection_weights(cube, shape, True)
-        mask = np.broadcast_to(weights == 0, cube.shape)
-        data = np.ma.array(cube.data, mask=mask)
-        cube = cube.copy(data=data)
-
-        self._cube = cube
-        return self._cube
+        self._weights = util.cubes.get_intersection_weights(
+            cube, shape, sparse=True
+        )
+        cube = util.cubes.mask_outside(cube, self._weights)
+
+        return cube
+
+    def area_mean(self):
+        """
+        Calculate the mean over the shape, weighted by the proportion of each
+        grid cell that lies within it.
+
+        Returns:
+            (Cube): cube with the X and Y dimensions collapsed
+        """
+        cube = self.as_cube()
+        if self._weights is None:
+            # The cube came from the result cache, so the weights have not
+            # been calculated here
+            self._weights = util.cubes.get_intersection_weights(
+                cube, self._transformed_shape(cube), sparse=True
+            )
+        return util.cubes.weighted_mean(cube, self._weights)
+
+
+def _crs_spec(crs):
+    """
+    Describe a CRS, for use in a cache key.
+    """
+    if crs is None:
+        return None
+    return util.crs.as_pyproj_crs(crs).to_wkt()
@@ -1,32 +1,121 @@
 ##Data Visuliser Class to handle rendering of maps and plots##
 
-from .data_visuliser_interface import DataVisuliserInterface
+import concurrent.futures
+
+import holoviews as hv
+import xarray
+
+from clean_air import util
+from clean_air.visualise import render_map, render_plot
+from .data_subset import (MultiPointSubset, PointSubset, ShapeSubset,
+                          TrackSubset)
+from .data_visualiser_interface import DataVisuliserInterface
 
 
 class DataVisuliser(DataVisuliserInterface):
-    def __init__(self, *datasets):
+    def __init__(self, *datasets, max_workers=None):
+        """
+        Args:
+            datasets: DataSubset objects to render.
+            max_workers (int?): maximum number of datasets to load at once,
+                defaulting to one per dataset.
+        """
         self.datasets = datasets #declare variable to hold a list of datasets
+        self.max_workers = max_workers or max(len(datasets), 1)
 
     def render_obs(self):
         # do Something
         pass
 
     def render_gridded(self, subsetter=None):
-        # do Something
-        pass
+        """
+        Renders gridded datasets straight from their lazily loaded cubes,
+        choosing a suitable kind of plot for each type of subset.
 
-    def _render_gridded_point(self, latlon):
-        # doSomething
-        pass
+        The datasets are loaded concurrently.  Each subset keeps its own
+        cube once loaded (and shares it through the DataSubset result cache,
+        if configured), so rendering again does not load anything again.
 
-    def _render_gridded_poly(self, shapefile):
-        # doSomething
-        pass
+        Args:
+            subsetter: DataSubset to render, instead of all of the datasets.
 
-    def _render_gridded_box(self, gridbox):
-        # doSomething
-        pass
+        Returns:
+            list of holoviews objects, one per dataset.
+        """
+        datasets = self.datasets
+        if subsetter is not None:
+            datasets = [subsetter]
+        self._load(datasets)
 
-    def _render_gridded_track(self, track):
-        # doSomething
-        pass
+        plots = []
+        for subset in datasets:
+            if isinstance(subset, (PointSubset, MultiPointSubset)):
+                plots.append(self._render_gridded_point(subset))
+            elif isinstance(subset, ShapeSubset):
+                plots.append(self._render_gridded_poly(subset))
+            elif isinstance(subset, TrackSubset):
+                plots.append(self._render_gridded_track(subset))
+            else:
+                plots.append(self._render_gridded_box(subset))
+        return plots
+
+    def _load(self, datasets):
+        """
+        Loads all the datasets at once, in separate threads.  This is
+        dominated by reading files, so threads run it in parallel well.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            list(pool.map(lambda subset: subset.as_cube(), datasets))
+
+    def _render_gridded_point(self, subset):
+        # Timeseries at each point:
+        cube = subset.as_cube()
+        dataarray = xarray.DataArray.from_iris(cube)
+        if not cube.coords('station', dim_coords=True):
+            return render_plot.Plot(dataarray).render_timeseries()
+
+        station_dim = dataarray.dims[
+            cube.coord_dims(cube.coord('station', dim_coords=True))[0]]
+        return hv.Overlay([
+            render_plot.Plot(dataarray.isel({station_dim: i}))
+            .render_timeseries()
+            for i in range(dataarray.sizes[station_dim])
+        ])
+
+    def _render_gridded_poly(self, subset):
+        # Shapes are masked boxes, so are drawn the same way:
+        return self._render_gridded_box(subset)
+
+    def _render_gridded_box(self, subset):
+        # Map of the grid, reading only the time step and part of the grid
+        # in view whenever it is drawn:
+        cube = subset.as_cube()
+        dataarray = xarray.DataArray.from_iris(cube)
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        x_dim = dataarray.dims[cube.coord_dims(xcoord)[0]]
+        y_dim = dataarray.dims[cube.coord_dims(ycoord)[0]]
+        t_dim = None
+        if cube.coords('time', dim_coords=True):
+            t_dim = dataarray.dims[
+                cube.coord_dims(cube.coord('time', dim_coords=True))[0]]
+        return render_map.Map(dataarray).render_grid(x_dim, y_dim, t_dim)
+
+    def _render_gridded_track(self, subset):
+        # Points along the track, coloured by value.  Tracks have been
+        # interpolated to their sample points, so are small enough to load:
+        cube = subset.as_cube()
+        if cube.ndim != 1:
+            raise ValueError(f'Can only draw a track with a single value at '
+                             f'each sample, not a {cube.ndim}-dimensional '
+                             f'cube.')
+        xcoord = cube.coord(axis='x')
+        ycoord = cube.coord(axis='y')
+        name = cube.name()
+        return hv.Points(
+            (xcoord.points, ycoord.points, cube.data),
+            kdims=[xcoord.name(), ycoord.name()],
+            vdims=[name],
+        ).opts(color=name)
+
+
+DataVisualiser = DataVisuliser
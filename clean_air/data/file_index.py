@@ -0,0 +1,190 @@
+"""
+Persistent index of the contents of data files
+"""
+
+import contextlib
+import os
+import sqlite3
+
+import iris
+
+from clean_air import util
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contents (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    grid TEXT
+);
+CREATE INDEX IF NOT EXISTS contents_path ON contents(path);
+"""
+
+# Times are stored as strings in this format, which sort chronologically
+_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class FileIndex:
+    """
+    A catalog of which phenomena, times and grids each data file holds.
+
+    The catalog is kept in an SQLite database, so persists between runs and
+    can be shared between processes.  Files are only rescanned when their
+    modification time or size changes.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: location of the SQLite database, which will be created if
+                it does not already exist
+        """
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def update(self, paths):
+        """
+        Bring the index up to date for the given files.  Files are indexed
+        by absolute path, so may be given relative to the current directory.
+
+        Files are read outside of any transaction, and each is committed
+        separately, so other processes are only locked out of the database
+        for as long as it takes to write a single file's entries.
+
+        Args:
+            paths (list of str): files to check
+        """
+        with self._connect() as conn:
+            known = {
+                path: (mtime, size) for path, mtime, size
+                in conn.execute("SELECT path, mtime, size FROM files")
+            }
+
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if path in known:
+                    self._forget([path])
+                continue
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+
+            rows = _scan(path)
+            with self._connect() as conn:
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                conn.execute(
+                    "INSERT INTO files VALUES (?, ?, ?)",
+                    (path, stat.st_mtime, stat.st_size),
+                )
+                conn.executemany(
+                    "INSERT INTO contents VALUES (?, ?, ?, ?, ?)",
+                    [(path, *row) for row in rows],
+                )
+
+    def prune(self):
+        """
+        Forget any indexed files that no longer exist.
+
+        This checks every file in the index, so is left to be done
+        explicitly, rather than whenever the index is updated.
+        """
+        with self._connect() as conn:
+            paths = [path for path, in conn.execute("SELECT path FROM files")]
+        self._forget([path for path in paths if not os.path.exists(path)])
+
+    def select(self, paths, parameter=None, start_time=None, end_time=None):
+        """
+        Find which of the given files may contain the requested data.
+
+        The files should already have been indexed using `update`, and may
+        likewise be given relative to the current directory.
+
+        Args:
+            paths (list of str): files to choose from
+            parameter (str?): name of the phenomenon required
+            start_time (datetime?): earliest time required, inclusive
+            end_time (datetime?): latest time required, exclusive
+
+        Returns:
+            (list of str): the subset of paths that may hold matching data,
+            in the same order
+        """
+        query = "SELECT DISTINCT path FROM contents WHERE 1"
+        args = []
+        if parameter:
+            query += " AND name = ?"
+            args.append(parameter)
+        if start_time:
+            query += " AND (end_time IS NULL OR end_time >= ?)"
+            args.append(start_time.strftime(_TIME_FORMAT))
+        if end_time:
+            query += " AND (start_time IS NULL OR start_time < ?)"
+            args.append(end_time.strftime(_TIME_FORMAT))
+
+        with self._connect() as conn:
+            matches = {path for path, in conn.execute(query, args)}
+        return [path for path in paths if os.path.abspath(path) in matches]
+
+    def _forget(self, paths):
+        """
+        Remove the given files from the index.
+        """
+        if not paths:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path,) for path in paths],
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Open the database for a single transaction.
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA foreign_keys = ON")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def _scan(path):
+    """
+    Read the metadata of a single file.
+
+    Returns:
+        (list of tuple): (name, start, end, grid) for each name of each cube
+        in the file
+    """
+    rows = []
+    for cube in iris.load(path):
+        start = end = grid = None
+        if cube.coords("time"):
+            tcoord = cube.coord("time")
+            values = tcoord.bounds if tcoord.has_bounds() else tcoord.points
+            times = tcoord.units.num2date([values.min(), values.max()])
+            start, end = (time.strftime(_TIME_FORMAT) for time in times)
+        try:
+            grid = util.cubes.grid_signature(cube)
+        except iris.exceptions.CoordinateNotFoundError:
+            pass
+
+        # Cubes may be requested by any of their names
+        names = {cube.name(), cube.standard_name, cube.long_name,
+                 cube.var_name}
+        names.discard(None)
+        for name in sorted(names):
+            rows.append((name, start, end, grid))
+    return rows
@@ -1 +1 @@
-from . import crs, cubes
+from . import cache, crs, cubes
@@ -0,0 +1,188 @@
+"""
+This module contains functions to convert cubes to Apache Arrow tables, and
+write them to Parquet files.
+
+The tables have one row per grid cell of each x-y slice of the cube, in the
+same order as clean_air.util.dataframe_converter.convert_to_geodf, with
+columns for:
+    - the values of the cube's other dimension coords (eg time)
+    - the x and y coords, named after the coords
+    - the data, named after the cube
+    - the cell centres as WKB points, in a "geometry" column
+
+Every column is built directly from the cube's numpy arrays, without
+creating any Python objects per row.  Parquet files are written following
+the GeoParquet specification, so can be read by geopandas.read_parquet as
+well as by any Parquet reader.
+"""
+
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from clean_air.util import crs as crs_util
+from clean_air.util.cubes import get_xy_coords
+from clean_air.util.dataframe_converter import _slice_labels, _xy_slices
+
+# Layout of a little-endian 2D WKB point
+_WKB_POINT = np.dtype([('order', 'u1'), ('type', '<u4'),
+                       ('x', '<f8'), ('y', '<f8')])
+
+
+def iter_record_batches(cube, chunk_size=1):
+    """
+    Convert a cube to Arrow record batches, one chunk at a time.
+
+    Only one chunk is read and converted at a time, so large lazy cubes can
+    be processed without holding everything in memory at once.
+
+    Args:
+        cube: input cube, with x and y dimension coords.
+        chunk_size: number of x-y slices to put in each record batch.
+
+    Yields:
+        pyarrow.RecordBatch, each covering up to chunk_size slices.
+    """
+    x_coord, y_coord = get_xy_coords(cube)
+    data = _xy_slices(cube, x_coord, y_coord)
+
+    # The coordinates are the same for every slice, so build them once:
+    x_points, y_points = np.meshgrid(x_coord.points, y_coord.points,
+                                     indexing='ij')
+    x_points = x_points.ravel()
+    y_points = y_points.ravel()
+    geometry = _point_wkb(x_points, y_points)
+    n_cells = x_points.size
+
+    schema = None
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size]
+        if cube.has_lazy_data():
+            chunk = chunk.compute()
+        n_slices = chunk.shape[0]
+
+        columns = {}
+        labels = _slice_labels(cube, x_coord, y_coord,
+                               start, start + n_slices)
+        for name, values in labels.items():
+            columns[name] = pa.array(np.repeat(values, n_cells))
+        columns[x_coord.name()] = pa.array(np.tile(x_points, n_slices))
+        columns[y_coord.name()] = pa.array(np.tile(y_points, n_slices))
+        columns[cube.name()] = _as_arrow_data(chunk.reshape(-1))
+        columns['geometry'] = pa.concat_arrays([geometry] * n_slices)
+
+        if schema is None:
+            schema = pa.schema(
+                [(name, column.type) for name, column in columns.items()],
+                metadata={b'geo': _geo_metadata(cube)},
+            )
+        yield pa.RecordBatch.from_arrays(list(columns.values()),
+                                         schema=schema)
+
+
+def as_table(cube):
+    """
+    Convert a whole cube to an Arrow table.
+
+    Args:
+        cube: input cube, with x and y dimension coords.
+
+    Returns:
+        pyarrow.Table
+    """
+    return pa.Table.from_batches(list(iter_record_batches(cube)))
+
+
+def write_parquet(source, path, chunk_size=1, compression='zstd'):
+    """
+    Write a cube, or a DataSubset, to a GeoParquet file.
+
+    Each chunk of x-y slices is written as a separate row group, so the
+    memory used is bounded by the chunk size rather than the cube size.
+
+    Args:
+        source: cube or DataSubset to write.
+        path: file to write to.
+        chunk_size: number of x-y slices to put in each row group.
+        compression: Parquet compression codec to use.
+    """
+    if hasattr(source, 'as_cube'):
+        cube = source.as_cube()
+    else:
+        cube = source
+
+    writer = None
+    try:
+        for batch in iter_record_batches(cube, chunk_size):
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema,
+                                          compression=compression)
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _as_arrow_data(data):
+    """
+    Helper function to convert a (possibly masked) array to an Arrow array,
+    with masked points as nulls.
+    """
+    if isinstance(data, np.ma.MaskedArray):
+        mask = np.ma.getmask(data)
+        if mask is np.ma.nomask:
+            mask = None
+        return pa.array(data.data, mask=mask)
+    return pa.array(data)
+
+
+def _point_wkb(xs, ys):
+    """
+    Helper function to encode points as WKB.
+
+    Every point has the same size, so the encoded points can be written
+    straight into a single buffer, and wrapped up as an Arrow array.
+
+    Args:
+        xs: array of x values
+        ys: array of y values
+
+    Returns:
+        pyarrow.BinaryArray of WKB points
+    """
+    points = np.empty(len(xs), dtype=_WKB_POINT)
+    points['order'] = 1  # little endian
+    points['type'] = 1  # point
+    points['x'] = xs
+    points['y'] = ys
+    offsets = np.arange(len(xs) + 1, dtype=np.int32) * _WKB_POINT.itemsize
+    return pa.BinaryArray.from_buffers(
+        pa.binary(), len(xs), [None, pa.py_buffer(offsets),
+                               pa.py_buffer(points)],
+    )
+
+
+def _geo_metadata(cube):
+    """
+    Helper function to describe the geometry column, as required by the
+    GeoParquet specification.
+    """
+    crs = None
+    coord_system = cube.coord_system()
+    if coord_system is not None:
+        crs = crs_util.as_pyproj_crs(
+            coord_system.as_cartopy_crs()).to_json_dict()
+
+    return json.dumps({
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': ['Point'],
+                'crs': crs,
+            },
+        },
+    })
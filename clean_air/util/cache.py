@@ -0,0 +1,399 @@
+"""
+Caches for expensive intermediate results.
+"""
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+import dask
+import dask.array as da
+import iris
+import iris.fileformats.netcdf
+import numpy as np
+
+
+class MemoryCache:
+    """
+    An in-memory cache, holding a limited number of values.
+
+    When full, the least recently used values are evicted first.  Values
+    may also be given a limited lifetime.  The cache may safely be shared
+    between threads.
+    """
+
+    def __init__(self, max_items=128, ttl=None):
+        """
+        Args:
+            max_items (int): maximum number of values to hold
+            ttl (float?): time to keep each value for, in seconds
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._values)
+
+    def get(self, key):
+        """
+        Look up a cached value, returning None if it is not present.
+        """
+        with self._lock:
+            try:
+                stored, value = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                del self._values[key]
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store a value in the cache, evicting old values if necessary.
+        """
+        with self._lock:
+            self._values[key] = (time.time(), value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_items:
+                self._values.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove everything from the cache, and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _expire(self):
+        """
+        Remove values that have outlived the ttl.
+        """
+        if self.ttl is None:
+            return
+        now = time.time()
+        expired = [key for key, (stored, _) in self._values.items()
+                   if now - stored > self.ttl]
+        for key in expired:
+            del self._values[key]
+
+
+class DiskCache:
+    """
+    A directory of cached values, stored one per file.
+
+    Values are looked up by a string key, which should be safe to use as a
+    filename (eg a hex digest).  The cache may be limited to a maximum total
+    size on disk, in which case the least recently used entries are evicted
+    first, and values may be given a limited lifetime.  Since everything
+    lives on disk, the same directory can be shared between processes.
+
+    Each file's modification time records when it was stored, and its access
+    time when it was last used.
+
+    By default values are dicts of numpy arrays, stored as compressed .npz
+    files.  Subclasses may store other types by overriding `suffix`, `_read`
+    and `_write`.
+    """
+
+    suffix = ".npz"
+
+    def __init__(self, directory, max_size=None, ttl=None):
+        """
+        Args:
+            directory: directory to store cached values in, which will be
+                created if it does not already exist
+            max_size (int?): maximum total size of the cache, in bytes
+            ttl (float?): time to keep each value for, in seconds
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        The file a given key is (or would be) stored in.
+        """
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """
+        Look up a cached value, returning None if it is not present.
+        """
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if self._expired(stat):
+                os.remove(path)
+                raise FileNotFoundError(path)
+            value = self._read(path)
+            # Mark as recently used
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            # Note this includes the case where another process evicts the
+            # entry while we are reading it
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store a value in the cache, evicting old values if necessary.
+        """
+        path = self.path(key)
+
+        # Write to a temporary file then move it into place, so that other
+        # processes never see a partially written file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self._write(tmp, value)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self._evict()
+
+    def clear(self):
+        """
+        Remove everything from the cache, and reset the hit/miss counters.
+        """
+        for path, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def size(self):
+        """
+        Total size of the cached values, in bytes.
+        """
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _entries(self):
+        """
+        List the (path, stat) pairs of every cached value.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                try:
+                    entries.append((entry.path, entry.stat()))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def _expired(self, stat):
+        return self.ttl is not None and time.time() - stat.st_mtime > self.ttl
+
+    def _evict(self):
+        """
+        Remove expired values, then the least recently used values until
+        within the size limit.
+        """
+        if self.max_size is None and self.ttl is None:
+            return
+
+        entries = sorted(self._entries(), key=lambda e: e[1].st_atime)
+        total = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if not self._expired(stat) and (
+                    self.max_size is None or total <= self.max_size):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+
+    def _read(self, path):
+        with np.load(path) as npz:
+            return dict(npz)
+
+    def _write(self, path, value):
+        # Note savez would add a suffix to the path if given it directly
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **value)
+
+
+class CubeCache(DiskCache):
+    """
+    A DiskCache of cubes, stored as NetCDF files.
+
+    Cubes are loaded with all their data when read from the cache, so they
+    never depend on the cache file, which may be evicted (by this or any
+    other process) as soon as it has been read.
+
+    Saving a cube with lazy data means computing all of it, so by default
+    this is done in a background thread, leaving `put` to return straight
+    away.  The cube's data is then replaced by the computed result, so that
+    it is only read once, for both the cube and the cache.  Use `flush` to
+    wait for the writes to finish.
+    """
+
+    suffix = ".nc"
+
+    def __init__(self, directory, max_size=None, ttl=None, background=True):
+        """
+        Args:
+            directory: directory to store cached values in, which will be
+                created if it does not already exist
+            max_size (int?): maximum total size of the cache, in bytes
+            ttl (float?): time to keep each value for, in seconds
+            background (bool): whether to compute and write cubes with lazy
+                data in a background thread
+        """
+        super().__init__(directory, max_size, ttl)
+        self.background = background
+        self._writer = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        """
+        Store a cube in the cache, evicting old values if necessary.
+
+        The data of cubes with lazy data is computed, once, and shared with
+        the cube given.  This is done in the background unless that has been
+        turned off, in which case the cube's data is realised here.  Cubes
+        written in the background will not be found by `get` until they have
+        been written, while the cube given stays lazy, its data becoming
+        available once computed.
+        """
+        if not value.has_lazy_data():
+            super().put(key, value)
+            return
+        if not self.background:
+            # Realise the data first, so it is not read again to write it
+            value.data
+            super().put(key, value)
+            return
+
+        lazy = value.lazy_data()
+        stored = value.copy()
+        with self._lock:
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(1)
+            self._pending = [future for future in self._pending
+                             if not future.done()]
+            data = self._writer.submit(lazy.compute)
+            self._pending.append(
+                self._writer.submit(self._put_computed, key, stored, data)
+            )
+        value.data = da.from_delayed(dask.delayed(data.result)(),
+                                     value.shape, dtype=value.dtype,
+                                     meta=lazy._meta)
+
+    def flush(self):
+        """
+        Wait for any cubes being written in the background to be stored.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        concurrent.futures.wait(pending)
+
+    def _put_computed(self, key, cube, data):
+        cube.data = data.result()
+        DiskCache.put(self, key, cube)
+
+    def _read(self, path):
+        cube = iris.load_cube(path)
+        # Realise everything while the file is known to exist
+        cube.data
+        for coord in cube.coords():
+            coord.points
+            coord.bounds
+        return cube
+
+    def _write(self, path, value):
+        iris.fileformats.netcdf.save(value, path)
+
+
+class BytesCache(DiskCache):
+    """
+    A DiskCache of raw bytes, such as rendered images.
+    """
+
+    def __init__(self, directory, max_size=None, ttl=None, suffix=".bin"):
+        """
+        Args:
+            directory: directory to store cached values in, which will be
+                created if it does not already exist
+            max_size (int?): maximum total size of the cache, in bytes
+            ttl (float?): time to keep each value for, in seconds
+            suffix (str): file extension to use, eg ".png"
+        """
+        self.suffix = suffix
+        super().__init__(directory, max_size, ttl)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, path, value):
+        with open(path, "wb") as f:
+            f.write(value)
+
+
+class TieredCache:
+    """
+    A series of caches, checked in turn, such as a MemoryCache in front of a
+    DiskCache.
+
+    Values found in later tiers are copied to the earlier ones.
+    """
+
+    def __init__(self, *tiers):
+        """
+        Args:
+            tiers: caches to use, fastest first
+        """
+        self.tiers = tiers
+
+    def get(self, key):
+        """
+        Look up a cached value, returning None if it is not present.
+        """
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for earlier in self.tiers[:i]:
+                    earlier.put(key, value)
+                return value
+        return None
+
+    def put(self, key, value):
+        """
+        Store a value in every tier.
+        """
+        for tier in self.tiers:
+            tier.put(key, value)
+
+    def clear(self):
+        """
+        Remove everything from every tier.
+        """
+        for tier in self.tiers:
+            tier.clear()
@@ -7,7 +7,15 @@ import warnings
 import numpy as np
 import cartopy.crs as ccrs
 import pyproj
-import shapely.ops
+import shapely
+
+from clean_air.util.cache import MemoryCache
+
+# Cache of converted CRSs and transformation functions, keyed by the
+# canonical (WKT or proj4) representations of the CRSs involved.
+# Inspect it via its `hits` and `misses` counters and `len`, and empty it
+# with `clear()`.
+cache = MemoryCache(max_items=64)
 
 # Cartopy classes corresponding to EPSG codes
 _CARTOPY_EPSG = {
@@ -126,7 +134,12 @@ def as_pyproj_crs(crs):
     if isinstance(crs, ccrs.CRS):
         # Conveniently, Cartopy exposes a proj4 init string, which pyproj
         # can handle
-        return pyproj.CRS(crs.proj4_init)
+        key = ("pyproj", crs.proj4_init)
+        converted = cache.get(key)
+        if converted is None:
+            converted = pyproj.CRS(crs.proj4_init)
+            cache.put(key, converted)
+        return converted
 
     raise TypeError(f"Unrecognised CRS: {crs}")
 
@@ -141,6 +154,18 @@ def as_cartopy_crs(crs):
     if not isinstance(crs, pyproj.CRS):
         raise TypeError(f"Unrecognised CRS: {crs}")
 
+    key = ("cartopy", crs.to_wkt())
+    converted = cache.get(key)
+    if converted is None:
+        converted = _convert_to_cartopy(crs)
+        cache.put(key, converted)
+    return converted
+
+
+def _convert_to_cartopy(crs):
+    """
+    Does the actual work for as_cartopy_crs.
+    """
     # Check EPSG code to use specific cartopy classes where possible.
     # Minor note of caution: this method (by default) finds a "close enough"
     # EPSG code, with a confidence level of 70%. Apparently this is useful
@@ -216,35 +241,112 @@ def as_cartopy_crs(crs):
 
 
 def _transformer_cartopy(source, target):
-    def transform(xs, ys):
-        tfpoints = target.transform_points(source, np.array(xs), np.array(ys))
-        # Cartopy gave us an array of shape (n, 3), but shapely expects output
-        # of the same type as the input, ie two lists of length n.
-        # A numpy array of shape (2, n) counts as two lists, so just need to
-        # drop the z coordinates and transpose.
-        return tfpoints[:, 0:2].T
+    def transform(coords):
+        # Cartopy always gives us an array of shape (n, 3), so just need to
+        # drop the z coordinates if we were not given any
+        zs = coords[:, 2] if coords.shape[1] == 3 else None
+        return target.transform_points(
+            source, coords[:, 0], coords[:, 1], zs
+        )[:, :coords.shape[1]]
 
     return transform
 
 def _transformer_pyproj(source, target):
     transformer = pyproj.Transformer.from_crs(source, target, always_xy=True)
-    return transformer.transform
 
-def transform_shape(shape, source, target):
+    def transform(coords):
+        transformed = transformer.transform(*coords.T)
+        return np.column_stack(transformed)
+
+    return transform
+
+def _crs_key(crs):
+    """
+    A canonical representation of a CRS, for use as a cache key.
+    """
+    if isinstance(crs, ccrs.CRS):
+        return crs.proj4_init
+    return crs.to_wkt()
+
+def _transformer(source, target):
+    """
+    Get a function transforming an array of coordinates, of shape (n, 2),
+    or (n, 3) including z coordinates.
+    """
+    key = ("transformer", _crs_key(source), _crs_key(target))
+    transformer = cache.get(key)
+    if transformer is None:
+        transformer = _make_transformer(source, target)
+        cache.put(key, transformer)
+    return transformer
+
+def _make_transformer(source, target):
+    """
+    Create a function transforming an array of coordinates, of shape (n, 2),
+    or (n, 3) including z coordinates.
+    """
     # Determine an appropriate transformation function based on type
     # If the CRSs are not compatible types, assume it is slightly more helpful
     # to match the target, so convert the source
     if isinstance(source, ccrs.CRS):
         if isinstance(target, ccrs.CRS):
-            transformer = _transformer_cartopy(source, target)
-        else:
-            source = as_pyproj_crs(source)
-            transformer = _transformer_pyproj(source, target)
-    else:
-        if isinstance(target, ccrs.CRS):
-            source = as_cartopy_crs(source)
-            transformer = _transformer_cartopy(source, target)
-        else:
-            transformer = _transformer_pyproj(source, target)
+            return _transformer_cartopy(source, target)
+        source = as_pyproj_crs(source)
+        return _transformer_pyproj(source, target)
+
+    if isinstance(target, ccrs.CRS):
+        source = as_cartopy_crs(source)
+        return _transformer_cartopy(source, target)
+    return _transformer_pyproj(source, target)
+
+def transform_shape(shape, source, target):
+    """
+    Transform a shape, or an array of shapes, to another CRS.
 
-    return shapely.ops.transform(transformer, shape)
+    The coordinates of every part of every shape are gathered into a single
+    array and transformed in one go, so this is cheap even for large
+    collections of complex shapes.  Shapes with z coordinates keep them,
+    transformed along with x and y.
+
+    Args:
+        shape: shapely geometry, or array of geometries
+        source: CRS the shape is currently in
+        target: CRS to transform it to
+
+    Returns:
+        the transformed geometry, or array of geometries
+    """
+    transformer = _transformer(source, target)
+    has_z = shapely.has_z(shape)
+    if not np.any(has_z):
+        return shapely.transform(shape, transformer)
+    if np.all(has_z):
+        return shapely.transform(shape, transformer, include_z=True)
+
+    # A mixture, so the 2D and 3D shapes must be transformed separately
+    transformed = np.array(shape, dtype=object)
+    transformed[has_z] = shapely.transform(
+        transformed[has_z], transformer, include_z=True
+    )
+    transformed[~has_z] = shapely.transform(transformed[~has_z], transformer)
+    return transformed
+
+def transform_points(xs, ys, source, target):
+    """
+    Transform many points at once.
+
+    Args:
+        xs, ys: arrays of x and y coordinates
+        source: CRS the points are currently in
+        target: CRS to transform them to
+
+    Returns:
+        (xs, ys): arrays of the transformed coordinates
+    """
+    transformer = _transformer(source, target)
+    coords = np.column_stack([
+        np.asarray(xs, dtype=float).ravel(),
+        np.asarray(ys, dtype=float).ravel(),
+    ])
+    coords = transformer(coords)
+    return coords[:, 0], coords[:, 1]
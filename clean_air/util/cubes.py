@@ -2,12 +2,33 @@
 Helper functions for Iris Cubes
 """
 
+import concurrent.futures
+import hashlib
 import itertools
+import os
 
 import numpy as np
+import dask.array as da
 import iris
 import shapely
 
+from clean_air.util.cache import DiskCache
+
+# Number of grid cells along each side of the tiles used when calculating
+# intersection weights
+_TILE_SIZE = 64
+
+# Optional persistent cache of intersection weights.  This can be set up by
+# assigning a DiskCache here, or via the CLEAN_AIR_WEIGHTS_CACHE (directory)
+# and CLEAN_AIR_WEIGHTS_CACHE_SIZE (maximum size, in bytes) environment
+# variables.
+weights_cache = None
+if os.environ.get("CLEAN_AIR_WEIGHTS_CACHE"):
+    weights_cache = DiskCache(
+        os.environ["CLEAN_AIR_WEIGHTS_CACHE"],
+        int(os.environ.get("CLEAN_AIR_WEIGHTS_CACHE_SIZE", 0)) or None,
+    )
+
 
 def get_xy_coords(cube):
     """
@@ -24,62 +45,332 @@ def get_xy_coords(cube):
     return xcoord, ycoord
 
 
+def grid_signature(cube):
+    """
+    Compute a hash identifying a cube's horizontal grid.
+
+    Two cubes have the same signature iff their X and Y dimension coords have
+    the same points, bounds and coordinate system.
+
+    Args:
+        cube: Cube to get the grid of
+
+    Returns:
+        (str): hex digest
+    """
+    digest = hashlib.sha256()
+    for coord in get_xy_coords(cube):
+        digest.update(str(coord.coord_system).encode())
+        digest.update(np.ascontiguousarray(coord.points, dtype="f8"))
+        if coord.has_bounds():
+            digest.update(np.ascontiguousarray(coord.bounds, dtype="f8"))
+    return digest.hexdigest()
+
+
 def extract_box(cube, box):
     """
     Extracts a rectangular area from a cube.
 
+    For bounded cells, a cell is included iff its bounded region has
+    nonempty intersection with the requested box.  Otherwise falls back to
+    simply checking the point.
+
     Args:
         cube: Cube to subset
         box (x0, y0, x1, y1): Box defined in terms of its lower-left (x0, y0)
             and upper-right (x1, y1) corners
-    """
-
-    def extent_checker(low, high):
-        """
-        Create a callback function that checks whether a cell is contained
-        in a given range.
-
-        For bounded cells, the cell is included iff its bounded region
-        has nonempty intersection with the requested interval. Otherwise
-        falls back to simply checking the point.
-        """
-        def cb(cell):
-            if cell.bound:
-                a, b = cell.bound
-                # Sufficient to check a <= high and low <= b.
-                # Note that this *does* cover the potential edge case where
-                # a requested range is entirely contained by a cell, as
-                # this is just a < low < high < b
-                return a <= high and low <= b
-            return low <= cell.point <= high
-
-        return cb
 
+    Returns:
+        (Cube or None): the subsetted cube, or None if no cells are included
+    """
     xcoord, ycoord = get_xy_coords(cube)
     xmin, ymin, xmax, ymax = box
 
-    constraint = iris.Constraint(coord_values={
-        ycoord.name(): extent_checker(ymin, ymax)
-    })
+    keys = [slice(None)] * cube.ndim
+    keys[cube.coord_dims(ycoord)[0]] = _extent_slice(ycoord, ymin, ymax)
+    if not xcoord.units.modulus:
+        keys[cube.coord_dims(xcoord)[0]] = _extent_slice(xcoord, xmin, xmax)
+    if None in keys:
+        return None
+    cube = cube[tuple(keys)]
+
     if xcoord.units.modulus:
         # ie there is modular arithmetic to worry about.
-        # This can be done by extracting with constraints, but it is
-        # more convenient to use cube.intersection, which additionally
-        # wraps points into the requested range.
-        cube = cube.extract(constraint)
+        # It is more convenient to use cube.intersection for this, which
+        # additionally wraps points into the requested range.
         cube = cube.intersection(
-            iris.coords.CoordExtent(xcoord, xmin, xmax)
+            iris.coords.CoordExtent(xcoord.name(), xmin, xmax)
         )
-    else:
-        constraint &= iris.Constraint(coord_values={
-            xcoord.name(): extent_checker(xmin, xmax)
-        })
-        cube = cube.extract(constraint)
 
     return cube
 
 
-def get_intersection_weights(cube, geom, match_cube_dims=False):
+def _extent_slice(coord, low, high):
+    """
+    Find which cells of a dimension coord lie within a given range.
+
+    Since dimension coords are monotonic, the cells always form a contiguous
+    block, so this can be done directly on the points or bounds, without
+    having to check each cell separately.
+
+    Args:
+        coord (DimCoord): coord to check
+        low, high: range to check against
+
+    Returns:
+        (slice or None): the cells in the range, or None if there are none
+    """
+    if coord.has_bounds():
+        # Sufficient to check a <= high and low <= b.
+        # Note that this *does* cover the potential edge case where
+        # a requested range is entirely contained by a cell, as
+        # this is just a < low < high < b
+        bounds = coord.bounds
+        inside = (bounds.min(axis=1) <= high) & (low <= bounds.max(axis=1))
+    else:
+        inside = (low <= coord.points) & (coord.points <= high)
+
+    indices = np.nonzero(inside)[0]
+    if len(indices) == 0:
+        return None
+    return slice(indices[0], indices[-1] + 1)
+
+
+def extract_time(cube, start=None, end=None):
+    """
+    Extracts a range of times from a cube.
+
+    The times are found by searching the time coord's points directly,
+    rather than with a constraint, which would have to be checked one cell
+    at a time.  If the coord has bounds, a time is included if its cell
+    overlaps the range at all.
+
+    Args:
+        cube: Cube to subset
+        start (datetime?): earliest time to include
+        end (datetime?): time to stop before (ie exclusive)
+
+    Returns:
+        (Cube or None): the subsetted cube, or None if no times match
+
+    Raises:
+        ValueError: if the time coord is multi-dimensional
+    """
+    if not cube.coords("time"):
+        return cube
+    tcoord = cube.coord("time")
+    if tcoord.ndim != 1:
+        raise ValueError(
+            f"cannot extract times from a {tcoord.ndim}-D time coord"
+        )
+    points = tcoord.points
+    low = -np.inf if start is None else tcoord.units.date2num(start)
+    high = np.inf if end is None else tcoord.units.date2num(end)
+
+    if tcoord.has_bounds():
+        # Cells overlapping [low, high), counting zero-width cells as points
+        lower = tcoord.bounds.min(axis=1)
+        upper = tcoord.bounds.max(axis=1)
+        inside = (lower < high) & ((low < upper) | (low <= lower))
+    else:
+        inside = (low <= points) & (points < high)
+
+    dims = cube.coord_dims(tcoord)
+    if not dims:
+        # Scalar time: all or nothing
+        return cube if inside[0] else None
+
+    if isinstance(tcoord, iris.coords.DimCoord) and not tcoord.has_bounds() \
+            and (len(points) < 2 or points[0] < points[-1]):
+        # Monotonically increasing, so binary search will do
+        i0, i1 = np.searchsorted(points, [low, high], side="left")
+        index = slice(i0, i1)
+        empty = i0 >= i1
+    else:
+        index = np.nonzero(inside)[0]
+        empty = len(index) == 0
+        if not empty and isinstance(tcoord, iris.coords.DimCoord):
+            # Monotonic, so the matches are contiguous
+            index = slice(index[0], index[-1] + 1)
+    if empty:
+        return None
+
+    keys = [slice(None)] * cube.ndim
+    keys[dims[0]] = index
+    return cube[tuple(keys)]
+
+
+def interpolate_points(cube, sample_points, dim_name="sample"):
+    """
+    Linearly interpolate a cube to many points at once.
+
+    This is equivalent to calling `cube.interpolate` with
+    `iris.analysis.Linear()` once per point, but works out the interpolation
+    indices and weights for all the points in one go.  Points outside the
+    grid are linearly extrapolated.  If the cube's data is lazy, the result
+    is too, and only the block of cells surrounding the points is ever read.
+
+    Samples along coords with a modulus, such as longitude, are first
+    wrapped into the range of the grid.  Circular coords are treated as
+    periodic, so samples between the last and first points are interpolated
+    across the join rather than extrapolated.
+
+    Args:
+        cube: Cube to interpolate
+        sample_points: list of (coord, values) pairs, where each coord is a
+            dimension coord of the cube (or its name), and each list of
+            values is the same length, n, giving the positions of the points
+            along that coord
+        dim_name (str): name for the new dimension of the points
+
+    Returns:
+        (Cube): cube with the sampled dimensions replaced by a single new
+        trailing dimension of length n, along which the sampled coords
+        become aux coords.  Any other coords spanning the sampled dimensions
+        are dropped.
+    """
+    coords = [cube.coord(coord, dim_coords=True) for coord, _ in sample_points]
+    dims = [cube.coord_dims(coord)[0] for coord in coords]
+    values = [np.asarray(vals, dtype=float) for _, vals in sample_points]
+
+    # For each sampled dimension, find the pair of points either side of
+    # each sample, and how far between them it lies
+    lower, upper, fractions = [], [], []
+    for coord, vals in zip(coords, values):
+        points = coord.points
+        modulus = coord.units.modulus
+        if len(points) == 1:
+            i = np.zeros(len(vals), dtype=np.intp)
+            j = i
+            frac = np.zeros(len(vals))
+        elif modulus and coord.circular:
+            # Wrap into the period starting at the first point, and add the
+            # first point again, a period on, so every sample is bracketed
+            sign = 1 if points[0] < points[-1] else -1
+            vals = points[0] + sign * ((sign * (vals - points[0])) % modulus)
+            points = np.append(points, points[0] + sign * modulus)
+            i = np.searchsorted(sign * points, sign * vals, side="right") - 1
+            i = np.clip(i, 0, len(points) - 2)
+            j = i + 1
+            frac = (vals - points[i]) / (points[j] - points[i])
+            j = j % len(coord.points)
+        else:
+            if modulus:
+                # Wrap into the period centred on the grid
+                centre = (points.min() + points.max()) / 2
+                vals = (vals - centre + modulus / 2) % modulus \
+                    + centre - modulus / 2
+            # Negate descending coords so the search still works
+            sign = 1 if points[0] < points[-1] else -1
+            i = np.searchsorted(sign * points, sign * vals, side="right") - 1
+            i = np.clip(i, 0, len(points) - 2)
+            j = i + 1
+            frac = (vals - points[i]) / (points[j] - points[i])
+        lower.append(i)
+        upper.append(j)
+        fractions.append(frac)
+
+    # Cut the data down to the block of cells surrounding the samples, so
+    # that nothing outside it needs to be read.  Note the upper cell can
+    # come before the lower one, across the join of a circular coord
+    keys = [slice(None)] * cube.ndim
+    for k, dim in enumerate(dims):
+        start = min(lower[k].min(), upper[k].min())
+        keys[dim] = slice(start, max(lower[k].max(), upper[k].max()) + 1)
+        lower[k] = lower[k] - start
+        upper[k] = upper[k] - start
+    data = cube.core_data()[tuple(keys)]
+
+    # Move the sampled dimensions to the end and flatten them together, so
+    # that each corner surrounding the samples can be picked out with a
+    # single `take`
+    data = np.moveaxis(data, dims, range(-len(dims), 0))
+    sampled_shape = data.shape[-len(dims):]
+    data = data.reshape(data.shape[:-len(dims)] + (-1,))
+
+    result = 0
+    for corner in itertools.product([False, True], repeat=len(dims)):
+        indices = []
+        weight = 1
+        for use_upper, i, j, frac in zip(corner, lower, upper, fractions):
+            indices.append(j if use_upper else i)
+            weight = weight * (frac if use_upper else 1 - frac)
+        cells = np.ravel_multi_index(indices, sampled_shape)
+        result = result + weight * np.take(data, cells, axis=-1)
+
+    # Build the new cube, keeping any coords not spanning the sampled dims
+    other_dims = [dim for dim in range(cube.ndim) if dim not in dims]
+    new_dims = {dim: i for i, dim in enumerate(other_dims)}
+    new_dim = len(other_dims)
+    if cube.dtype.kind == "f":
+        result = result.astype(cube.dtype)
+    result = iris.cube.Cube(result)
+    result.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        dim = cube.coord_dims(coord)[0]
+        if dim not in dims:
+            result.add_dim_coord(coord.copy(), new_dims[dim])
+    for coord in cube.aux_coords:
+        coord_dims = cube.coord_dims(coord)
+        if not any(dim in dims for dim in coord_dims):
+            coord_dims = [new_dims[dim] for dim in coord_dims]
+            result.add_aux_coord(coord.copy(), coord_dims)
+    result.add_dim_coord(
+        iris.coords.DimCoord(np.arange(len(values[0])), long_name=dim_name),
+        new_dim,
+    )
+    for coord, vals in zip(coords, values):
+        coord = iris.coords.AuxCoord.from_coord(coord)
+        result.add_aux_coord(coord.copy(points=vals, bounds=None), new_dim)
+
+    return result
+
+
+class SparseWeights:
+    """
+    Intersection weights for a grid, stored as the indices and values of
+    only those cells with non-zero weight.
+
+    Memory usage therefore scales with the size of the shape, rather than
+    the size of the grid.
+
+    Attributes:
+        shape (nx, ny): shape of the full grid
+        x (np.array): x indices of the non-zero cells
+        y (np.array): y indices of the non-zero cells
+        values (np.array): weights of the non-zero cells
+    """
+
+    def __init__(self, shape, x, y, values):
+        self.shape = tuple(shape)
+        self.x = np.asarray(x, dtype=np.intp)
+        self.y = np.asarray(y, dtype=np.intp)
+        self.values = np.asarray(values, dtype=float)
+
+    def __len__(self):
+        return len(self.values)
+
+    def todense(self):
+        """
+        Convert to an (x, y) array of weights.
+        """
+        weights = np.zeros(self.shape)
+        weights[self.x, self.y] = self.values
+        return weights
+
+    def mask(self):
+        """
+        Create an (x, y) boolean array, which is True wherever the weight
+        is zero.
+        """
+        mask = np.ones(self.shape, dtype=bool)
+        mask[self.x, self.y] = False
+        return mask
+
+
+def get_intersection_weights(
+    cube, geom, match_cube_dims=False, workers=None, sparse=False
+):
     """
     Calculate what proportion of each grid cell intersects a given shape.
 
@@ -91,12 +382,49 @@ def get_intersection_weights(cube, geom, match_cube_dims=False):
 
             - If False (the default), the returned array will have shape (x, y)
             - If True, its shape will be compatible with the cube
+        workers (int?):
+            Number of processes to spread the calculation over.  Defaults to
+            the value of the CLEAN_AIR_WORKERS environment variable, or 1 if
+            that is not set.  A value of 0 uses all available cores.
+            The result does not depend on the number of workers.
+        sparse (bool?):
+            Whether to return a SparseWeights object instead of an array,
+            in which case match_cube_dims is ignored.
+
+    If a `weights_cache` has been configured, previously calculated weights
+    for the same grid and geometry are reused.
 
     Returns:
-        (np.array): intersection weights
+        (np.array or SparseWeights): intersection weights
     """
-    # Determine output shape
     xcoord, ycoord = get_xy_coords(cube)
+
+    # Look for previously calculated weights.  Note the geometry is in the
+    # grid's coordinate system, which is part of the grid signature.
+    key = cached = None
+    if weights_cache is not None:
+        digest = hashlib.sha256(grid_signature(cube).encode())
+        digest.update(shapely.to_wkb(geom))
+        key = digest.hexdigest()
+        cached = weights_cache.get(key)
+
+    if cached is not None:
+        weights = SparseWeights(**cached)
+    else:
+        if workers is None:
+            workers = int(os.environ.get("CLEAN_AIR_WORKERS", 1))
+        if workers < 1:
+            workers = os.cpu_count()
+        weights = _intersection_weights(
+            xcoord.bounds, ycoord.bounds, geom, workers
+        )
+        if weights_cache is not None:
+            weights_cache.put(key, vars(weights))
+
+    if sparse:
+        return weights
+
+    # Determine output shape
     ndim = 2
     xdim = 0
     ydim = 1
@@ -109,21 +437,197 @@ def get_intersection_weights(cube, geom, match_cube_dims=False):
     shape[xdim] = len(xcoord.points)
     shape[ydim] = len(ycoord.points)
 
-    # Calculate the weights
-    # TODO:
-    # - consider looping over only the bounding box of the geometry.
-    #   Currently, if the cube is much larger than the shape, the loop
-    #   itself vastly outweighs any actual intersection calculations.
-    # - investigate parallelisation. Would reduce the above need for using
-    #   bounding boxes, and is likely the only way of achieving any speed
-    #   up for large complex shapes at all.
-    weights = np.zeros(shape)
-    indices = [range(n) for n in shape]
-    for i in itertools.product(*indices):
-        x0, x1 = xcoord.bounds[i[xdim]]
-        y0, y1 = ycoord.bounds[i[ydim]]
-        cell = shapely.geometry.box(x0, y0, x1, y1)
-        weight = cell.intersection(geom).area / cell.area
-        weights[i] = weight
+    # Convert the (x, y) weights to a dense array, then rearrange to match
+    weights = weights.todense()
+    if xdim > ydim:
+        weights = weights.T
+    return weights.reshape(shape)
+
+
+def mask_outside(cube, weights):
+    """
+    Mask all points of a cube that lie in cells with zero weight.
+
+    If the cube has lazy data, the mask is applied lazily too, so that no
+    data is read until the result is actually used.
+
+    Arguments:
+        cube (Cube): cube to mask
+        weights (SparseWeights): intersection weights for the cube's grid
+
+    Returns:
+        (Cube): masked copy of the cube
+    """
+    xcoord, ycoord = get_xy_coords(cube)
+    xdim = cube.coord_dims(xcoord)[0]
+    ydim = cube.coord_dims(ycoord)[0]
+
+    # Make the (x, y) mask broadcastable to the cube's shape
+    mask = weights.mask()
+    if xdim > ydim:
+        mask = mask.T
+    shape = [1] * cube.ndim
+    shape[xdim], shape[ydim] = weights.shape
+    mask = mask.reshape(shape)
+
+    # Note we need to do the broadcasting manually: numpy is strangely
+    # reluctant to do it, no matter which of the many ways of creating
+    # a masked array we try
+    if cube.has_lazy_data():
+        data = cube.lazy_data()
+        # Chunk the mask like the data along X and Y first: broadcast_to
+        # can only split the dimensions it creates, not existing ones
+        chunks = [data.chunks[i] if i in (xdim, ydim) else 1
+                  for i in range(cube.ndim)]
+        mask = da.from_array(mask, chunks=chunks)
+        mask = da.broadcast_to(mask, cube.shape, chunks=data.chunks)
+        data = da.ma.masked_array(data, mask=mask)
+    else:
+        mask = np.broadcast_to(mask, cube.shape)
+        data = np.ma.array(cube.data, mask=mask)
+    return cube.copy(data=data)
+
+
+def weighted_mean(cube, weights):
+    """
+    Calculate the area-weighted mean of a cube over its X and Y dimensions.
+
+    Only the cells with non-zero weight are read from the cube's data.  If
+    there are none, because the shape does not cover any of the grid, the
+    result is entirely masked.
+
+    Arguments:
+        cube (Cube): cube to collapse
+        weights (SparseWeights): intersection weights for the cube's grid
+
+    Returns:
+        (Cube): cube with the X and Y dimensions collapsed
+    """
+    xcoord, ycoord = get_xy_coords(cube)
+    xdim = cube.coord_dims(xcoord)[0]
+    ydim = cube.coord_dims(ycoord)[0]
+
+    # Move the X and Y dimensions to the end and flatten them together, so
+    # that the non-zero cells can be picked out with a single `take`
+    data = np.moveaxis(cube.core_data(), [xdim, ydim], [-2, -1])
+    data = data.reshape(data.shape[:-2] + (-1,))
+    cells = np.ravel_multi_index((weights.x, weights.y), weights.shape)
+    values = np.take(data, cells, axis=-1)
+    if isinstance(values, da.Array):
+        values = values.compute()
+    if len(weights):
+        means = np.ma.average(values, axis=-1, weights=weights.values)
+    else:
+        means = np.ma.masked_all(values.shape[:-1], dtype=float)
+
+    # Let iris sort out the metadata, without touching the actual data
+    result = cube.copy(data=cube.lazy_data())
+    result = result.collapsed([xcoord, ycoord], iris.analysis.MEAN)
+    return result.copy(data=means)
+
+
+def _intersection_weights(xbounds, ybounds, geom, workers=1):
+    """
+    Calculate intersection weights for a grid defined by its cell bounds.
+
+    Only cells that overlap the bounding box of the geometry are considered
+    at all.  These are split into tiles, each of which is handled separately
+    using only the piece of the geometry that falls within it, which keeps
+    the intersection calculations cheap even for very complex shapes.  The
+    tiles are always the same regardless of the number of workers, so the
+    result is identical whether or not they are processed in parallel.
+
+    Arguments:
+        xbounds (np.array): bounds of the x coord, with shape (nx, 2)
+        ybounds (np.array): bounds of the y coord, with shape (ny, 2)
+        geom (BaseGeometry): shape to intersect
+        workers (int): number of processes to use
+
+    Returns:
+        (SparseWeights): intersection weights
+    """
+    shape = (len(xbounds), len(ybounds))
+    empty = SparseWeights(shape, [], [], [])
+    if geom.is_empty:
+        return empty
+
+    # Find the cells overlapping the geometry's bounding box.  Note bounds
+    # may be in either order, eg for descending coords.
+    gx0, gy0, gx1, gy1 = geom.bounds
+    xi = np.nonzero(
+        (xbounds.min(axis=1) <= gx1) & (gx0 <= xbounds.max(axis=1))
+    )[0]
+    yi = np.nonzero(
+        (ybounds.min(axis=1) <= gy1) & (gy0 <= ybounds.max(axis=1))
+    )[0]
+    if len(xi) == 0 or len(yi) == 0:
+        return empty
+
+    # Split into tiles, and give each its own piece of the geometry
+    tiles = []
+    for xtile in np.array_split(xi, np.ceil(len(xi) / _TILE_SIZE)):
+        for ytile in np.array_split(yi, np.ceil(len(yi) / _TILE_SIZE)):
+            xb = xbounds[xtile]
+            yb = ybounds[ytile]
+            clip = shapely.box(xb.min(), yb.min(), xb.max(), yb.max())
+            tiles.append((xtile, ytile, xb, yb, geom.intersection(clip)))
+
+    args = [tile[2:] for tile in tiles]
+    if workers > 1 and len(tiles) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_tile_weights, args))
+    else:
+        results = [_tile_weights(arg) for arg in args]
+
+    # Stitch the non-zero parts of the tiles back together
+    x, y, values = [], [], []
+    for (xtile, ytile, *_), tile_weights in zip(tiles, results):
+        i, j = np.nonzero(tile_weights)
+        x.append(xtile[i])
+        y.append(ytile[j])
+        values.append(tile_weights[i, j])
+    return SparseWeights(
+        shape, np.concatenate(x), np.concatenate(y), np.concatenate(values)
+    )
+
+
+def _tile_weights(args):
+    """
+    Calculate intersection weights for a single tile of grid cells.
+
+    Cells entirely inside or outside the geometry are assigned weights of 1
+    or 0 directly, so that only the cells on its boundary need an actual
+    intersection calculating.  All of this is done using vectorised shapely
+    operations.
+
+    Arguments:
+        args (tuple): the x bounds, y bounds, and (clipped) geometry for
+            the tile, packed into one argument for ease of use with
+            executor.map
+
+    Returns:
+        (np.array): intersection weights for the tile
+    """
+    xbounds, ybounds, geom = args
+
+    # Construct all the cells at once, as an (x, y) array
+    x0, x1 = xbounds[:, 0], xbounds[:, 1]
+    y0, y1 = ybounds[:, 0], ybounds[:, 1]
+    cells = shapely.box(
+        x0[:, np.newaxis], y0[np.newaxis, :],
+        x1[:, np.newaxis], y1[np.newaxis, :],
+    )
+
+    # Classify the cells, so that only those on the boundary of the geometry
+    # need any real work doing
+    shapely.prepare(geom)
+    inside = shapely.contains(geom, cells)
+    partial = shapely.intersects(geom, cells) & ~inside
 
+    weights = inside.astype(float)
+    boundary = cells[partial]
+    weights[partial] = (
+        shapely.area(shapely.intersection(boundary, geom))
+        / shapely.area(boundary)
+    )
     return weights
@@ -2,12 +2,14 @@
 This module contains functions to convert between dataframe types.
 """
 
+import os
+
 from clean_air.util.cubes import get_xy_coords
 from iris.pandas import _assert_shared, _as_pandas_coord
+import dask.array as da
 import numpy as np
 import pandas as pd
-from geopandas import GeoDataFrame
-from shapely.geometry import Point
+from geopandas import GeoDataFrame, points_from_xy
 import warnings
 
 
@@ -15,19 +17,41 @@ def as_pandas_data(data, copy=True):
     """
     Sort iris cube style data into pandas style data.
 
+    Masked floating point data keeps its dtype, with masked points replaced
+    by NaN.  Masked integer and boolean data, which cannot hold NaN, is
+    instead returned as a pandas nullable array (eg Int64) sharing the
+    original values and mask.
+
     Args:
         data: Data array to be converted.
-        copy: Boolean value representing whether the data should be copied.
-              or not (this will return an error if the array is masked).
+        copy: Boolean value representing whether the data should be copied
+              or not.  If not, masked floating point data will be filled
+              with NaN in place, so the original array should not be used
+              again afterwards.
 
     Returns:
         Data array in pandas format.
     """
     if isinstance(data, np.ma.MaskedArray):
-        if not copy:
-            raise ValueError("Masked arrays must always be copied.")
-        data = data.astype('f').filled(np.nan)
-    elif copy:
+        values = data.data
+        mask = np.ma.getmask(data)
+        if mask is np.ma.nomask or not mask.any():
+            data = values
+        elif values.dtype.kind in 'fc':
+            if copy:
+                # Note this makes the one and only copy
+                return data.filled(np.nan)
+            np.copyto(values, np.nan, where=mask)
+            return values
+        elif values.dtype.kind in 'iu':
+            return pd.arrays.IntegerArray(values, mask, copy=copy)
+        elif values.dtype.kind == 'b':
+            return pd.arrays.BooleanArray(values, mask, copy=copy)
+        else:
+            # Anything else has no way to represent missing values as is
+            return data.astype('f8').filled(np.nan)
+
+    if copy:
         data = data.copy()
 
     return data
@@ -50,7 +74,7 @@ def as_series(cube, index=None, copy=True):
     """
     # NOTE: This is as yet untested and unfinished; pulled from iris but in
     # need of simplification and modification.
-    data = as_pandas_data(cube.data)
+    data = as_pandas_data(cube.data, copy=copy)
     if index is None:
         if cube.dim_coords:
             index = _as_pandas_coord(cube.dim_coords[0])
@@ -74,32 +98,199 @@ def _make_geo(cube, x_coord, y_coord):
         y_coord: iris dim coord representing y direction
 
     Returns:
-        list of geodataframes
-    """
-    dataframes = []
-    for sub_cube in cube.slices([x_coord, y_coord], ordered=True):
-        # Get the coordinates, data and geometry in the right
-        # order here:
-        x_coords_pd = []
-        y_coords_pd = []
-        data_pd = []
-        geom = []
-        for i, x in enumerate(x_coord.points):
-            for j, y in enumerate(y_coord.points):
-                x_coords_pd.append(x)
-                y_coords_pd.append(y)
-                data_pd.append(sub_cube.data[i, j])
-                geom.append(Point(x, y))
-
-        # Now construct pandas geodataframe object for this sub_cube:
-        geo_df = GeoDataFrame({'x_coord': x_coords_pd,
-                               'y_coord': y_coords_pd,
-                               'data': data_pd,
-                               'geometry': geom})
-
-        dataframes.append(geo_df)
-
-    return dataframes
+        list of geodataframes, one per x-y slice of the cube
+    """
+    geo_df = _make_geo_frame(cube, x_coord, y_coord)
+
+    # The slices are stored one after the other, so can just be split up
+    # again:
+    n_cells = len(x_coord.points) * len(y_coord.points)
+    return [geo_df.iloc[i:i + n_cells]
+            for i in range(0, len(geo_df), n_cells)]
+
+
+def _make_geo_frame(cube, x_coord, y_coord):
+    """
+    Helper function to convert a whole cube to a single geodataframe.
+
+    The rows are ordered slice by slice, as given by
+    cube.slices([x_coord, y_coord], ordered=True), and within each slice
+    by x then y.  Each slice is indexed from 0, exactly as if the slices had
+    been converted separately and then concatenated.
+
+    Args:
+        cube: cube for conversion
+        x_coord: iris dim coord representing x direction
+        y_coord: iris dim coord representing y direction
+
+    Returns:
+        geodataframe
+    """
+    data = _xy_slices(cube, x_coord, y_coord)
+    if cube.has_lazy_data():
+        data = data.compute()
+    return _geo_frame(data, x_coord, y_coord)
+
+
+def _xy_slices(cube, x_coord, y_coord):
+    """
+    Helper function to arrange cube data as a stack of x-y slices.
+
+    The data is not realised, so this is cheap even for lazy cubes.
+
+    Args:
+        cube: cube for conversion
+        x_coord: iris dim coord representing x direction
+        y_coord: iris dim coord representing y direction
+
+    Returns:
+        numpy or dask array of shape (number of slices, nx, ny)
+    """
+    # Put the x and y dimensions last, so that flattening the data gives
+    # us the right order:
+    x_dim = cube.coord_dims(x_coord)[0]
+    y_dim = cube.coord_dims(y_coord)[0]
+    data = cube.core_data()
+    if cube.has_lazy_data():
+        data = da.moveaxis(data, [x_dim, y_dim], [-2, -1])
+    else:
+        data = np.moveaxis(data, [x_dim, y_dim], [-2, -1])
+    return data.reshape((-1,) + data.shape[-2:])
+
+
+def _geo_frame(data, x_coord, y_coord):
+    """
+    Helper function to convert a stack of x-y slices to a geodataframe.
+
+    Args:
+        data: array of shape (number of slices, nx, ny)
+        x_coord: iris dim coord representing x direction
+        y_coord: iris dim coord representing y direction
+
+    Returns:
+        geodataframe
+    """
+    n_slices = data.shape[0]
+    data = as_pandas_data(data.reshape(-1))
+
+    # Every slice has the same coordinates, so build them once then repeat
+    # them for each slice:
+    x_points, y_points = np.meshgrid(x_coord.points, y_coord.points,
+                                     indexing='ij')
+    n_cells = x_points.size
+    x_points = np.tile(x_points.ravel(), n_slices)
+    y_points = np.tile(y_points.ravel(), n_slices)
+
+    return GeoDataFrame({'x_coord': x_points,
+                         'y_coord': y_points,
+                         'data': data,
+                         'geometry': points_from_xy(x_points, y_points)},
+                        index=np.tile(np.arange(n_cells), n_slices))
+
+
+def iter_geodf(cube, chunk_size=1):
+    """
+    Convert a cube to geodataframes one chunk at a time.
+
+    This gives the same rows as convert_to_geodf(cube, restitch=True), but
+    split up into chunks of x-y slices (eg time steps or model levels).  Only
+    one chunk is read and converted at a time, so large lazy cubes can be
+    processed without holding everything in memory at once.
+
+    Args:
+        cube: input cube, with x and y dimension coords.
+        chunk_size: number of x-y slices to put in each geodataframe.
+
+    Yields:
+        geodataframes, each covering up to chunk_size slices.
+    """
+    x_coord, y_coord = get_xy_coords(cube)
+    data = _xy_slices(cube, x_coord, y_coord)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size]
+        if cube.has_lazy_data():
+            chunk = chunk.compute()
+        yield _geo_frame(chunk, x_coord, y_coord)
+
+
+def write_geoparquet(cube, directory, chunk_size=1):
+    """
+    Stream a cube into a partitioned GeoParquet dataset.
+
+    Each chunk of x-y slices (see iter_geodf) is written to its own file in
+    the directory, named part-00000.parquet, part-00001.parquet etc, so the
+    memory used is bounded by the chunk size rather than the cube size.  The
+    whole directory can be read back as a single table by pyarrow, or
+    geopandas.read_parquet.
+
+    As the chunks are written separately, the values of the cube's other
+    dimension coords (eg time) are added as extra columns, named after the
+    coords.
+
+    Args:
+        cube: input cube, with x and y dimension coords.
+        directory: directory to write to, which will be created if it does
+                   not already exist.
+        chunk_size: number of x-y slices to put in each file.
+
+    Returns:
+        list of the paths written.
+    """
+    x_coord, y_coord = get_xy_coords(cube)
+    n_cells = len(x_coord.points) * len(y_coord.points)
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for n, gdf in enumerate(iter_geodf(cube, chunk_size)):
+        # Label the rows with the coordinate values of their slices:
+        start = n * chunk_size
+        stop = start + len(gdf) // n_cells
+        labels = _slice_labels(cube, x_coord, y_coord, start, stop)
+        for name, values in labels.items():
+            gdf[name] = np.repeat(values, n_cells)
+
+        path = os.path.join(directory, f'part-{n:05d}.parquet')
+        gdf.to_parquet(path)
+        paths.append(path)
+    return paths
+
+
+def _slice_labels(cube, x_coord, y_coord, start, stop):
+    """
+    Helper function to find the coordinate values of a range of x-y slices,
+    numbered as in _xy_slices.
+
+    Args:
+        cube: cube the slices are taken from
+        x_coord: iris dim coord representing x direction
+        y_coord: iris dim coord representing y direction
+        start: number of the first slice
+        stop: number of the slice after the last one
+
+    Returns:
+        dict mapping the name of each other dimension coord to an array of
+        its values, one per slice
+    """
+    xy_dims = cube.coord_dims(x_coord) + cube.coord_dims(y_coord)
+    other_dims = [dim for dim in range(cube.ndim) if dim not in xy_dims]
+    other_shape = [cube.shape[dim] for dim in other_dims]
+
+    indices = np.unravel_index(np.arange(start, stop), other_shape)
+    labels = {}
+    for dim, index in zip(other_dims, indices):
+        for coord in cube.coords(dimensions=dim, dim_coords=True):
+            labels[coord.name()] = _as_column(coord)[index]
+    return labels
+
+
+def _as_column(coord):
+    """
+    Helper function to convert coord points to values suitable for a
+    dataframe column, turning times into datetimes.
+    """
+    if coord.units.is_time_reference():
+        return pd.to_datetime(coord.units.num2pydate(coord.points)).values
+    return coord.points
 
 
 def convert_to_geodf(cube, restitch=False):
@@ -129,14 +320,14 @@ def convert_to_geodf(cube, restitch=False):
         # If there are two or more coords, we need to look for standard
         # xy dimension coords and use them to slice the cube up:
         x_coord, y_coord = get_xy_coords(cube)
-        geodataframes = _make_geo(cube, x_coord, y_coord)
 
-        # Now we have a set of 2D geopandas dataframes which must be
-        # stitched back together if required
+        # Convert everything in one go if we want it all stitched together,
+        # otherwise split into a set of 2D geopandas dataframes:
         if restitch is True:
-            geodataframe = pd.concat(geodataframes)
+            geodataframe = _make_geo_frame(cube, x_coord, y_coord)
             return geodataframe
         else:
+            geodataframes = _make_geo(cube, x_coord, y_coord)
             return geodataframes
 
     # For cubes with less than 2 dim coords (warn then convert to series):
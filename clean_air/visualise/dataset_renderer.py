@@ -2,25 +2,61 @@
 Top-level module for rendering datasets.
 """
 
-import geopandas
+import glob
+import hashlib
+import io
+import json
+import os
+
+import colorcet
+import datashader
+import datashader.transfer_functions
 import iris
 import xarray
-from clean_air.visualise import render_map, render_plot
+from clean_air import util
+from clean_air.visualise import pyramid, render_map, render_plot
+
+# Optional cache of rendered images, keyed by everything that affects them.
+# This can be set up by assigning a cache here (with `get` and `put` methods,
+# such as a util.cache.TieredCache), or via the CLEAN_AIR_RENDER_CACHE
+# (directory) and CLEAN_AIR_RENDER_CACHE_SIZE (maximum size, in bytes)
+# environment variables, which set up an in-memory cache in front of a
+# directory of PNG files.
+render_cache = None
+if os.environ.get("CLEAN_AIR_RENDER_CACHE"):
+    render_cache = util.cache.TieredCache(
+        util.cache.MemoryCache(max_items=256),
+        util.cache.BytesCache(
+            os.environ["CLEAN_AIR_RENDER_CACHE"],
+            int(os.environ.get("CLEAN_AIR_RENDER_CACHE_SIZE", 0)) or None,
+            suffix=".png",
+        ),
+    )
 
 
 class DatasetRenderer:
-    def __init__(self, dataset_path):
-        # Use iris to read in dataset as lazy array here:
+    def __init__(self, dataset_path, pyramid_path=None):
+        # Use iris to read in dataset as lazy array here.  This is the only
+        # time the file is opened, and only its metadata is read until the
+        # data is actually plotted:
         self.path = dataset_path
         self.dataset = iris.load_cube(dataset_path)
         self.dims = self.dataset.dim_coords
+        self.dataframe = None
 
-        # Guess all possible dim coords here using iris object before loading
-        # dataframe as xarray object (but scalar coords become None because we
-        # can't make plots out of them):
+        # Optional precomputed pyramid of the dataset (see
+        # pyramid.build_pyramid) to draw maps from:
+        self.pyramid = None
+        if pyramid_path is not None:
+            self.pyramid = pyramid.Pyramid(pyramid_path)
+
+        # Guess all possible dim coords here using iris object before
+        # converting to an xarray object (but scalar coords become None
+        # because we can't make plots out of them).  Note this goes by the
+        # shape of each coord, so no coord points need to be read either:
         self.x_coord = self.y_coord = self.z_coord = self.t_coord = None
         for coord in self.dataset.coords():
-            if len(coord.points) > 1:
+            if coord.core_points().size > 1:
                 axis = iris.util.guess_coord_axis(coord)
                 if axis == 'X' and self.x_coord is None:
                     self.x_coord = coord.name()
@@ -31,6 +67,19 @@ class DatasetRenderer:
                 elif axis == 'T' and self.t_coord is None:
                     self.t_coord = coord.name()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the files of the pyramid, if there is one.
+        """
+        if self.pyramid is not None:
+            self.pyramid.close()
+
     def render(self):
         """
         Analyses the dimensionality of the dataset and then sends to
@@ -39,23 +88,143 @@ class DatasetRenderer:
         # If we have both an x-coord and y-coord then we can draw a map:
         if self.x_coord is not None and self.y_coord is not None:
             self.img_type = 'map'
-            self.dataframe = geopandas.read_file(self.path)
-            render_map.Map(self.dataframe).render(self.x_coord,
-                                                  self.y_coord,
-                                                  self.z_coord,
-                                                  self.t_coord)
+            self.dataframe = self._as_xarray()
+            self.plot = render_map.Map(self.dataframe, self.pyramid).render(
+                self.x_coord, self.y_coord, self.z_coord, self.t_coord)
         # If we have just a time coord then we can make a timeseries:
-        elif self.x_coord is None and self.y_coord is None:
+        elif self.x_coord is None and self.y_coord is None \
+                and self.t_coord is not None:
             self.img_type = 'timeseries'
-            self.dataframe = xarray.open_dataset(self.path)
-            render_plot.Plot(self.dataframe).render_timeseries()
-        # If we don't have any coords then something's gone wrong and we can't
-        # plot anything:
-        elif (self.x_coord and self.y_coord and self.z_coord and self.t_coord) \
-                is None:
-            raise ValueError('All dimension coordinates are either missing or '
-                             'scalar, please choose a dataset with more '
-                             'coordinate points.')
+            self.dataframe = self._as_xarray()
+            self.plot = render_plot.Plot(self.dataframe).render_timeseries()
+        # Otherwise something's gone wrong and we can't plot anything:
+        else:
+            raise ValueError('Dimension coordinates are missing or scalar, '
+                             'please choose a dataset with x and y '
+                             'coordinates, or just a time coordinate.')
+
+    def _as_xarray(self):
+        """
+        Converts the already loaded iris cube into an xarray object for
+        plotting, rather than reading the file again.  Lazy data stays lazy,
+        as a dask array.
+        """
+        return xarray.DataArray.from_iris(self.dataset)
+
+    def render_png(self, time_index=0, x_range=None, y_range=None,
+                   width=800, height=600, cmap='bgy'):
+        """
+        Draws a map of a single time step as a PNG image, using datashader.
+
+        If a `render_cache` has been configured, images are reused for as
+        long as the dataset file is unchanged.
+
+        Args:
+            time_index: index of the time step to draw.
+            x_range: (min, max) of the x coordinates to draw, defaulting to
+                     the whole dataset.
+            y_range: (min, max) of the y coordinates to draw, defaulting to
+                     the whole dataset.
+            width: width of the image, in pixels.
+            height: height of the image, in pixels.
+            cmap: name of the colorcet colour map to use, or a list of
+                  colours.
+
+        Returns:
+            PNG image, as bytes.
+        """
+        if self.x_coord is None or self.y_coord is None:
+            raise ValueError('Dataset has no x and y coordinates, so cannot '
+                             'be drawn as a map.')
+
+        view = dict(time_index=time_index, x_range=x_range, y_range=y_range,
+                    width=width, height=height, cmap=cmap)
+        key = None
+        if render_cache is not None:
+            key = self._render_key(view)
+            png = render_cache.get(key)
+            if png is not None:
+                return png
+
+        png = self._draw_png(**view)
+        if key is not None:
+            render_cache.put(key, png)
+        return png
+
+    def _render_key(self, view):
+        """
+        Identifies an image by the dataset file (including when it was last
+        modified), the variable drawn and the view.
+        """
+        stat = os.stat(self.path)
+        spec = dict(view, path=os.path.abspath(self.path),
+                    mtime=stat.st_mtime, size=stat.st_size,
+                    variable=self.dataset.name(),
+                    pyramid=self.pyramid and self.pyramid.path)
+        spec = json.dumps(spec, sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def _draw_png(self, time_index, x_range, y_range, width, height, cmap):
+        if self.pyramid is not None:
+            # Only read as much as the image needs:
+            data = self.pyramid.select(x_range, y_range, width, height,
+                                       time_index)
+            x_dim, y_dim = self.pyramid.x_dim, self.pyramid.y_dim
+        else:
+            data = self._as_xarray()
+            x_dim = data.dims[self.dataset.coord_dims(self.x_coord)[0]]
+            y_dim = data.dims[self.dataset.coord_dims(self.y_coord)[0]]
+            if self.t_coord is not None:
+                t_dim = data.dims[self.dataset.coord_dims(self.t_coord)[0]]
+                data = data.isel({t_dim: time_index})
+            # Any other dimensions (eg model levels) are drawn at the first
+            # index:
+            data = data.isel({dim: 0 for dim in data.dims
+                              if dim not in (x_dim, y_dim)})
+
+        canvas = datashader.Canvas(plot_width=width, plot_height=height,
+                                   x_range=x_range, y_range=y_range)
+        aggregate = canvas.quadmesh(data.load(), x=x_dim, y=y_dim)
+        image = datashader.transfer_functions.shade(
+            aggregate, cmap=colorcet.palette.get(cmap, cmap))
+
+        png = io.BytesIO()
+        image.to_pil().save(png, format='PNG')
+        return png.getvalue()
+
+
+def prewarm(dataset_pattern, time_indices=None, views=({},),
+            pyramid_path=None):
+    """
+    Renders images into the `render_cache` ahead of time, so that the first
+    visitors to request them do not have to wait.
+
+    Args:
+        dataset_pattern: path of the dataset, or a glob, in which case the
+                         most recently modified match (eg the latest forecast
+                         run) is used.
+        time_indices: time steps to draw, defaulting to all of them.
+        views: sequence of dicts of other arguments to
+               DatasetRenderer.render_png, eg x_range and y_range, one for
+               each popular view.
+        pyramid_path: optional precomputed pyramid of the dataset.
 
+    Returns:
+        the DatasetRenderer used, which should be closed when finished with.
+    """
+    paths = glob.glob(dataset_pattern)
+    if not paths:
+        raise OSError(f'No files found matching {dataset_pattern}')
+    path = max(paths, key=os.path.getmtime)
 
+    renderer = DatasetRenderer(path, pyramid_path)
+    if time_indices is None:
+        time_indices = [0]
+        if renderer.t_coord is not None:
+            n_times = len(renderer.dataset.coord(renderer.t_coord).points)
+            time_indices = range(n_times)
 
+    for time_index in time_indices:
+        for view in views:
+            renderer.render_png(time_index, **view)
+    return renderer
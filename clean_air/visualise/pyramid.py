@@ -0,0 +1,238 @@
+"""
+Module to precompute multi-resolution versions of gridded datasets, so that
+maps can be drawn quickly at any zoom level.
+"""
+
+import os
+
+import numpy as np
+import xarray
+
+
+def build_pyramid(dataarray, path, x_dim, y_dim, t_dim=None, factor=2,
+                  min_size=256, tile_size=256):
+    """
+    Writes a pyramid of successively coarser versions of a dataset to a
+    directory of NetCDF files.
+
+    Level 0 is the original data, and each level after that averages blocks
+    of factor x factor cells of the one before, until the grid is no bigger
+    than min_size in either direction.  Each level is stored in its own
+    file, level_0.nc, level_1.nc etc, chunked on disk into tiles of one time
+    step and tile_size x tile_size cells.  The data is processed a tile at a
+    time, and each level is computed from the one already written, so the
+    memory used does not depend on the size of the dataset.
+
+    Args:
+        dataarray: xarray DataArray to use, which may be lazy.
+        path: directory to write to, which will be created if it does not
+              already exist.
+        x_dim: name of the x dimension.
+        y_dim: name of the y dimension.
+        t_dim: name of the time dimension, if there is one.
+        factor: amount to coarsen by at each level.
+        min_size: size at which to stop coarsening.
+        tile_size: size of the tiles the levels are stored and processed
+                   in, which should be a multiple of factor.
+
+    Returns:
+        Pyramid object for the files written.
+    """
+    name = dataarray.name or 'data'
+    level = dataarray.rename(name)
+    if t_dim is not None:
+        level = level.chunk({t_dim: 1})
+
+    n_levels = 1
+    size = max(level.sizes[x_dim], level.sizes[y_dim])
+    while size > min_size and size >= factor:
+        size //= factor
+        n_levels += 1
+
+    # Each level's file describes the whole pyramid:
+    attrs = {'variable': name, 'x_dim': x_dim, 'y_dim': y_dim,
+             'factor': factor, 'levels': n_levels, 'tile_size': tile_size}
+    if t_dim is not None:
+        attrs['t_dim'] = t_dim
+
+    os.makedirs(path, exist_ok=True)
+    previous = None
+    try:
+        for n in range(n_levels):
+            level_path = _level_path(path, n)
+            chunks = _tile_chunks(level, x_dim, y_dim, t_dim, tile_size)
+            encoding = {name: {'chunksizes': tuple(chunks.get(dim, size)
+                                                   for dim, size in
+                                                   level.sizes.items())}}
+            level.to_dataset().assign_attrs(attrs).to_netcdf(
+                level_path, encoding=encoding)
+
+            # The level just written is only needed to compute the next one
+            if previous is not None:
+                previous.close()
+            previous = xarray.open_dataset(level_path, chunks=chunks)
+            level = previous[name].coarsen({x_dim: factor, y_dim: factor},
+                                           boundary='trim').mean()
+    finally:
+        if previous is not None:
+            previous.close()
+
+    return Pyramid(path)
+
+
+class Pyramid:
+    """
+    Class to choose the right level of a precomputed pyramid (see
+    build_pyramid) for a given view of the data.
+
+    The level files are kept open until `close` is called, or the pyramid
+    is used as a context manager.
+    """
+    def __init__(self, path):
+        self.path = path
+        with xarray.open_dataset(_level_path(path, 0)) as level:
+            attrs = dict(level.attrs)
+        self.variable = attrs['variable']
+        self.x_dim = attrs['x_dim']
+        self.y_dim = attrs['y_dim']
+        self.t_dim = attrs.get('t_dim')
+        self.factor = int(attrs['factor'])
+        tile_size = int(attrs.get('tile_size', 256))
+
+        # Open every level lazily, in the tiles it is stored in, so that only
+        # the data that is actually displayed ever gets read:
+        self._datasets = []
+        self.levels = []
+        try:
+            for n in range(int(attrs['levels'])):
+                dataset = xarray.open_dataset(_level_path(path, n))
+                self._datasets.append(dataset)
+                level = dataset[self.variable]
+                self.levels.append(level.chunk(_tile_chunks(
+                    level, self.x_dim, self.y_dim, self.t_dim, tile_size)))
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the level files.  The levels cannot be read after this.
+        """
+        for dataset in self._datasets:
+            dataset.close()
+        self._datasets = []
+
+    def level_for(self, x_range=None, y_range=None, width=800, height=600):
+        """
+        Finds the coarsest level that still has at least one grid cell per
+        pixel, for a view of the given extent and size.
+
+        Args:
+            x_range: (min, max) of the x coordinates to view, defaulting to
+                     the whole dataset.
+            y_range: (min, max) of the y coordinates to view, defaulting to
+                     the whole dataset.
+            width: width of the view, in pixels.
+            height: height of the view, in pixels.
+
+        Returns:
+            index of the level to use.
+        """
+        x_range = x_range or _extent(self.levels[0][self.x_dim])
+        y_range = y_range or _extent(self.levels[0][self.y_dim])
+        x_pixel = abs(x_range[1] - x_range[0]) / width
+        y_pixel = abs(y_range[1] - y_range[0]) / height
+
+        best = 0
+        for n, level in enumerate(self.levels):
+            x_res = _resolution(level[self.x_dim])
+            y_res = _resolution(level[self.y_dim])
+            if x_res <= x_pixel and y_res <= y_pixel:
+                best = n
+        return best
+
+    def select(self, x_range=None, y_range=None, width=800, height=600,
+               time_index=None):
+        """
+        Extracts the data for a view, from the coarsest suitable level.
+
+        Args:
+            x_range: (min, max) of the x coordinates to view, defaulting to
+                     the whole dataset.
+            y_range: (min, max) of the y coordinates to view, defaulting to
+                     the whole dataset.
+            width: width of the view, in pixels.
+            height: height of the view, in pixels.
+            time_index: index of the time step to view, if the dataset has a
+                        time dimension.
+
+        Returns:
+            xarray DataArray, still lazy, of at most about width x height
+            points (or a few more, covering the edges of the view).
+        """
+        level = self.levels[self.level_for(x_range, y_range, width, height)]
+        if self.t_dim is not None and time_index is not None:
+            level = level.isel({self.t_dim: time_index})
+        if x_range is not None:
+            level = self.crop(level, self.x_dim, x_range)
+        if y_range is not None:
+            level = self.crop(level, self.y_dim, y_range)
+        return level
+
+    @staticmethod
+    def crop(dataarray, dim, limits):
+        """
+        Cuts a DataArray down to the given range of one of its coordinates,
+        keeping the cells either side so that the edges of the view are
+        filled.  This is how views are selected from each level, but works
+        on any gridded DataArray.
+
+        Args:
+            dataarray: xarray DataArray, which may be lazy.
+            dim: name of the dimension to cut down.
+            limits: (min, max) of the coordinates to keep.
+
+        Returns:
+            xarray DataArray, still lazy, of the cells in range.
+        """
+        points = dataarray[dim].values
+        low, high = sorted(limits)
+        inside = np.nonzero((points >= low) & (points <= high))[0]
+        if inside.size == 0:
+            # Pick the nearest cell, so there is still something to draw
+            nearest = np.argmin(np.abs(points - (low + high) / 2))
+            return dataarray.isel({dim: slice(nearest, nearest + 1)})
+        start = max(inside[0] - 1, 0)
+        stop = inside[-1] + 2
+        return dataarray.isel({dim: slice(start, stop)})
+
+
+def _level_path(path, n):
+    return os.path.join(path, f'level_{n}.nc')
+
+
+def _tile_chunks(dataarray, x_dim, y_dim, t_dim, tile_size):
+    # One time step, and square tiles of the grid, at a time
+    chunks = {x_dim: min(tile_size, dataarray.sizes[x_dim]),
+              y_dim: min(tile_size, dataarray.sizes[y_dim])}
+    if t_dim is not None:
+        chunks[t_dim] = 1
+    return chunks
+
+
+def _extent(coord):
+    # Note this includes the whole of the cells at either end
+    half = _resolution(coord) / 2 if coord.size > 1 else 0
+    return float(coord.min()) - half, float(coord.max()) + half
+
+
+def _resolution(coord):
+    if coord.size < 2:
+        return np.inf
+    return float(abs(coord[1] - coord[0]))
@@ -2,15 +2,26 @@
 Module to create fabulous visualisations of maps.
 """
 
+import holoviews as hv
 import hvplot.xarray  # noqa
 
+from . import pyramid as pyr
+
 
 class Map:
     """
     Class to process data and create a lovely map from it.
     """
-    def __init__(self, dataframe):
-        self.df = dataframe.load()
+    def __init__(self, dataframe, pyramid=None, width=800, height=600):
+        # Note the data is not loaded here, so that only what is needed for
+        # the plot is ever read:
+        self.df = dataframe
+
+        # If a precomputed pyramid (see pyramid.build_pyramid) is given, it
+        # is used instead of the full resolution data:
+        self.pyramid = pyramid
+        self.width = width
+        self.height = height
 
     def render(self, x_coord, y_coord, z_coord=None, t_coord=None):
         # NOTE: Must have a a deployed Bokeh Server app or a deployed Panel
@@ -18,11 +29,126 @@ class Map:
         # NOTE: At this stage this is only displaying data points, without an
         # actual map behind it yet (although geo=True might add a map, I need
         # to see the image to find out...)
+        if self.pyramid is not None:
+            return self._render_pyramid(x_coord, y_coord, t_coord)
 
         # TODO: work out what to do when we have x and t coords as well
         # I assume this will involve Panel so that we can make sliders and
         # dashboards and widgets and stuff:
         # https://holoviz.org/tutorial/Building_Panels.html
-        self.df.hvplot.points(x=x_coord, y=y_coord, datashade=True, geo=True)
+        return self.df.hvplot.points(x=x_coord, y=y_coord, datashade=True,
+                                     geo=True)
+
+    def _render_pyramid(self, x_coord, y_coord, t_coord=None):
+        """
+        Creates a map which redraws itself from the most suitable level of
+        the pyramid whenever it is panned or zoomed, so that the amount of
+        data read and sent to the browser only depends on the size of the
+        map.
+        """
+        n_times = None
+        if t_coord is not None and self.pyramid.t_dim is not None:
+            n_times = self.pyramid.levels[0].sizes[self.pyramid.t_dim]
+
+        def image(time_index=None, x_range=None, y_range=None):
+            return self.pyramid_image(x_coord, y_coord, time_index,
+                                      x_range, y_range)
+
+        return _dynamic_map(image, n_times)
+
+    def render_grid(self, x_coord, y_coord, t_coord=None):
+        """
+        Creates a map of gridded data which redraws itself whenever it is
+        panned or zoomed, from just the time step and part of the grid in
+        view, thinned out to about one cell per pixel.  Like a pyramid map,
+        only what is drawn is ever read, but without having to build the
+        pyramid first.
+
+        Args:
+            x_coord: name of the x dimension.
+            y_coord: name of the y dimension.
+            t_coord: name of the time dimension, if there is one.
+
+        Returns:
+            holoviews DynamicMap, with a time_index dimension if there is a
+            time dimension.
+        """
+        n_times = None
+        if t_coord is not None:
+            n_times = self.df.sizes[t_coord]
+
+        def image(time_index=None, x_range=None, y_range=None):
+            return self.grid_image(x_coord, y_coord, t_coord, time_index,
+                                   x_range, y_range)
+
+        return _dynamic_map(image, n_times)
 
+    def grid_image(self, x_coord, y_coord, t_coord=None, time_index=None,
+                   x_range=None, y_range=None):
+        """
+        Draws a single view of gridded data.
 
+        Args:
+            x_coord: name of the x dimension.
+            y_coord: name of the y dimension.
+            t_coord: name of the time dimension, if there is one.
+            time_index: index of the time step to draw.
+            x_range: (min, max) of the x coordinates to view.
+            y_range: (min, max) of the y coordinates to view.
+
+        Returns:
+            holoviews Image
+        """
+        data = self.df
+        if t_coord is not None:
+            data = data.isel({t_coord: time_index or 0})
+        if x_range is not None and None not in x_range:
+            data = pyr.Pyramid.crop(data, x_coord, x_range)
+        if y_range is not None and None not in y_range:
+            data = pyr.Pyramid.crop(data, y_coord, y_range)
+
+        # Only every so many cells are needed to fill each pixel:
+        x_step = max(data.sizes[x_coord] // self.width, 1)
+        y_step = max(data.sizes[y_coord] // self.height, 1)
+        data = data.isel({x_coord: slice(None, None, x_step),
+                          y_coord: slice(None, None, y_step)})
+
+        # This is small enough to load, whatever the size of the dataset:
+        data = data.load()
+        return hv.Image(data, kdims=[x_coord, y_coord]).opts(
+            width=self.width, height=self.height)
+
+    def pyramid_image(self, x_coord, y_coord, time_index=None, x_range=None,
+                      y_range=None):
+        """
+        Draws a single view of the pyramid.
+
+        Args:
+            x_coord: name of the x coordinate.
+            y_coord: name of the y coordinate.
+            time_index: index of the time step to draw.
+            x_range: (min, max) of the x coordinates to view.
+            y_range: (min, max) of the y coordinates to view.
+
+        Returns:
+            holoviews Image
+        """
+        if time_index is None and self.pyramid.t_dim is not None:
+            time_index = 0
+        data = self.pyramid.select(x_range, y_range, self.width,
+                                   self.height, time_index)
+        # This is small enough to load, whatever the size of the dataset:
+        data = data.load()
+        return hv.Image(data, kdims=[x_coord, y_coord]).opts(
+            width=self.width, height=self.height)
+
+
+def _dynamic_map(image, n_times=None):
+    """
+    Wraps a function drawing a view into a DynamicMap, which calls it again
+    whenever the map is panned or zoomed, or another time step is picked.
+    """
+    kdims = []
+    if n_times is not None:
+        kdims = [hv.Dimension('time_index', values=list(range(n_times)))]
+    return hv.DynamicMap(image, kdims=kdims, streams=[hv.streams.RangeXY()])
@@ -2,18 +2,158 @@
 Module to create fabulous visualisations of various non-map plots.
 """
 
+import cftime
+import holoviews as hv
 import hvplot.xarray  # noqa
+import numpy as np
+import xarray
 
 
 class Plot:
     """
     Class to process data and create a lovely map from it.
     """
-    def __init__(self, dataframe):
-        self.df = dataframe.load()
+    def __init__(self, dataframe, width=800):
+        # Note the data is not loaded here, so that only what is needed for
+        # the plot is ever read:
+        self.df = dataframe
+        self.width = width
 
     def render_timeseries(self):
         # NOTE: Must have a a deployed Bokeh Server app or a deployed Panel
         # app to be able to view these plots.
-        self.df.hvplot.line(datashade=True)
+        # Only a few points per pixel can ever be seen, so the series is cut
+        # down to those, and cut down again from the full data whenever the
+        # plot is zoomed into (see decimate):
+        series = self._series()
+        if series.ndim != 1:
+            raise ValueError(f'Can only plot a timeseries of 1-dimensional '
+                             f'data, not {series.ndim}-dimensional data.')
+        time_dim = series.dims[0]
+        name = series.name or 'data'
 
+        def curve(x_range=None):
+            times, values = decimate(series, self.width, x_range)
+            return hv.Curve((times, values), kdims=[time_dim], vdims=[name])
+
+        return hv.DynamicMap(curve, streams=[hv.streams.RangeX()]).opts(
+            width=self.width)
+
+    def _series(self):
+        """
+        Finds the 1-dimensional series to plot.
+        """
+        series = self.df
+        if isinstance(series, xarray.Dataset):
+            series = series[list(series.data_vars)[0]]
+        return series.squeeze()
+
+
+def decimate(series, n_bins, t_range=None, chunk_size=None):
+    """
+    Cuts down a timeseries to the points needed to draw it at a given width,
+    using M4 aggregation: for each pixel column, only the first, last,
+    minimum and maximum points are kept, which is enough for the line drawn
+    to look exactly the same.
+
+    The data is read a chunk at a time, so only one chunk and the points
+    kept so far are ever held in memory.  Since each bin's first, last,
+    minimum and maximum must be among those of the chunks it covers, the
+    result is the same as if everything had been read at once.
+
+    Args:
+        series: 1-dimensional xarray DataArray, along a sorted time (or other
+                numerical) coordinate, which may be lazy.
+        n_bins: number of bins (pixels) to divide the time range into.
+        t_range: (start, end) of the time range to keep, defaulting to the
+                 whole series.
+        chunk_size: number of points to read at a time, defaulting to the
+                    size of the dask chunks, or a million points for data
+                    that is already loaded.
+
+    Returns:
+        times, values: numpy arrays of the points kept.
+    """
+    times = series[series.dims[0]].values
+    numbers = _as_numbers(times)
+
+    # Work out which points are in range:
+    start, stop = 0, len(numbers)
+    if t_range is not None and None not in t_range:
+        t_range = _as_numbers(np.asarray(t_range, dtype=times.dtype))
+        start = np.searchsorted(numbers, t_range[0], side='left')
+        stop = np.searchsorted(numbers, t_range[1], side='right')
+    else:
+        t_range = None
+    if start >= stop:
+        return times[:0], np.empty(0)
+    if t_range is None:
+        t_range = numbers[start], numbers[stop - 1]
+
+    if chunk_size is None:
+        chunk_size = series.chunks[0][0] if series.chunks else 1000000
+
+    # Decimate each chunk, then the combination of them:
+    kept_indices = []
+    kept_values = []
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        values = series[chunk_start:chunk_stop].values.astype(float)
+        keep = m4_indices(numbers[chunk_start:chunk_stop], values, n_bins,
+                          t_range)
+        kept_indices.append(keep + chunk_start)
+        kept_values.append(values[keep])
+    indices = np.concatenate(kept_indices)
+    values = np.concatenate(kept_values)
+
+    keep = m4_indices(numbers[indices], values, n_bins, t_range)
+    return times[indices[keep]], values[keep]
+
+
+def m4_indices(times, values, n_bins, t_range):
+    """
+    Finds the first, last, minimum and maximum point in each bin.
+
+    Args:
+        times: sorted array of times, as numbers.
+        values: array of values, the same length as times.  Points with
+                missing (NaN) values are never kept.
+        n_bins: number of bins to divide the time range into.
+        t_range: (start, end) of the time range.
+
+    Returns:
+        sorted array of the indices of the points to keep.
+    """
+    valid = np.flatnonzero(np.isfinite(values))
+    if valid.size == 0:
+        return valid
+
+    start, end = t_range
+    bins = np.zeros(valid.size, dtype=int)
+    if end > start:
+        bins = ((times[valid] - start) / (end - start) * n_bins).astype(int)
+        bins = np.clip(bins, 0, n_bins - 1)
+
+    # The times are sorted, so each bin's points are together:
+    firsts = np.flatnonzero(np.diff(bins, prepend=-1))
+    lasts = np.append(firsts[1:], bins.size) - 1
+
+    # Sorting by value within each bin puts the minimum first and maximum
+    # last:
+    order = np.lexsort((values[valid], bins))
+    keep = np.concatenate([firsts, lasts, order[firsts], order[lasts]])
+    return np.unique(valid[keep])
+
+
+def _as_numbers(times):
+    """
+    Represents times as numbers, for binning.  As well as numbers, times
+    may be numpy datetimes, or cftime datetimes (as xarray uses for
+    non-standard calendars).
+    """
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[ns]').astype(np.int64)
+    if times.size and isinstance(times.flat[0], cftime.datetime):
+        return cftime.date2num(times, 'seconds since 1970-01-01',
+                               calendar=times.flat[0].calendar)
+    return np.asarray(times, dtype=float)
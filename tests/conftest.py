@@ -0,0 +1,152 @@
+"""
+Fixtures shared between the test modules
+"""
+
+import datetime
+import os
+import weakref
+
+import dask
+import dask.array as da
+import numpy as np
+import iris
+import iris.coord_systems, iris.coords, iris.cube
+import pytest
+
+
+def make_files(directory, ndays=3, nx=10, ny=8):
+    """
+    Write a series of small daily files of hourly data on the OSGB grid,
+    similar in layout to the AQUM sample data.
+
+    Returns:
+        (str): glob matching the files
+    """
+    start = datetime.datetime(2020, 5, 20)
+    cs = iris.coord_systems.OSGB()
+    for day in range(ndays):
+        date = start + datetime.timedelta(days=day)
+        hours = np.arange(1, 25) + 24 * day
+        xcoord = iris.coords.DimCoord(
+            np.arange(nx) * 2000.0,
+            standard_name="projection_x_coordinate",
+            units="m",
+            coord_system=cs,
+        )
+        ycoord = iris.coords.DimCoord(
+            np.arange(ny) * 2000.0,
+            standard_name="projection_y_coordinate",
+            units="m",
+            coord_system=cs,
+        )
+        tcoord = iris.coords.DimCoord(
+            hours.astype(float),
+            standard_name="time",
+            units="hours since 2020-05-20 00:00:00",
+        )
+        data = (
+            hours[:, np.newaxis, np.newaxis]
+            + np.arange(ny)[:, np.newaxis] * 100
+            + np.arange(nx) * 10000
+        ).astype(np.float32)
+        cube = iris.cube.Cube(
+            data,
+            standard_name="mass_concentration_of_ozone_in_air",
+            units="ug m-3",
+            dim_coords_and_dims=[(tcoord, 0), (ycoord, 1), (xcoord, 2)],
+        )
+        filename = f"aqum_hourly_o3_{date:%Y%m%d}.nc"
+        iris.save(cube, os.path.join(directory, filename))
+    return os.path.join(directory, "aqum_hourly_o3_*.nc")
+
+
+def make_cube(nx=20, ny=15, nt=2, spacing=2000.0):
+    """
+    Create a simple (time, y, x) cube on a regular bounded grid.
+    """
+    xcoord = iris.coords.DimCoord(
+        np.arange(nx) * spacing,
+        standard_name="projection_x_coordinate",
+        units="m",
+    )
+    ycoord = iris.coords.DimCoord(
+        np.arange(ny) * spacing,
+        standard_name="projection_y_coordinate",
+        units="m",
+    )
+    tcoord = iris.coords.DimCoord(
+        np.arange(nt, dtype=float),
+        standard_name="time",
+        units="hours since 2020-05-20 00:00:00",
+    )
+    xcoord.guess_bounds()
+    ycoord.guess_bounds()
+    data = np.arange(nt * ny * nx, dtype=float).reshape(nt, ny, nx)
+    return iris.cube.Cube(
+        data,
+        long_name="test_data",
+        dim_coords_and_dims=[(tcoord, 0), (ycoord, 1), (xcoord, 2)],
+    )
+
+
+@pytest.fixture(scope="class")
+def synthetic_files(request, tmp_path_factory):
+    """
+    Write a set of files from `make_files` for a test class to share.
+
+    The class's `ndays` attribute, if any, sets the number of files.  The
+    directory is made available as `self.tmpdir`, and the glob matching the
+    files as `self.files`.
+    """
+    directory = str(tmp_path_factory.mktemp("data"))
+    ndays = getattr(request.cls, "ndays", 3)
+    request.cls.tmpdir = directory
+    request.cls.files = make_files(directory, ndays=ndays)
+
+
+class ChunkTracker:
+    """
+    Array-like wrapper which records which chunks of an array are read
+    through it, and how many of them are held in memory at once.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+        self.reads = []
+        self.live = 0
+        self.max_live = 0
+
+    def __getitem__(self, key):
+        # Copy, so each chunk is a separate array that is freed independently
+        chunk = self.data[key].copy()
+        if chunk.size:
+            self.reads.append(key)
+            self.live += 1
+            self.max_live = max(self.max_live, self.live)
+            weakref.finalize(chunk, self._release)
+        return chunk
+
+    def _release(self):
+        self.live -= 1
+
+
+@pytest.fixture
+def tracked_array():
+    """
+    Make a lazy array which keeps track of how it is read, to check that
+    data is streamed rather than loaded all at once.
+
+    Returns a function taking a numpy array and dask chunks, which returns
+    the dask array and its ChunkTracker.  The synchronous dask scheduler
+    is used, so only one chunk is ever computed at a time.
+    """
+    def track(data, chunks):
+        tracker = ChunkTracker(np.asarray(data))
+        array = da.from_array(tracker, chunks=chunks)
+        return array, tracker
+
+    with dask.config.set(scheduler="synchronous"):
+        yield track
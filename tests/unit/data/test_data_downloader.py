@@ -0,0 +1,297 @@
+"""
+Unit tests for data_downloader.py, using a local HTTP server
+"""
+
+import hashlib
+import http.server
+import os
+import re
+import threading
+import tracemalloc
+import urllib.error
+
+import iris
+import netCDF4
+import numpy as np
+import pytest
+
+from clean_air.data import DataSubset
+from clean_air.data.data_downloader import DataDownloader
+from tests.conftest import make_cube
+
+FILES = {
+    "/small.nc": b"small file contents",
+    "/large.nc": bytes(range(256)) * 1000,
+}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves FILES, supporting ranged requests, with an ETag for each file
+    made from `version` on the server.  Set `drop_after` on the server to
+    close the connection after sending that many bytes of a response.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        try:
+            content = FILES[self.path]
+        except KeyError:
+            self.send_error(404)
+            return
+
+        start = 0
+        etag = f'"{self.path}-{self.server.version}"'
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if self.headers.get("If-Range", etag) != etag:
+            match = None
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{len(content) - 1}/{len(content)}",
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+
+        body = content[start:]
+        if self.server.drop_after is not None:
+            body = body[:self.server.drop_after]
+            self.server.drop_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    server.ranges = True
+    server.drop_after = None
+    server.version = 1
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,),
+                              daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def sha256(content):
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+class TestDownload:
+    def test_download(self, server, tmp_path):
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("large.nc", str(tmp_path))
+        assert path == str(tmp_path / "large.nc")
+        assert read(path) == FILES["/large.nc"]
+        assert not os.path.exists(path + ".part")
+
+    def test_full_url(self, server, tmp_path):
+        path = DataDownloader().download_obs(
+            server.url + "small.nc", str(tmp_path / "out.nc")
+        )
+        assert read(path) == FILES["/small.nc"]
+
+    def test_not_found(self, server, tmp_path):
+        downloader = DataDownloader(base_url=server.url)
+        with pytest.raises(urllib.error.HTTPError):
+            downloader.download_obs("missing.nc", str(tmp_path))
+        assert len(server.requests) == 1
+
+    def test_checksum(self, server, tmp_path):
+        downloader = DataDownloader(base_url=server.url)
+        content = FILES["/small.nc"]
+        path = downloader.download_obs("small.nc", str(tmp_path),
+                                       sha256(content))
+        assert read(path) == content
+
+        path = downloader.download_obs(
+            "small.nc", str(tmp_path / "md5.nc"),
+            "md5:" + hashlib.md5(content).hexdigest(),
+        )
+        assert read(path) == content
+
+    def test_bad_checksum(self, server, tmp_path):
+        downloader = DataDownloader(base_url=server.url)
+        with pytest.raises(ValueError):
+            downloader.download_obs("small.nc", str(tmp_path),
+                                    sha256(b"something else"))
+        assert os.listdir(tmp_path) == []
+
+    def test_many(self, server, tmp_path):
+        downloader = DataDownloader(base_url=server.url, max_workers=2)
+        paths = downloader.download_many([
+            ("small.nc", str(tmp_path / "a.nc")),
+            ("large.nc", str(tmp_path / "b.nc"), sha256(FILES["/large.nc"])),
+            ("small.nc", str(tmp_path / "c.nc")),
+        ])
+        assert [read(path) for path in paths] == [
+            FILES["/small.nc"], FILES["/large.nc"], FILES["/small.nc"],
+        ]
+
+
+class TestResume:
+    def test_dropped_connection(self, server, tmp_path):
+        # The first response is cut short, so the download should resume
+        # from where it stopped
+        server.drop_after = 1000
+        downloader = DataDownloader(base_url=server.url, chunk_size=100)
+        content = FILES["/large.nc"]
+        path = downloader.download_gridded("large.nc", str(tmp_path),
+                                           sha256(content))
+        assert read(path) == content
+        assert server.requests == [("/large.nc", None),
+                                   ("/large.nc", "bytes=1000-")]
+
+    def write_part(self, path, content, etag):
+        # As left behind by an earlier run
+        with open(str(path) + ".part", "wb") as f:
+            f.write(content)
+        with open(str(path) + ".part.validator", "w") as f:
+            f.write(etag)
+
+    def test_partial_file(self, server, tmp_path):
+        content = FILES["/large.nc"]
+        self.write_part(tmp_path / "large.nc", content[:5000],
+                        '"/large.nc-1"')
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("large.nc", str(tmp_path))
+        assert read(path) == content
+        assert server.requests == [("/large.nc", "bytes=5000-")]
+        assert os.listdir(tmp_path) == ["large.nc"]
+
+    def test_complete_partial_file(self, server, tmp_path):
+        content = FILES["/small.nc"]
+        self.write_part(tmp_path / "small.nc", content, '"/small.nc-1"')
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("small.nc", str(tmp_path))
+        assert read(path) == content
+        assert len(server.requests) == 1
+
+    def test_oversized_partial_file(self, server, tmp_path):
+        # Longer than the file on the server, so cannot be part of it
+        content = FILES["/small.nc"]
+        self.write_part(tmp_path / "small.nc", content + b"extra",
+                        '"/small.nc-1"')
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("small.nc", str(tmp_path))
+        assert read(path) == content
+        assert server.requests == [("/small.nc", f"bytes={len(content) + 5}-"),
+                                   ("/small.nc", None)]
+
+    def test_changed_file(self, server, tmp_path):
+        # The file has been replaced on the server since the partial one
+        # was downloaded, so should be fetched from the start
+        server.version = 2
+        content = FILES["/large.nc"]
+        self.write_part(tmp_path / "large.nc", b"x" * 5000, '"/large.nc-1"')
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("large.nc", str(tmp_path))
+        assert read(path) == content
+
+    def test_unknown_partial_file(self, server, tmp_path):
+        # Without a validator, there is no telling where the partial file
+        # came from
+        content = FILES["/large.nc"]
+        with open(tmp_path / "large.nc.part", "wb") as f:
+            f.write(b"x" * 5000)
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("large.nc", str(tmp_path))
+        assert read(path) == content
+        assert server.requests == [("/large.nc", None)]
+
+    def test_no_range_support(self, server, tmp_path):
+        # Server sends the whole file again, which should replace the
+        # partial one rather than be appended to it
+        server.ranges = False
+        content = FILES["/large.nc"]
+        self.write_part(tmp_path / "large.nc", content[:5000],
+                        '"/large.nc-1"')
+
+        downloader = DataDownloader(base_url=server.url)
+        path = downloader.download_gridded("large.nc", str(tmp_path))
+        assert read(path) == content
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestSubset:
+    def subset(self):
+        return DataSubset(
+            None, "aqum", self.files, box=(3000, 5000, 9000, 9000)
+        )
+
+    def test_save(self, tmp_path):
+        subset = self.subset()
+        path = DataDownloader().download_gridded(subset, str(tmp_path))
+        assert path == str(tmp_path / "aqum.nc")
+        assert os.listdir(tmp_path) == ["aqum.nc"]
+
+        cube = iris.load_cube(path)
+        expected = subset.as_cube()
+        assert cube.shape == expected.shape
+        assert np.array_equal(cube.data, expected.data)
+
+    def test_streamed(self, tmp_path, tracked_array):
+        # The subset's data should never be loaded all at once, but read
+        # and written a chunk of time steps at a time.  It has to be big
+        # enough to stand out from everything else in memory.
+        expected = make_cube(nx=200, ny=200, nt=24)
+        data, tracker = tracked_array(expected.data, chunks=(1, 200, 200))
+        subset = self.subset()
+        subset._cube = expected.copy(data=data)
+
+        tracemalloc.start()
+        try:
+            path = DataDownloader().download_gridded(
+                subset, str(tmp_path / "out.nc"), time_chunk=2
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert len(tracker.reads) == 24
+        assert peak < expected.data.nbytes / 4
+        assert np.array_equal(iris.load_cube(path).data, expected.data)
+
+    def test_chunking(self, tmp_path):
+        path = str(tmp_path / "out.nc")
+        DataDownloader().download_gridded(self.subset(), path, time_chunk=6,
+                                          complevel=2)
+        with netCDF4.Dataset(path) as dataset:
+            variable = dataset.variables["mass_concentration_of_ozone_in_air"]
+            assert variable.chunking() == [6, 2, 3]
+            assert variable.filters()["complevel"] == 2
+
+    def test_chunksizes(self, tmp_path):
+        path = str(tmp_path / "out.nc")
+        DataDownloader().download_gridded(self.subset(), path,
+                                          chunksizes=(24, 1, 1))
+        with netCDF4.Dataset(path) as dataset:
+            variable = dataset.variables["mass_concentration_of_ozone_in_air"]
+            assert variable.chunking() == [24, 1, 1]
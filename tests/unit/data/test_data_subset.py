@@ -1,10 +1,15 @@
+import datetime
+import glob
 import os
 
 import numpy as np
+import pytest
 import iris
+import iris.cube
 import shapely, shapely.geometry
+import cartopy.crs as ccrs
 
-from clean_air.data import DataSubset
+from clean_air.data import DataSubset, data_subset
 from clean_air import util
 
 SAMPLEDIR = os.path.expanduser("~cbosley/Projects/toybox/cap_sample_data")
@@ -87,3 +92,293 @@ class TestPolygonSubset:
         # Simple data check, which, as the mask is taken into account, should
         # be a pretty reliable test
         assert round(self.cube.data.mean(), 8) == 57.66388811
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestSyntheticShapeSubset:
+    def setup_class(self):
+        # Covers 3/4 of cells (2, 1) and (2, 2), and smaller parts of the
+        # cells either side
+        self.shape = shapely.geometry.box(1500, 1500, 6000, 4500)
+
+    def test_subset_mask(self):
+        ds = DataSubset(None, "aqum", self.files, shape=self.shape)
+        cube = ds.as_cube()
+        assert cube.shape == (72, 2, 3)
+        assert not cube.data.mask.any()
+
+    def test_subset_lazy(self):
+        ds = DataSubset(None, "aqum", self.files, shape=self.shape)
+        assert ds.as_cube().has_lazy_data()
+
+    def test_area_mean(self):
+        ds = DataSubset(None, "aqum", self.files, shape=self.shape)
+        mean = ds.area_mean()
+        assert mean.shape == (72,)
+        expected = np.average(
+            ds.as_cube().data, axis=(1, 2), weights=[[[0.75, 1, 0.5]] * 2] * 72
+        )
+        assert np.allclose(mean.data, expected)
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestSyntheticBoxSubset:
+    def test_box_subset(self):
+        ds = DataSubset(
+            None, "aqum", self.files, box=(3000, 5000, 9000, 9000)
+        )
+        cube = ds.as_cube()
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [4000, 6000, 8000])
+        assert iris.util.array_equal(ycoord.points, [6000, 8000])
+        assert cube.shape == (72, 2, 3)
+        assert cube.has_lazy_data()
+
+    def test_extract_before_combining(self, monkeypatch):
+        # Each file should be cut down before the cubes are combined
+        combined = []
+        concatenate_cube = iris.cube.CubeList.concatenate_cube
+
+        def check(cubes):
+            combined.extend(cubes)
+            return concatenate_cube(cubes)
+
+        monkeypatch.setattr(iris.cube.CubeList, "concatenate_cube", check)
+        ds = DataSubset(
+            None, "aqum", self.files, box=(3000, 5000, 9000, 9000)
+        )
+        ds.as_cube()
+        assert len(combined) == 3
+        for cube in combined:
+            assert cube.shape == (24, 2, 3)
+
+    def test_time_range(self):
+        ds = DataSubset(
+            None,
+            "aqum",
+            self.files,
+            parameter="mass_concentration_of_ozone_in_air",
+            start_time=datetime.datetime(2020, 5, 20, 22),
+            end_time=datetime.datetime(2020, 5, 21, 3),
+            box=(3000, 5000, 9000, 9000),
+        )
+        cube = ds.as_cube()
+        times = cube.coord("time").units.num2date(cube.coord("time").points)
+        assert [t.hour for t in times] == [22, 23, 0, 1, 2]
+        assert cube.shape == (5, 2, 3)
+
+    def test_skip_files_by_name(self):
+        ds = DataSubset(
+            None,
+            "aqum",
+            self.files,
+            start_time=datetime.datetime(2020, 5, 21),
+            end_time=datetime.datetime(2020, 5, 21, 12),
+            daily_files=True,
+        )
+        files = [os.path.basename(path) for path in ds._find_files()]
+        # Note the first file contains data for midnight at the end of the
+        # day, so cannot be ruled out based on its name alone
+        assert files == [
+            "aqum_hourly_o3_20200520.nc",
+            "aqum_hourly_o3_20200521.nc",
+        ]
+
+    def test_keep_files_by_default(self):
+        # Without daily_files, a date stamp says nothing about the contents
+        # of a file, which could hold a month of data
+        ds = DataSubset(
+            None,
+            "aqum",
+            self.files,
+            start_time=datetime.datetime(2020, 5, 22),
+            end_time=datetime.datetime(2020, 5, 22, 12),
+        )
+        assert len(ds._find_files()) == 3
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestSyntheticMultiPointSubset:
+    def setup_class(self):
+        self.points = [(3100, 4500), (0, 0), (12345, 6789), (15000, 1000)]
+
+    def test_matches_point_subsets(self):
+        ds = DataSubset(None, "aqum", self.files, points=self.points)
+        cube = ds.as_cube()
+        assert cube.shape == (72, 4)
+        assert iris.util.array_equal(
+            cube.coord("station").points, [0, 1, 2, 3]
+        )
+        for i, point in enumerate(self.points):
+            expected = DataSubset(None, "aqum", self.files, point=point)
+            expected = expected.as_cube().data.squeeze()
+            assert np.allclose(cube.data[:, i], expected)
+
+    def test_crs(self):
+        # Convert the points to lat-lon, and make sure they come back the same
+        osgb = DataSubset(None, "aqum", self.files).as_cube().coord_system()
+        osgb = osgb.as_cartopy_crs()
+        latlon = ccrs.Geodetic()
+        points = np.array(self.points, dtype=float)
+        points = latlon.transform_points(osgb, points[:, 0], points[:, 1])
+        ds = DataSubset(
+            None, "aqum", self.files, points=points[:, :2], crs=latlon
+        )
+        cube = ds.as_cube()
+        xs = cube.coord("projection_x_coordinate").points
+        ys = cube.coord("projection_y_coordinate").points
+        assert np.allclose(xs, [p[0] for p in self.points], atol=1e-3)
+        assert np.allclose(ys, [p[1] for p in self.points], atol=1e-3)
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestSyntheticTrackSubset:
+    def setup_class(self):
+        # A straight line across the grid, crossing midnight
+        n = 50
+        start = datetime.datetime(2020, 5, 20, 22)
+        self.xs = np.linspace(1000, 15000, n)
+        self.ys = np.linspace(13000, 500, n)
+        self.times = [start + datetime.timedelta(minutes=3 * i)
+                      for i in range(n)]
+        self.track = list(zip(self.xs, self.ys, self.times))
+
+    def test_track(self):
+        ds = DataSubset(None, "aqum", self.files, track=self.track)
+        cube = ds.as_cube()
+        assert cube.shape == (50,)
+
+        full = DataSubset(None, "aqum", self.files).as_cube()
+        tcoord = full.coord("time")
+        for i in [0, 13, 20, 21, 49]:
+            expected = full.interpolate(
+                [("projection_x_coordinate", [self.xs[i]]),
+                 ("projection_y_coordinate", [self.ys[i]]),
+                 ("time", tcoord.units.date2num([self.times[i]]))],
+                iris.analysis.Linear(),
+            )
+            assert np.isclose(cube.data[i], expected.data.squeeze())
+
+    def test_lazy(self):
+        ds = DataSubset(None, "aqum", self.files, track=self.track)
+        assert ds.as_cube().has_lazy_data()
+
+    def loaded_times(self, monkeypatch, track):
+        loaded = []
+        interpolate_points = util.cubes.interpolate_points
+
+        def record(cube, samples):
+            loaded.extend(cube.coord("time").points)
+            return interpolate_points(cube, samples)
+
+        monkeypatch.setattr(util.cubes, "interpolate_points", record)
+        DataSubset(None, "aqum", self.files, track=track).as_cube()
+        return loaded
+
+    def test_narrowed(self, monkeypatch):
+        # Only the times around the track should be loaded, including the
+        # first hour of the next file
+        loaded = self.loaded_times(monkeypatch, self.track)
+        assert loaded == [21, 22, 23, 24, 25]
+
+    def test_short(self, monkeypatch):
+        # A track between two time steps should load just those two
+        start = datetime.datetime(2020, 5, 21, 10, 15)
+        track = [(5000, 5000, start),
+                 (6000, 5000, start + datetime.timedelta(minutes=30))]
+        assert self.loaded_times(monkeypatch, track) == [34, 35]
+
+    def test_empty(self):
+        with pytest.raises(ValueError):
+            DataSubset(None, "aqum", self.files, track=[])
+
+    def test_datetime64(self):
+        times = np.array(self.times, dtype="datetime64[s]")
+        track = np.empty((len(times), 3), dtype=object)
+        track[:, 0] = self.xs
+        track[:, 1] = self.ys
+        track[:, 2] = times
+        ds = DataSubset(None, "aqum", self.files, track=track)
+        expected = DataSubset(None, "aqum", self.files, track=self.track)
+        assert np.allclose(ds.as_cube().data, expected.as_cube().data)
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestResultCache:
+    def setup_class(self):
+        self.shape = shapely.geometry.box(1500, 1500, 6000, 4500)
+
+    def setup_method(self):
+        self.memory = util.cache.MemoryCache()
+        self.disk = util.cache.CubeCache(
+            os.path.join(self.tmpdir, "results")
+        )
+
+    def teardown_method(self):
+        self.disk.flush()
+        self.disk.clear()
+
+    def use_cache(self, monkeypatch, *tiers):
+        monkeypatch.setattr(
+            data_subset, "result_cache", util.cache.TieredCache(*tiers)
+        )
+
+    def box_subset(self, box=(3000, 5000, 9000, 9000)):
+        return DataSubset(None, "aqum", self.files, box=box)
+
+    def test_shared(self, monkeypatch):
+        self.use_cache(monkeypatch, self.memory, self.disk)
+        cube = self.box_subset().as_cube()
+        assert self.box_subset().as_cube() is cube
+        assert self.memory.hits == 1
+
+    def test_different_spec(self, monkeypatch):
+        self.use_cache(monkeypatch, self.memory)
+        cube = self.box_subset().as_cube()
+        other = self.box_subset((3000, 5000, 9000, 11000)).as_cube()
+        assert other is not cube
+        assert other.shape == (72, 3, 3)
+
+    def test_disk(self, monkeypatch):
+        # As if from another process
+        self.use_cache(monkeypatch, self.disk)
+        expected = self.box_subset().as_cube()
+        assert expected.has_lazy_data()
+        self.disk.flush()
+        self.use_cache(monkeypatch, util.cache.CubeCache(self.disk.directory))
+        cube = self.box_subset().as_cube()
+        assert cube is not expected
+        assert np.array_equal(cube.data, expected.data)
+
+    def test_find_files_once(self, monkeypatch):
+        self.use_cache(monkeypatch, self.memory)
+        calls = []
+        find_files = DataSubset._find_files
+
+        def record(subset):
+            calls.append(subset)
+            return find_files(subset)
+
+        monkeypatch.setattr(DataSubset, "_find_files", record)
+        self.box_subset().as_cube()
+        assert len(calls) == 1
+
+    def test_modified_file(self, monkeypatch):
+        self.use_cache(monkeypatch, self.memory)
+        cube = self.box_subset().as_cube()
+
+        path = sorted(glob.glob(self.files))[0]
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+        assert self.box_subset().as_cube() is not cube
+
+    def test_shape_area_mean(self, monkeypatch):
+        self.use_cache(monkeypatch, self.disk)
+        expected = DataSubset(
+            None, "aqum", self.files, shape=self.shape
+        ).area_mean()
+        self.disk.flush()
+        mean = DataSubset(None, "aqum", self.files, shape=self.shape
+                          ).area_mean()
+        assert self.disk.hits == 1
+        assert np.allclose(mean.data, expected.data)
@@ -0,0 +1,95 @@
+"""
+Unit tests for data_visualiser.py
+"""
+
+import datetime
+import threading
+
+import holoviews as hv
+import pytest
+import shapely.geometry
+
+from clean_air.data import DataSubset
+from clean_air.data.data_visualiser import DataVisualiser
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestRenderGridded:
+    ndays = 1
+
+    def subset(self, **kw):
+        return DataSubset(None, "aqum", self.files, **kw)
+
+    def test_box(self, tracked_array):
+        subset = self.subset(box=(3000, 5000, 9000, 9000))
+        cube = subset.as_cube()
+        cube.data, tracker = tracked_array(cube.data, chunks=(1, 2, 2))
+        plot, = DataVisualiser(subset).render_gridded()
+        assert isinstance(plot, hv.DynamicMap)
+
+        # Nothing is read until the map is drawn, and then only the time
+        # step drawn
+        assert tracker.reads == []
+        image = plot[3]
+        assert isinstance(image, hv.Image)
+        assert tracker.reads
+        assert all(key[0] in (3, slice(3, 4)) for key in tracker.reads)
+
+    def test_shape(self):
+        subset = self.subset(shape=shapely.geometry.box(1500, 1500, 6000,
+                                                        4500))
+        plot, = DataVisualiser(subset).render_gridded()
+        assert plot is not None
+
+    def test_point(self):
+        plot, = DataVisualiser(
+            self.subset(point=(5000, 5000))).render_gridded()
+        assert isinstance(plot, hv.DynamicMap)
+
+    def test_points(self):
+        plot, = DataVisualiser(
+            self.subset(points=[(5000, 5000), (7000, 3000)])
+        ).render_gridded()
+        assert isinstance(plot, hv.Overlay)
+        assert len(plot) == 2
+
+    def test_track(self):
+        start = datetime.datetime(2020, 5, 20, 2)
+        track = [(1000 * i, 500 * i, start + datetime.timedelta(minutes=i))
+                 for i in range(10)]
+        plot, = DataVisualiser(self.subset(track=track)).render_gridded()
+        assert isinstance(plot, hv.Points)
+        assert len(plot) == 10
+
+    def test_track_not_1d(self):
+        # Such as a track through data with an extra dimension
+        start = datetime.datetime(2020, 5, 20, 2)
+        subset = self.subset(track=[(1000, 500, start)])
+        subset._cube = self.subset(box=(3000, 5000, 9000, 9000)).as_cube()
+        with pytest.raises(ValueError, match="3-dimensional"):
+            DataVisualiser(subset).render_gridded()
+
+    def test_subsetter(self):
+        box = self.subset(box=(3000, 5000, 9000, 9000))
+        point = self.subset(point=(5000, 5000))
+        plots = DataVisualiser(box, point).render_gridded(subsetter=point)
+        assert len(plots) == 1
+        assert box._cube is None
+
+    def test_concurrent(self, monkeypatch):
+        # Each first load waits for the other to start, so this can only
+        # finish if they run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+        subsets = [self.subset(box=(3000, 5000, 9000, 9000)),
+                   self.subset(box=(1000, 1000, 5000, 5000))]
+        for subset in subsets:
+            as_cube = subset.as_cube
+
+            def wait_then_load(subset=subset, as_cube=as_cube):
+                if subset._cube is None:
+                    barrier.wait()
+                return as_cube()
+            monkeypatch.setattr(subset, "as_cube", wait_then_load)
+
+        plots = DataVisualiser(*subsets).render_gridded()
+        assert len(plots) == 2
@@ -0,0 +1,128 @@
+"""
+Unit tests for the data.file_index module
+"""
+
+import datetime
+import glob
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from clean_air import data
+from clean_air.data import DataSubset, FileIndex
+
+
+@pytest.mark.usefixtures("synthetic_files")
+class TestFileIndex:
+    def setup_method(self):
+        self.paths = sorted(glob.glob(self.files))
+        self.index = FileIndex(os.path.join(self.tmpdir, "index.db"))
+        self.index.update(self.paths)
+
+    def indexed(self):
+        with sqlite3.connect(self.index.path) as conn:
+            return sorted(
+                path for path, in conn.execute("SELECT path FROM files")
+            )
+
+    def test_select_all(self):
+        assert self.index.select(self.paths) == self.paths
+
+    def test_select_parameter(self):
+        selected = self.index.select(
+            self.paths, parameter="mass_concentration_of_ozone_in_air"
+        )
+        assert selected == self.paths
+        assert self.index.select(self.paths, parameter="no2") == []
+
+    def test_select_times(self):
+        selected = self.index.select(
+            self.paths,
+            start_time=datetime.datetime(2020, 5, 21, 6),
+            end_time=datetime.datetime(2020, 5, 21, 12),
+        )
+        assert selected == self.paths[1:2]
+
+    def test_select_boundaries(self):
+        # The first file ends at midnight, which is included in the start
+        # time, whereas the end time is exclusive
+        selected = self.index.select(
+            self.paths,
+            start_time=datetime.datetime(2020, 5, 21),
+            end_time=datetime.datetime(2020, 5, 21, 1),
+        )
+        assert selected == self.paths[:1]
+
+    def test_incremental_update(self, monkeypatch):
+        scanned = []
+        scan = data.file_index._scan
+
+        def record(path):
+            scanned.append(path)
+            return scan(path)
+
+        monkeypatch.setattr(data.file_index, "_scan", record)
+        self.index.update(self.paths)
+        assert scanned == []
+
+        os.utime(self.paths[0], (0, 0))
+        self.index.update(self.paths)
+        assert scanned == self.paths[:1]
+
+    def test_prune(self):
+        extra = os.path.join(self.tmpdir, "extra.nc")
+        shutil.copy(self.paths[0], extra)
+        self.index.update([extra])
+        assert self.index.select([extra]) == [extra]
+
+        # Updating other files leaves it alone, until pruned
+        os.remove(extra)
+        self.index.update(self.paths)
+        assert extra in self.indexed()
+        self.index.prune()
+        assert extra not in self.indexed()
+        assert self.indexed() == self.paths
+
+    def test_relative(self, monkeypatch):
+        monkeypatch.chdir(self.tmpdir)
+        relative = [os.path.basename(path) for path in self.paths]
+        self.index.update(relative)
+        assert self.indexed() == self.paths
+        assert self.index.select(relative) == relative
+
+        # Running from elsewhere must not lose the entries
+        monkeypatch.chdir(os.path.dirname(self.tmpdir))
+        self.index.update([])
+        self.index.prune()
+        assert self.indexed() == self.paths
+
+    def test_not_locked_while_scanning(self, monkeypatch):
+        # Another process must be able to write while files are being read
+        scan = data.file_index._scan
+
+        def write_then_scan(path):
+            conn = sqlite3.connect(self.index.path, timeout=0)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+            finally:
+                conn.close()
+            return scan(path)
+
+        monkeypatch.setattr(data.file_index, "_scan", write_then_scan)
+        for path in self.paths:
+            os.utime(path, (0, 0))
+        self.index.update(self.paths)
+
+    def test_data_subset(self, monkeypatch):
+        monkeypatch.setattr(data.data_subset, "file_index", self.index)
+        ds = DataSubset(
+            None,
+            "aqum",
+            self.files,
+            start_time=datetime.datetime(2020, 5, 21, 6),
+            end_time=datetime.datetime(2020, 5, 21, 12),
+        )
+        assert ds._find_files() == self.paths[1:2]
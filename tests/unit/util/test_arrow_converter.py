@@ -0,0 +1,100 @@
+"""
+Unit tests for arrow_converter.py
+"""
+
+import geopandas as geopd
+import iris.coord_systems
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from clean_air.util import arrow_converter as ac
+from clean_air.util import dataframe_converter as dc
+from tests.conftest import make_cube
+
+
+def make_osgb_cube(**kw):
+    cube = make_cube(**kw)
+    osgb = iris.coord_systems.OSGB()
+    cube.coord("projection_x_coordinate").coord_system = osgb
+    cube.coord("projection_y_coordinate").coord_system = osgb
+    return cube
+
+
+class TestAsTable:
+    def setup_class(self):
+        self.cube = make_osgb_cube(nx=4, ny=3, nt=3)
+
+    def test_columns(self):
+        table = ac.as_table(self.cube)
+        assert table.column_names == [
+            "time", "projection_x_coordinate", "projection_y_coordinate",
+            "test_data", "geometry",
+        ]
+        assert table.num_rows == 36
+
+    def test_matches_geodf(self):
+        table = ac.as_table(self.cube)
+        gdf = dc.convert_to_geodf(self.cube, restitch=True)
+        assert np.all(table["test_data"].to_numpy() == gdf.data.values)
+        assert np.all(
+            table["projection_x_coordinate"].to_numpy() == gdf.x_coord.values)
+        geometry = shapely.from_wkb(table["geometry"].to_numpy(
+            zero_copy_only=False))
+        assert np.all(shapely.equals(geometry, gdf.geometry.values))
+
+    def test_masked(self):
+        cube = self.cube.copy()
+        cube.data = np.ma.masked_less(cube.data, 5)
+        table = ac.as_table(cube)
+        assert table["test_data"].null_count == 5
+
+    def test_lazy(self, tracked_array):
+        data, tracker = tracked_array(self.cube.data, chunks=(1, 3, 4))
+        cube = self.cube.copy(data=data)
+        batches = ac.iter_record_batches(cube)
+        next(batches)
+        assert len(tracker.reads) == 1
+
+        table = pa.Table.from_batches([next(batches), *batches])
+        assert len(tracker.reads) == 3
+        assert cube.has_lazy_data()
+        assert table.equals(ac.as_table(self.cube).slice(12))
+
+
+class TestWriteParquet:
+    def setup_class(self):
+        self.cube = make_osgb_cube(nx=4, ny=3, nt=5)
+
+    def test_row_groups(self, tmp_path):
+        path = tmp_path / "out.parquet"
+        ac.write_parquet(self.cube, path, chunk_size=2)
+        parquet = pq.ParquetFile(path)
+        assert parquet.num_row_groups == 3
+        assert parquet.read().equals(ac.as_table(self.cube))
+
+    def test_streamed(self, tmp_path, tracked_array):
+        data, tracker = tracked_array(self.cube.data, chunks=(1, 3, 4))
+        path = tmp_path / "out.parquet"
+        ac.write_parquet(self.cube.copy(data=data), path)
+        assert len(tracker.reads) == 5
+        assert tracker.max_live == 1
+        assert pq.read_table(path).equals(ac.as_table(self.cube))
+
+    def test_geoparquet(self, tmp_path):
+        path = tmp_path / "out.parquet"
+        ac.write_parquet(self.cube, path)
+        gdf = geopd.read_parquet(path)
+        assert gdf.crs.to_epsg() == 27700
+        assert np.all(gdf.geometry.x == gdf.projection_x_coordinate)
+        assert np.all(gdf.geometry.y == gdf.projection_y_coordinate)
+
+    def test_subset(self, tmp_path):
+        class Subset:
+            def as_cube(subset):
+                return self.cube
+
+        path = tmp_path / "out.parquet"
+        ac.write_parquet(Subset(), path)
+        assert pq.read_table(path).num_rows == 60
@@ -0,0 +1,248 @@
+"""
+Unit tests for the util.cache submodule
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import dask.array as da
+import iris.cube
+import numpy as np
+
+from clean_air import util
+
+
+class TestMemoryCache:
+    def test_roundtrip(self):
+        cache = util.cache.MemoryCache()
+        assert cache.get("key") is None
+        cache.put("key", "value")
+        assert cache.get("key") == "value"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_lru_eviction(self):
+        cache = util.cache.MemoryCache(max_items=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    def test_threads(self):
+        cache = util.cache.MemoryCache(max_items=10)
+
+        def work(i):
+            for j in range(200):
+                key = (i + j) % 20
+                if cache.get(key) is None:
+                    cache.put(key, key)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(work, range(8)))
+        assert len(cache) == 10
+        assert cache.hits + cache.misses == 8 * 200
+
+    def test_ttl(self, monkeypatch):
+        now = time.time()
+        cache = util.cache.MemoryCache(ttl=10)
+        cache.put("key", "value")
+        monkeypatch.setattr(time, "time", lambda: now + 5)
+        assert cache.get("key") == "value"
+        monkeypatch.setattr(time, "time", lambda: now + 15)
+        assert cache.get("key") is None
+        assert len(cache) == 0
+
+    def test_len_ttl(self, monkeypatch):
+        # Expired values should not be counted, even if never looked up
+        now = time.time()
+        cache = util.cache.MemoryCache(ttl=10)
+        cache.put("a", 1)
+        monkeypatch.setattr(time, "time", lambda: now + 5)
+        cache.put("b", 2)
+        assert len(cache) == 2
+        monkeypatch.setattr(time, "time", lambda: now + 12)
+        assert len(cache) == 1
+        assert cache.get("b") == 2
+
+    def test_clear(self):
+        cache = util.cache.MemoryCache()
+        cache.put("key", "value")
+        cache.get("key")
+        cache.clear()
+        assert len(cache) == 0
+        assert (cache.hits, cache.misses) == (0, 0)
+
+
+class TestDiskCache:
+    def test_miss(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path))
+        assert cache.get("missing") is None
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    def test_roundtrip(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path))
+        cache.put("key", {"a": np.arange(5), "b": np.eye(3)})
+        value = cache.get("key")
+        assert np.array_equal(value["a"], np.arange(5))
+        assert np.array_equal(value["b"], np.eye(3))
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    def test_shared_directory(self, tmp_path):
+        util.cache.DiskCache(str(tmp_path)).put("key", {"a": np.ones(3)})
+        value = util.cache.DiskCache(str(tmp_path)).get("key")
+        assert np.array_equal(value["a"], np.ones(3))
+
+    def test_lru_eviction(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path))
+        for i, key in enumerate(["a", "b", "c"]):
+            cache.put(key, {"x": np.random.rand(1000)})
+            # Make sure the modification times are distinguishable
+            os.utime(cache.path(key), (i, i))
+
+        # Use "a", so that "b" becomes the least recently used
+        cache.get("a")
+        cache.max_size = cache.size() - 1
+        cache.put("d", {"x": np.zeros(1)})
+
+        assert cache.get("b") is None
+        for key in ["a", "c", "d"]:
+            assert cache.get(key) is not None
+        assert cache.size() <= cache.max_size
+
+    def test_clear(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path))
+        cache.put("key", {"a": np.ones(3)})
+        cache.get("key")
+        cache.clear()
+        assert cache.size() == 0
+        assert (cache.hits, cache.misses) == (0, 0)
+
+    def test_ttl(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path), ttl=10)
+        cache.put("old", {"a": np.ones(3)})
+        cache.put("new", {"a": np.ones(3)})
+        old = time.time() - 20
+        os.utime(cache.path("old"), (old, old))
+
+        assert cache.get("old") is None
+        assert not os.path.exists(cache.path("old"))
+        assert cache.get("new") is not None
+
+    def test_ttl_from_stored(self, tmp_path):
+        # Using a value should not extend its lifetime
+        cache = util.cache.DiskCache(str(tmp_path), ttl=10)
+        cache.put("key", {"a": np.ones(3)})
+        old = time.time() - 8
+        os.utime(cache.path("key"), (old, old))
+        assert cache.get("key") is not None
+        assert os.stat(cache.path("key")).st_mtime == old
+
+    def test_evict_expired(self, tmp_path):
+        cache = util.cache.DiskCache(str(tmp_path), ttl=10)
+        cache.put("old", {"a": np.ones(3)})
+        old = time.time() - 20
+        os.utime(cache.path("old"), (old, old))
+        cache.put("new", {"a": np.ones(3)})
+        assert not os.path.exists(cache.path("old"))
+
+
+class TestCubeCache:
+    def test_roundtrip(self, tmp_path):
+        cache = util.cache.CubeCache(str(tmp_path))
+        # Big enough for iris to load it lazily
+        cube = iris.cube.Cube(np.arange(2500.0).reshape(50, 50),
+                              long_name="test_data", units="K")
+        cache.put("key", cube)
+        assert os.path.exists(tmp_path / "key.nc")
+
+        value = cache.get("key")
+        assert value.name() == "test_data"
+
+        # Evicting the file must not affect the cube read from it
+        cache.clear()
+        assert not value.has_lazy_data()
+        assert np.array_equal(value.data, cube.data)
+
+    def test_background(self, tmp_path, monkeypatch):
+        # Lazy cubes should be written without holding up put
+        cache = util.cache.CubeCache(str(tmp_path))
+        cube = iris.cube.Cube(da.arange(6.0).reshape(2, 3),
+                              long_name="test_data")
+        release = threading.Event()
+        write = util.cache.CubeCache._write
+
+        def wait_then_write(self, path, value):
+            release.wait(10)
+            write(self, path, value)
+
+        monkeypatch.setattr(util.cache.CubeCache, "_write", wait_then_write)
+        cache.put("key", cube)
+        assert cache.get("key") is None
+        assert cube.has_lazy_data()
+        release.set()
+        cache.flush()
+        assert np.array_equal(cache.get("key").data,
+                              np.arange(6.0).reshape(2, 3))
+        assert os.listdir(tmp_path) == ["key.nc"]
+
+    def test_read_once(self, tmp_path, tracked_array):
+        # The data computed for the cache is shared with the cube
+        cache = util.cache.CubeCache(str(tmp_path))
+        data, tracker = tracked_array(np.arange(24.0).reshape(4, 6), (2, 3))
+        cube = iris.cube.Cube(data)
+        cache.put("key", cube)
+        cache.flush()
+        assert cube.has_lazy_data()
+        assert np.array_equal(cube.data, np.arange(24.0).reshape(4, 6))
+        assert np.array_equal(cache.get("key").data, cube.data)
+        assert len(tracker.reads) == 4
+
+    def test_foreground(self, tmp_path, tracked_array):
+        cache = util.cache.CubeCache(str(tmp_path), background=False)
+        data, tracker = tracked_array(np.arange(6.0).reshape(2, 3), (1, 3))
+        cube = iris.cube.Cube(data)
+        cache.put("key", cube)
+        assert cache.get("key") is not None
+        assert not cube.has_lazy_data()
+        assert len(tracker.reads) == 2
+
+
+class TestTieredCache:
+    def test_promote(self, tmp_path):
+        memory = util.cache.MemoryCache()
+        disk = util.cache.DiskCache(str(tmp_path))
+        cache = util.cache.TieredCache(memory, disk)
+
+        disk.put("key", {"a": np.ones(3)})
+        assert memory.get("key") is None
+        assert np.array_equal(cache.get("key")["a"], np.ones(3))
+        assert memory.get("key") is not None
+
+    def test_put(self, tmp_path):
+        memory = util.cache.MemoryCache()
+        disk = util.cache.DiskCache(str(tmp_path))
+        cache = util.cache.TieredCache(memory, disk)
+        cache.put("key", {"a": np.ones(3)})
+        assert memory.get("key") is not None
+        assert disk.get("key") is not None
+        assert cache.get("missing") is None
+
+    def test_evicted(self, tmp_path):
+        # Cubes promoted from disk should outlive their files
+        memory = util.cache.MemoryCache()
+        disk = util.cache.CubeCache(str(tmp_path), ttl=10)
+        cache = util.cache.TieredCache(memory, disk)
+        disk.put("key", iris.cube.Cube(np.arange(2500.0).reshape(50, 50)))
+        cache.get("key")
+
+        old = time.time() - 20
+        os.utime(disk.path("key"), (old, old))
+        disk.put("other", iris.cube.Cube(np.zeros(3)))
+        assert not os.path.exists(disk.path("key"))
+        assert np.array_equal(memory.get("key").data,
+                              np.arange(2500.0).reshape(50, 50))
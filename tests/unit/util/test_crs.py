@@ -77,26 +77,113 @@ class TestTransform():
         latlon = ccrs.Geodetic()
         osgb = ccrs.OSGB(approx=False)
         transformed = util.crs.transform_shape(self.latlon_point, latlon, osgb)
-        transformed = np.array(transformed).round(-1)
-        assert np.all(transformed == np.array(self.osgb_point))
+        transformed = np.array(transformed.coords).round(-1)
+        assert np.all(transformed == np.array(self.osgb_point.coords))
 
     def test_pyproj(self):
         latlon = pyproj.CRS.from_epsg(4326)
         osgb = pyproj.CRS.from_epsg(27700)
         transformed = util.crs.transform_shape(self.latlon_point, latlon, osgb)
-        transformed = np.array(transformed).round(-1)
-        assert np.all(transformed == np.array(self.osgb_point))
+        transformed = np.array(transformed.coords).round(-1)
+        assert np.all(transformed == np.array(self.osgb_point.coords))
 
     def test_cartopy_to_pyproj(self):
         latlon = ccrs.Geodetic()
         osgb = pyproj.CRS.from_epsg(27700)
         transformed = util.crs.transform_shape(self.latlon_point, latlon, osgb)
-        transformed = np.array(transformed).round(-1)
-        assert np.all(transformed == np.array(self.osgb_point))
+        transformed = np.array(transformed.coords).round(-1)
+        assert np.all(transformed == np.array(self.osgb_point.coords))
 
     def test_pyproj_to_cartopy(self):
         latlon = pyproj.CRS.from_epsg(4326)
         osgb = ccrs.OSGB(approx=False)
         transformed = util.crs.transform_shape(self.latlon_point, latlon, osgb)
-        transformed = np.array(transformed).round(-1)
-        assert np.all(transformed == np.array(self.osgb_point))
+        transformed = np.array(transformed.coords).round(-1)
+        assert np.all(transformed == np.array(self.osgb_point.coords))
+
+    def test_multipolygon(self):
+        latlon = pyproj.CRS.from_epsg(4326)
+        osgb = pyproj.CRS.from_epsg(27700)
+        shape = shapely.geometry.MultiPolygon([
+            shapely.geometry.box(-0.5, 51.4, -0.3, 51.6),
+            shapely.geometry.box(-3.6, 50.6, -3.4, 50.8).difference(
+                shapely.geometry.box(-3.55, 50.65, -3.45, 50.75)
+            ),
+        ])
+        transformed = util.crs.transform_shape(shape, latlon, osgb)
+        assert transformed.geom_type == "MultiPolygon"
+        assert len(transformed.geoms[1].interiors) == 1
+        coords = shapely.get_coordinates(shape)
+        expected = util.crs.transform_points(
+            coords[:, 0], coords[:, 1], latlon, osgb
+        )
+        assert np.allclose(
+            shapely.get_coordinates(transformed), np.column_stack(expected)
+        )
+
+    def test_array(self):
+        latlon = ccrs.Geodetic()
+        osgb = ccrs.OSGB(approx=False)
+        shapes = np.array([self.latlon_point, self.latlon_point.buffer(0.1)])
+        transformed = util.crs.transform_shape(shapes, latlon, osgb)
+        assert transformed.shape == (2,)
+        point = np.array(transformed[0].coords).round(-1)
+        assert np.all(point == np.array(self.osgb_point.coords))
+        assert transformed[1].contains(transformed[0])
+
+    def test_z(self):
+        # Heights are transformed along with the rest, for both kinds of
+        # CRS, whether or not 2D shapes are mixed in
+        line = shapely.geometry.LineString([(-0.4, 51.5, 100),
+                                            (-0.3, 51.6, 200)])
+        for latlon, osgb in [
+            (ccrs.Geodetic(), ccrs.OSGB(approx=False)),
+            (pyproj.CRS.from_epsg(4326), pyproj.CRS.from_epsg(27700)),
+        ]:
+            transformed = util.crs.transform_shape(line, latlon, osgb)
+            assert transformed.has_z
+            coords = shapely.get_coordinates(transformed, include_z=True)
+            assert np.all(coords[0, :2].round(-1) == [511160, 179110])
+            assert np.allclose(coords[:, 2], [100, 200], atol=100)
+
+            shapes = np.array([line, self.latlon_point])
+            transformed = util.crs.transform_shape(shapes, latlon, osgb)
+            assert list(shapely.has_z(transformed)) == [True, False]
+            point = np.array(transformed[1].coords).round(-1)
+            assert np.all(point == np.array(self.osgb_point.coords))
+
+    def test_points(self):
+        latlon = ccrs.Geodetic()
+        osgb = pyproj.CRS.from_epsg(27700)
+        xs, ys = util.crs.transform_points(
+            [-0.4, -0.4], [51.5, 51.5], latlon, osgb
+        )
+        assert np.all(xs.round(-1) == 511160)
+        assert np.all(ys.round(-1) == 179110)
+
+
+class TestCache:
+    def setup_method(self):
+        util.crs.cache.clear()
+
+    def test_conversion_cached(self):
+        first = util.crs.as_cartopy_crs(pyproj.CRS.from_epsg(27700))
+        second = util.crs.as_cartopy_crs(pyproj.CRS.from_epsg(27700))
+        assert second is first
+        assert (util.crs.cache.hits, util.crs.cache.misses) == (1, 1)
+
+    def test_transformer_cached(self):
+        latlon = ccrs.Geodetic()
+        osgb = pyproj.CRS.from_epsg(27700)
+        first = util.crs.transform_points([-0.4], [51.5], latlon, osgb)
+        misses = util.crs.cache.misses
+        second = util.crs.transform_points([-0.4], [51.5], latlon, osgb)
+        assert util.crs.cache.misses == misses
+        assert util.crs.cache.hits >= 1
+        assert np.array_equal(first, second)
+
+    def test_clear(self):
+        util.crs.as_cartopy_crs(pyproj.CRS.from_epsg(4326))
+        assert len(util.crs.cache) == 1
+        util.crs.cache.clear()
+        assert len(util.crs.cache) == 0
@@ -0,0 +1,434 @@
+"""
+Unit tests for the util.cubes submodule
+"""
+
+import datetime
+
+import dask.array as da
+import numpy as np
+import iris.coords
+import iris.cube
+import pytest
+import shapely.geometry
+
+from clean_air import util
+from tests.conftest import make_cube
+
+
+def brute_force_weights(cube, geom):
+    """
+    Reference implementation: intersect every cell individually.
+    """
+    xcoord, ycoord = util.cubes.get_xy_coords(cube)
+    weights = np.zeros((len(xcoord.points), len(ycoord.points)))
+    for i, (x0, x1) in enumerate(xcoord.bounds):
+        for j, (y0, y1) in enumerate(ycoord.bounds):
+            cell = shapely.geometry.box(x0, y0, x1, y1)
+            weights[i, j] = cell.intersection(geom).area / cell.area
+    return weights
+
+
+class TestIntersectionWeights:
+    def setup_class(self):
+        self.cube = make_cube()
+        self.shape = shapely.geometry.Polygon([
+            (3100, 4200),
+            (9500, 2900),
+            (17800, 8300),
+            (12200, 19100),
+            (5300, 14400),
+        ])
+
+    def test_matches_brute_force(self):
+        weights = util.cubes.get_intersection_weights(self.cube, self.shape)
+        expected = brute_force_weights(self.cube, self.shape)
+        assert weights.shape == expected.shape
+        assert np.allclose(weights, expected, rtol=0, atol=1e-12)
+
+    def test_match_cube_dims(self):
+        weights = util.cubes.get_intersection_weights(
+            self.cube, self.shape, match_cube_dims=True
+        )
+        expected = brute_force_weights(self.cube, self.shape)
+        assert weights.shape == (1, 15, 20)
+        assert np.allclose(weights[0], expected.T, rtol=0, atol=1e-12)
+
+    def test_shape_outside_grid(self):
+        shape = shapely.geometry.box(1e6, 1e6, 2e6, 2e6)
+        weights = util.cubes.get_intersection_weights(self.cube, shape)
+        assert weights.shape == (20, 15)
+        assert not weights.any()
+
+    def test_cell_inside_shape(self):
+        # A shape covering whole cells exactly should give weights of 1
+        shape = shapely.geometry.box(-1000, -1000, 3000, 5000)
+        weights = util.cubes.get_intersection_weights(self.cube, shape)
+        assert np.all(weights[:2, :3] == 1)
+        assert weights.sum() == 6
+
+    def test_tiled(self, monkeypatch):
+        # Force the shape to span several tiles
+        monkeypatch.setattr(util.cubes, "_TILE_SIZE", 4)
+        weights = util.cubes.get_intersection_weights(self.cube, self.shape)
+        expected = brute_force_weights(self.cube, self.shape)
+        assert np.allclose(weights, expected, rtol=0, atol=1e-12)
+
+    def test_parallel_matches_serial(self, monkeypatch):
+        monkeypatch.setattr(util.cubes, "_TILE_SIZE", 4)
+        serial = util.cubes.get_intersection_weights(
+            self.cube, self.shape, workers=1
+        )
+        parallel = util.cubes.get_intersection_weights(
+            self.cube, self.shape, workers=3
+        )
+        assert np.array_equal(serial, parallel)
+
+    def test_workers_from_environment(self, monkeypatch):
+        monkeypatch.setattr(util.cubes, "_TILE_SIZE", 4)
+        monkeypatch.setenv("CLEAN_AIR_WORKERS", "2")
+        weights = util.cubes.get_intersection_weights(self.cube, self.shape)
+        serial = util.cubes.get_intersection_weights(
+            self.cube, self.shape, workers=1
+        )
+        assert np.array_equal(weights, serial)
+
+    def test_cached(self, tmp_path, monkeypatch):
+        cache = util.cache.DiskCache(str(tmp_path))
+        monkeypatch.setattr(util.cubes, "weights_cache", cache)
+        first = util.cubes.get_intersection_weights(self.cube, self.shape)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        # The second time round, no weights should be calculated at all
+        def fail(*args):
+            raise AssertionError("weights were recalculated")
+
+        monkeypatch.setattr(util.cubes, "_intersection_weights", fail)
+        second = util.cubes.get_intersection_weights(
+            self.cube, self.shape, match_cube_dims=True
+        )
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert np.array_equal(second[0], first.T)
+
+    def test_sparse(self):
+        weights = util.cubes.get_intersection_weights(
+            self.cube, self.shape, sparse=True
+        )
+        expected = brute_force_weights(self.cube, self.shape)
+        assert weights.shape == (20, 15)
+        assert len(weights) == np.count_nonzero(expected)
+        assert np.all(weights.values > 0)
+        assert np.allclose(weights.todense(), expected, rtol=0, atol=1e-12)
+        assert np.array_equal(weights.mask(), expected == 0)
+
+
+class TestSparseHelpers:
+    def setup_class(self):
+        self.cube = make_cube(nx=4, ny=3)
+        # Covers the whole of cell (0, 0), and a quarter of cell (1, 1)
+        shape = shapely.geometry.box(-1000, -1000, 2000, 2000)
+        self.weights = util.cubes.get_intersection_weights(
+            self.cube, shape, sparse=True
+        )
+
+    def test_mask_outside(self):
+        masked = util.cubes.mask_outside(self.cube, self.weights)
+        expected = np.ones((3, 4), dtype=bool)
+        expected[:2, :2] = False
+        for i in range(2):
+            assert np.array_equal(masked.data.mask[i], expected)
+
+    def test_mask_outside_lazy(self):
+        cube = self.cube.copy(data=self.cube.lazy_data())
+        masked = util.cubes.mask_outside(cube, self.weights)
+        assert masked.has_lazy_data()
+        expected = util.cubes.mask_outside(self.cube, self.weights)
+        assert np.array_equal(masked.data.mask, expected.data.mask)
+        assert np.array_equal(masked.data, expected.data)
+
+    def test_mask_outside_multi_chunk(self):
+        data = da.from_array(self.cube.data, chunks=(1, 2, 2))
+        cube = self.cube.copy(data=data)
+        masked = util.cubes.mask_outside(cube, self.weights)
+        assert masked.lazy_data().chunks == data.chunks
+        expected = util.cubes.mask_outside(self.cube, self.weights)
+        assert np.array_equal(masked.data.mask, expected.data.mask)
+
+    def test_weighted_mean(self):
+        mean = util.cubes.weighted_mean(self.cube, self.weights)
+        assert mean.shape == (2,)
+        data = self.cube.data
+        cells = [(0, 0), (0, 1), (1, 0), (1, 1)]
+        weights = [1, 0.5, 0.5, 0.25]
+        for t in range(2):
+            values = [data[t, j, i] for i, j in cells]
+            assert np.isclose(
+                mean.data[t], np.average(values, weights=weights)
+            )
+
+    def test_weighted_mean_ignores_masked(self):
+        data = np.ma.masked_array(self.cube.data, mask=False)
+        data[:, 0, 0] = np.ma.masked
+        cube = self.cube.copy(data=data)
+        mean = util.cubes.weighted_mean(cube, self.weights)
+        cells = [(0, 1), (1, 0), (1, 1)]
+        weights = [0.5, 0.5, 0.25]
+        values = [data[0, j, i] for i, j in cells]
+        assert np.isclose(mean.data[0], np.average(values, weights=weights))
+
+    def test_weighted_mean_no_coverage(self):
+        shape = shapely.geometry.box(1e6, 1e6, 1e6 + 1000, 1e6 + 1000)
+        weights = util.cubes.get_intersection_weights(
+            self.cube, shape, sparse=True
+        )
+        assert len(weights) == 0
+        mean = util.cubes.weighted_mean(self.cube, weights)
+        assert mean.shape == (2,)
+        assert np.all(np.ma.getmaskarray(mean.data))
+
+
+def test_grid_signature():
+    cube = make_cube()
+    assert util.cubes.grid_signature(cube) == \
+        util.cubes.grid_signature(cube[0])
+    assert util.cubes.grid_signature(cube) != \
+        util.cubes.grid_signature(cube[:, 1:])
+
+
+class TestExtractTime:
+    def setup_class(self):
+        self.cube = make_cube(nt=24)
+
+    def test_range(self):
+        cube = util.cubes.extract_time(
+            self.cube,
+            datetime.datetime(2020, 5, 20, 3),
+            datetime.datetime(2020, 5, 20, 7),
+        )
+        assert iris.util.array_equal(cube.coord("time").points, [3, 4, 5, 6])
+        assert cube.ndim == 3
+
+    def test_open_ended(self):
+        start = datetime.datetime(2020, 5, 20, 20)
+        cube = util.cubes.extract_time(self.cube, start=start)
+        assert iris.util.array_equal(
+            cube.coord("time").points, [20, 21, 22, 23]
+        )
+        end = datetime.datetime(2020, 5, 20, 2)
+        cube = util.cubes.extract_time(self.cube, end=end)
+        assert iris.util.array_equal(cube.coord("time").points, [0, 1])
+
+    def test_single_time(self):
+        cube = util.cubes.extract_time(
+            self.cube,
+            datetime.datetime(2020, 5, 20, 3),
+            datetime.datetime(2020, 5, 20, 3, 30),
+        )
+        assert cube.shape == (1, 15, 20)
+
+    def test_no_match(self):
+        cube = util.cubes.extract_time(
+            self.cube, start=datetime.datetime(2020, 5, 21)
+        )
+        assert cube is None
+
+    def test_decreasing(self):
+        cube = util.cubes.extract_time(
+            self.cube[::-1],
+            datetime.datetime(2020, 5, 20, 3),
+            datetime.datetime(2020, 5, 20, 7),
+        )
+        assert iris.util.array_equal(cube.coord("time").points, [6, 5, 4, 3])
+
+    def test_scalar(self):
+        cube = self.cube[5]
+        start = datetime.datetime(2020, 5, 20, 5)
+        assert util.cubes.extract_time(cube, start) is cube
+        assert util.cubes.extract_time(cube, end=start) is None
+
+    def test_bounds(self):
+        # Hourly means, timestamped at the end of each hour, overlap the
+        # range if any part of their hour does
+        cube = self.cube.copy()
+        tcoord = cube.coord("time")
+        tcoord.bounds = np.stack([tcoord.points - 1, tcoord.points], axis=1)
+        cube = util.cubes.extract_time(
+            cube,
+            datetime.datetime(2020, 5, 20, 3),
+            datetime.datetime(2020, 5, 20, 7),
+        )
+        assert iris.util.array_equal(cube.coord("time").points, [4, 5, 6, 7])
+
+    def test_multidimensional(self):
+        cube = self.cube[:2, 0]
+        tcoord = cube.coord("time")
+        cube.remove_coord(tcoord)
+        points = tcoord.points[:, np.newaxis] + np.zeros(cube.shape[1])
+        cube.add_aux_coord(
+            iris.coords.AuxCoord(points, "time", units=tcoord.units), (0, 1)
+        )
+        with pytest.raises(ValueError):
+            util.cubes.extract_time(cube, datetime.datetime(2020, 5, 20, 1))
+
+
+class TestExtractBox:
+    def setup_class(self):
+        self.cube = make_cube()
+
+    def test_bounded(self):
+        # Cells are included if their bounds touch the box at all
+        cube = util.cubes.extract_box(self.cube, (3000, 5500, 8500, 8500))
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [2000, 4000, 6000, 8000])
+        assert iris.util.array_equal(ycoord.points, [6000, 8000])
+        assert cube.shape == (2, 2, 4)
+
+    def test_unbounded(self):
+        cube = self.cube.copy()
+        for coord in util.cubes.get_xy_coords(cube):
+            coord.bounds = None
+        cube = util.cubes.extract_box(cube, (3000, 5500, 8500, 8500))
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [4000, 6000, 8000])
+        assert iris.util.array_equal(ycoord.points, [6000, 8000])
+
+    def test_single_cell(self):
+        # The X and Y dimensions should be kept, even with only one cell
+        cube = util.cubes.extract_box(self.cube, (3500, 3500, 4500, 4500))
+        assert cube.shape == (2, 1, 1)
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [4000])
+        assert iris.util.array_equal(ycoord.points, [4000])
+        assert np.array_equal(cube.data, self.cube.data[:, 2:3, 2:3])
+
+        # And the result should still work with the rest of the toolkit
+        box = shapely.geometry.box(3500, 3500, 4500, 4500)
+        weights = util.cubes.get_intersection_weights(cube, box)
+        assert np.allclose(weights, [[0.25]])
+
+    def test_box_inside_cell(self):
+        cube = util.cubes.extract_box(self.cube, (3600, 3700, 3800, 3900))
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [4000])
+        assert iris.util.array_equal(ycoord.points, [4000])
+
+    def test_outside(self):
+        assert util.cubes.extract_box(self.cube, (1e6, 0, 2e6, 1e4)) is None
+
+    def test_lazy(self):
+        cube = self.cube.copy(data=self.cube.lazy_data())
+        cube = util.cubes.extract_box(cube, (3000, 5500, 8500, 8500))
+        assert cube.has_lazy_data()
+
+    def test_modular(self):
+        xcoord = iris.coords.DimCoord(
+            np.arange(0, 360, 30.0),
+            standard_name="longitude",
+            units="degrees",
+        )
+        ycoord = iris.coords.DimCoord(
+            np.arange(-60, 61, 30.0),
+            standard_name="latitude",
+            units="degrees",
+        )
+        cube = iris.cube.Cube(
+            np.zeros((5, 12)),
+            dim_coords_and_dims=[(ycoord, 0), (xcoord, 1)],
+        )
+        cube = util.cubes.extract_box(cube, (-60, -10, 60, 40))
+        xcoord, ycoord = util.cubes.get_xy_coords(cube)
+        assert iris.util.array_equal(xcoord.points, [-60, -30, 0, 30, 60])
+        assert iris.util.array_equal(ycoord.points, [0, 30])
+
+
+class TestInterpolatePoints:
+    def setup_class(self):
+        self.cube = make_cube()
+        self.cube.data = np.random.default_rng(0).random(self.cube.shape)
+        # Including points outside the grid, which are extrapolated
+        self.xs = np.array([100, 5500, 17777, 38000, -500])
+        self.ys = np.array([0, 3333, 25000, 28000, 100])
+
+    def test_matches_iris(self):
+        result = util.cubes.interpolate_points(
+            self.cube,
+            [("projection_x_coordinate", self.xs),
+             ("projection_y_coordinate", self.ys)],
+        )
+        assert result.shape == (2, 5)
+        assert iris.util.array_equal(result.coord("sample").points, range(5))
+        assert iris.util.array_equal(
+            result.coord("projection_x_coordinate").points, self.xs
+        )
+        for i, (x, y) in enumerate(zip(self.xs, self.ys)):
+            expected = self.cube.interpolate(
+                [("projection_x_coordinate", [x]),
+                 ("projection_y_coordinate", [y])],
+                iris.analysis.Linear(),
+            )
+            assert np.allclose(result.data[:, i], expected.data.squeeze())
+
+    def test_lazy(self):
+        cube = self.cube.copy(data=self.cube.lazy_data())
+        samples = [
+            ("projection_x_coordinate", self.xs),
+            ("projection_y_coordinate", self.ys),
+        ]
+        result = util.cubes.interpolate_points(cube, samples)
+        assert result.has_lazy_data()
+        expected = util.cubes.interpolate_points(self.cube, samples)
+        assert np.allclose(result.data, expected.data)
+
+    def test_descending(self):
+        cube = self.cube[:, ::-1, ::-1]
+        result = util.cubes.interpolate_points(
+            cube,
+            [("projection_x_coordinate", self.xs),
+             ("projection_y_coordinate", self.ys)],
+        )
+        expected = util.cubes.interpolate_points(
+            self.cube,
+            [("projection_x_coordinate", self.xs),
+             ("projection_y_coordinate", self.ys)],
+        )
+        assert np.allclose(result.data, expected.data)
+
+    def make_global(self, circular):
+        lons = iris.coords.DimCoord(
+            np.arange(0, 360, 30.0), "longitude", units="degrees",
+            circular=circular,
+        )
+        lats = iris.coords.DimCoord(
+            np.arange(-60, 61, 30.0), "latitude", units="degrees"
+        )
+        data = np.random.default_rng(1).random((5, 12))
+        return iris.cube.Cube(
+            data, dim_coords_and_dims=[(lats, 0), (lons, 1)]
+        )
+
+    def test_circular(self):
+        # Including samples across the join, and outside 0-360
+        cube = self.make_global(circular=True)
+        lons = np.array([345.0, -10, 370, 100, 330, 719])
+        lats = np.array([10.0, -20, 0, 45, 60, -60])
+        result = util.cubes.interpolate_points(
+            cube, [("longitude", lons), ("latitude", lats)]
+        )
+        assert iris.util.array_equal(
+            result.coord("longitude").points, lons
+        )
+        for i, (lon, lat) in enumerate(zip(lons, lats)):
+            expected = cube.interpolate(
+                [("longitude", [lon]), ("latitude", [lat])],
+                iris.analysis.Linear(),
+            )
+            assert np.isclose(result.data[i], expected.data.squeeze())
+
+    def test_wrapped(self):
+        # Not circular, but longitudes a whole turn away are the same place
+        cube = self.make_global(circular=False)
+        samples = [("longitude", [100.0, 200.0]), ("latitude", [0.0, 15.0])]
+        expected = util.cubes.interpolate_points(cube, samples)
+        result = util.cubes.interpolate_points(
+            cube, [("longitude", [-260.0, 560.0]), ("latitude", [0.0, 15.0])]
+        )
+        assert np.allclose(result.data, expected.data)
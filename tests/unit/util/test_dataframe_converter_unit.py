@@ -5,6 +5,7 @@ Unit tests for dataframe_converter.py
 import os
 from clean_air.util import dataframe_converter as dc
 from clean_air.util.cubes import get_xy_coords
+from tests.conftest import make_cube
 import iris
 import geopandas as geopd
 import pandas as pd
@@ -86,3 +87,152 @@ class TestMakeGeo:
         rounded_data = np.round(gdfs[0].data.array, decimals=5)
         assert np.all(rounded_data == expected_data)
 
+
+class TestSyntheticMakeGeo:
+    """
+    Checks of the conversion to GeoDataFrames against a cell by cell
+    conversion, using a small synthetic cube.
+    """
+
+    def setup_class(self):
+        self.cube = make_cube(nx=4, ny=3, nt=2)
+        self.x_coord, self.y_coord = get_xy_coords(self.cube)
+
+    def expected(self, cube):
+        # Straightforward conversion: one row per cell of each x-y slice,
+        # in x then y order
+        rows = []
+        for xy_slice in cube.slices([self.x_coord, self.y_coord],
+                                    ordered=True):
+            for i, x in enumerate(self.x_coord.points):
+                for j, y in enumerate(self.y_coord.points):
+                    rows.append((x, y, xy_slice.data[i, j]))
+        return np.array(rows)
+
+    def test_slices(self):
+        gdfs = dc._make_geo(self.cube, self.x_coord, self.y_coord)
+        assert len(gdfs) == 2
+        expected = self.expected(self.cube)
+        for n, gdf in enumerate(gdfs):
+            assert list(gdf.index) == list(range(12))
+            rows = expected[n * 12:(n + 1) * 12]
+            assert np.all(gdf.x_coord == rows[:, 0])
+            assert np.all(gdf.y_coord == rows[:, 1])
+            assert np.all(gdf.data == rows[:, 2])
+
+    def test_restitch(self):
+        gdf = dc.convert_to_geodf(self.cube, restitch=True)
+        assert isinstance(gdf, geopd.GeoDataFrame)
+        expected = self.expected(self.cube)
+        assert len(gdf) == len(expected)
+        assert np.all(gdf.data == expected[:, 2])
+        assert np.all(gdf.geometry.x == expected[:, 0])
+        assert np.all(gdf.geometry.y == expected[:, 1])
+        assert list(gdf.index) == list(range(12)) * 2
+
+    def test_transposed(self):
+        # Dimension order should not matter
+        cube = self.cube.copy()
+        cube.transpose([2, 0, 1])
+        gdf = dc.convert_to_geodf(cube, restitch=True)
+        assert np.all(gdf.data == self.expected(self.cube)[:, 2])
+
+    def test_masked(self):
+        cube = self.cube.copy()
+        cube.data = np.ma.masked_less(cube.data, 5)
+        gdf = dc.convert_to_geodf(cube, restitch=True)
+        assert gdf.data.isna().sum() == 5
+
+
+class TestIterGeoDF:
+    """
+    Unit tests for chunked conversion and streaming to GeoParquet.
+    """
+
+    def setup_class(self):
+        self.cube = make_cube(nx=4, ny=3, nt=5)
+
+    def test_chunks(self):
+        whole = dc.convert_to_geodf(self.cube, restitch=True)
+        chunks = list(dc.iter_geodf(self.cube, chunk_size=2))
+        assert [len(chunk) for chunk in chunks] == [24, 24, 12]
+        assert all(isinstance(chunk, geopd.GeoDataFrame) for chunk in chunks)
+        assert pd.concat(chunks).equals(whole)
+
+    def test_lazy(self, tracked_array):
+        data, tracker = tracked_array(self.cube.data, chunks=(1, 3, 4))
+        cube = self.cube.copy(data=data)
+        whole = dc.convert_to_geodf(self.cube, restitch=True)
+
+        # Each chunk should be read once, and only when it is needed
+        frames = dc.iter_geodf(cube, chunk_size=2)
+        first = next(frames)
+        assert len(tracker.reads) == 2
+        assert first.equals(whole[:24])
+        rows = len(first)
+        del first
+        for frame in frames:
+            assert frame.equals(whole[rows:rows + len(frame)])
+            rows += len(frame)
+        assert rows == len(whole)
+        assert len(tracker.reads) == 5
+        assert tracker.max_live <= 2
+        assert cube.has_lazy_data()
+
+    def test_write_geoparquet(self, tmp_path):
+        paths = dc.write_geoparquet(self.cube, tmp_path / "out", chunk_size=2)
+        assert len(paths) == 3
+
+        gdf = pd.concat(geopd.read_parquet(path) for path in paths)
+        whole = dc.convert_to_geodf(self.cube, restitch=True)
+        assert np.all(gdf.data.values == whole.data.values)
+        assert gdf.geometry.equals(whole.geometry)
+
+        # Time steps should be labelled
+        times = gdf.time.drop_duplicates()
+        assert list(times) == list(pd.date_range("2020-05-20", periods=5,
+                                                 freq="h"))
+
+
+class TestAsPandasData:
+    """
+    Unit tests for conversion of (masked) arrays to pandas style data.
+    """
+
+    def test_unmasked(self):
+        data = np.arange(4.0)
+        assert dc.as_pandas_data(data, copy=False) is data
+        result = dc.as_pandas_data(data)
+        assert not np.shares_memory(result, data)
+
+    def test_masked_float64(self):
+        data = np.ma.masked_equal([1 + 1e-12, 2.0, 3.0], 2.0)
+        result = dc.as_pandas_data(data)
+        assert result.dtype == np.float64
+        assert result[0] == 1 + 1e-12
+        assert np.isnan(result[1])
+        # The original should be untouched
+        assert data.data[1] == 2.0
+
+    def test_masked_no_copy(self):
+        data = np.ma.masked_equal([1.0, 2.0, 3.0], 2.0)
+        result = dc.as_pandas_data(data, copy=False)
+        assert np.shares_memory(result, data)
+        assert np.isnan(result[1])
+
+    def test_masked_float32(self):
+        data = np.ma.masked_equal(np.arange(3, dtype='f4'), 1)
+        assert dc.as_pandas_data(data).dtype == np.float32
+
+    def test_masked_int(self):
+        data = np.ma.masked_equal(np.arange(3), 1)
+        result = dc.as_pandas_data(data, copy=False)
+        assert result.dtype == pd.Int64Dtype()
+        assert list(result.isna()) == [False, True, False]
+        assert result[2] == 2
+
+    def test_masked_nothing(self):
+        data = np.ma.masked_array(np.arange(3))
+        result = dc.as_pandas_data(data, copy=False)
+        assert isinstance(result, np.ndarray)
+        assert result.dtype == data.dtype
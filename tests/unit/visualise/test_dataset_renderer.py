@@ -4,9 +4,12 @@ Unit tests for test_dataset_renderer.py
 
 import clean_air.visualise.dataset_renderer as dr
 import geopandas
+import iris
 import os
 import pytest
 import xarray
+from clean_air import util
+from clean_air.visualise import pyramid
 
 MODEL_DATA_PATH = ("/net/home/h06/cbosley/Projects/toybox/cap_sample_data/"
                    "model/")
@@ -110,3 +113,128 @@ class TestErrors:
             self.dframe.render()
 
 
+@pytest.mark.usefixtures('synthetic_files')
+class TestSyntheticDatasetRenderer:
+    """
+    Class to check that the dataset is read only once, and lazily, using a
+    small synthetic file.
+    """
+    ndays = 1
+
+    @property
+    def path(self):
+        return os.path.join(self.tmpdir, 'aqum_hourly_o3_20200520.nc')
+
+    def test_found_dim_coords(self):
+        renderer = dr.DatasetRenderer(self.path)
+        assert renderer.x_coord == 'projection_x_coordinate'
+        assert renderer.y_coord == 'projection_y_coordinate'
+        assert renderer.z_coord is None
+        assert renderer.t_coord == 'time'
+        assert renderer.dataset.has_lazy_data()
+
+    def test_render_map_lazy(self, monkeypatch):
+        renderer = dr.DatasetRenderer(self.path)
+
+        # The file should not be opened again
+        def fail(*args, **kwargs):
+            raise AssertionError('dataset loaded twice')
+        monkeypatch.setattr(dr.iris, 'load_cube', fail)
+        monkeypatch.setattr(dr.xarray, 'open_dataset', fail)
+
+        renderer.render()
+        assert renderer.img_type == 'map'
+        assert isinstance(renderer.dataframe, xarray.DataArray)
+        assert renderer.dataframe.chunks is not None
+        assert renderer.dataset.has_lazy_data()
+
+    def test_render_error(self):
+        # A single point (with scalar x, y and time coords) can't be drawn
+        cube = iris.load_cube(self.path)[0, 0, 0]
+        path = os.path.join(self.tmpdir, 'scalar.nc')
+        iris.save(cube, path)
+        renderer = dr.DatasetRenderer(path)
+        with pytest.raises(ValueError):
+            renderer.render()
+
+    def test_render_error_y_only(self):
+        # Nor can a line of points along y, with no time coord
+        cube = iris.load_cube(self.path)[0, :, 0]
+        path = os.path.join(self.tmpdir, 'y_only.nc')
+        iris.save(cube, path)
+        renderer = dr.DatasetRenderer(path)
+        assert renderer.y_coord is not None
+        with pytest.raises(ValueError):
+            renderer.render()
+
+
+@pytest.mark.usefixtures('synthetic_files')
+class TestRenderCache:
+    """
+    Class to check rendering to PNG, and the caching of the images.
+    """
+    ndays = 2
+
+    @property
+    def path(self):
+        return os.path.join(self.tmpdir, 'aqum_hourly_o3_20200520.nc')
+
+    def use_cache(self, monkeypatch):
+        memory = util.cache.MemoryCache()
+        disk = util.cache.BytesCache(os.path.join(self.tmpdir, 'png'),
+                                     suffix='.png')
+        monkeypatch.setattr(dr, 'render_cache',
+                            util.cache.TieredCache(memory, disk))
+        return memory, disk
+
+    def test_png(self):
+        png = dr.DatasetRenderer(self.path).render_png(width=40, height=30)
+        assert png.startswith(b'\x89PNG')
+
+    def test_png_pyramid(self):
+        renderer = dr.DatasetRenderer(self.path)
+        pyramid_path = os.path.join(self.tmpdir, 'pyramid')
+        pyramid.build_pyramid(renderer._as_xarray(), pyramid_path,
+                              renderer.x_coord, renderer.y_coord,
+                              renderer.t_coord, min_size=4).close()
+        with dr.DatasetRenderer(self.path, pyramid_path) as renderer:
+            png = renderer.render_png(width=4, height=3)
+        assert png.startswith(b'\x89PNG')
+        assert renderer.pyramid._datasets == []
+
+    def test_cached(self, monkeypatch):
+        memory, disk = self.use_cache(monkeypatch)
+        png = dr.DatasetRenderer(self.path).render_png(3, width=40, height=30)
+
+        # Must not be drawn again
+        def fail(*args, **kwargs):
+            raise AssertionError('image drawn twice')
+        monkeypatch.setattr(dr.DatasetRenderer, '_draw_png', fail)
+        renderer = dr.DatasetRenderer(self.path)
+        assert renderer.render_png(3, width=40, height=30) == png
+        assert memory.hits == 1
+        assert len(os.listdir(disk.directory)) >= 1
+
+    def test_key(self):
+        renderer = dr.DatasetRenderer(self.path)
+        view = dict(time_index=0, x_range=None, y_range=None, width=40,
+                    height=30, cmap='bgy')
+        key = renderer._render_key(view)
+        assert renderer._render_key(dict(view, time_index=1)) != key
+        assert renderer._render_key(dict(view, x_range=(0, 10))) != key
+
+        # A new version of the file should not reuse old images
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+        assert renderer._render_key(view) != key
+
+    def test_prewarm(self, monkeypatch):
+        memory, _ = self.use_cache(monkeypatch)
+        latest = os.path.join(self.tmpdir, 'aqum_hourly_o3_20200521.nc')
+        stat = os.stat(latest)
+        os.utime(latest, (stat.st_atime, stat.st_mtime + 100))
+
+        renderer = dr.prewarm(self.files, time_indices=[0, 1],
+                              views=[dict(width=20, height=15)])
+        assert renderer.path == latest
+        assert len(memory) == 2
@@ -0,0 +1,121 @@
+"""
+Unit tests for pyramid.py
+"""
+
+import os
+
+import dask.array as da
+import holoviews as hv
+import netCDF4
+import numpy as np
+import pytest
+import xarray
+
+from clean_air.visualise import pyramid, render_map
+
+
+def make_dataarray(nx=64, ny=48, nt=3):
+    data = np.arange(nt * ny * nx, dtype=float).reshape(nt, ny, nx)
+    return xarray.DataArray(
+        da.from_array(data, chunks=(1, ny, nx)),
+        dims=['time', 'y', 'x'],
+        coords={'time': np.arange(nt),
+                'y': np.arange(ny) * 1000.0,
+                'x': np.arange(nx) * 1000.0},
+        name='o3',
+    )
+
+
+class TestBuildPyramid:
+    def setup_class(self):
+        self.data = make_dataarray()
+
+    @pytest.fixture
+    def pyr(self, tmp_path):
+        with pyramid.build_pyramid(self.data, str(tmp_path / 'pyr'),
+                                   'x', 'y', 'time', min_size=8) as pyr:
+            yield pyr
+
+    def test_levels(self, pyr):
+        assert [level.shape for level in pyr.levels] == [
+            (3, 48, 64), (3, 24, 32), (3, 12, 16), (3, 6, 8)]
+
+    def test_level_values(self, pyr):
+        expected = self.data.coarsen(x=4, y=4).mean()
+        assert np.allclose(pyr.levels[2].values, expected.values)
+        assert np.allclose(pyr.levels[2].x.values, expected.x.values)
+
+    def test_tiles(self, tmp_path):
+        path = str(tmp_path / 'pyr')
+        with pyramid.build_pyramid(self.data, path, 'x', 'y', 'time',
+                                   min_size=8, tile_size=16) as pyr:
+            # Stored and read back one time step and tile at a time
+            with netCDF4.Dataset(os.path.join(path, 'level_0.nc')) as nc:
+                assert nc.variables['o3'].chunking() == [1, 16, 16]
+            with netCDF4.Dataset(os.path.join(path, 'level_3.nc')) as nc:
+                assert nc.variables['o3'].chunking() == [1, 6, 8]
+            assert pyr.levels[0].chunks == ((1, 1, 1), (16,) * 3, (16,) * 4)
+            assert pyr.levels[1].chunks == ((1, 1, 1), (16, 8), (16, 16))
+
+    def test_streamed(self, tmp_path, tracked_array):
+        # The input should be read once, a time step at a time
+        data, tracker = tracked_array(self.data.values, chunks=(1, 48, 64))
+        pyr = pyramid.build_pyramid(self.data.copy(data=data),
+                                    str(tmp_path / 'pyr'), 'x', 'y', 'time',
+                                    min_size=8)
+        pyr.close()
+        assert len(tracker.reads) == 3
+        assert tracker.max_live == 1
+
+    def test_close(self, tmp_path):
+        if not os.path.isdir('/proc/self/fd'):
+            pytest.skip('needs /proc to list open files')
+
+        def open_files():
+            files = []
+            for fd in os.listdir('/proc/self/fd'):
+                try:
+                    files.append(os.readlink(f'/proc/self/fd/{fd}'))
+                except OSError:
+                    pass
+            return [path for path in files if path.startswith(str(tmp_path))]
+
+        pyr = pyramid.build_pyramid(self.data, str(tmp_path / 'pyr'),
+                                    'x', 'y', 'time', min_size=8)
+        pyr.levels[3].values
+        assert len(open_files()) <= 4
+        pyr.close()
+        assert open_files() == []
+
+    def test_level_for(self, pyr):
+        # Whole dataset on a small view needs the coarsest level
+        assert pyr.level_for(width=8, height=6) == 3
+        # Whole dataset on a big view needs the finest
+        assert pyr.level_for(width=800, height=600) == 0
+        # Zoomed out a bit
+        assert pyr.level_for(width=16, height=12) == 2
+        # Zoomed in to a quarter of the width on the same small view
+        assert pyr.level_for((0, 16000), (0, 12000), 8, 6) == 1
+
+    def test_select(self, pyr):
+        data = pyr.select((10000, 20000), (5000, 9000), 20, 8, time_index=1)
+        assert data.dims == ('y', 'x')
+        # Level 0, plus a cell either side
+        assert list(data.x.values) == list(np.arange(9, 22) * 1000.0)
+        assert list(data.y.values) == list(np.arange(4, 11) * 1000.0)
+        assert np.array_equal(data.values,
+                              self.data[1, 4:11, 9:22].values)
+
+
+class TestMapPyramid:
+    def test_image(self, tmp_path):
+        pyr = pyramid.build_pyramid(make_dataarray(), str(tmp_path / 'pyr'),
+                                    'x', 'y', 'time', min_size=8)
+        map_ = render_map.Map(None, pyr, width=16, height=12)
+        plot = map_.render('x', 'y', t_coord='time')
+        assert isinstance(plot, hv.DynamicMap)
+
+        image = map_.pyramid_image('x', 'y', time_index=2)
+        assert isinstance(image, hv.Image)
+        assert image.data['o3'].shape == (12, 16)
+        pyr.close()
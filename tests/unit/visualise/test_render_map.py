@@ -0,0 +1,66 @@
+"""
+Unit tests for render_map.py
+"""
+
+import holoviews as hv
+import numpy as np
+import xarray
+
+from clean_air.visualise import render_map
+
+
+def make_dataarray(tracked_array, nx=64, ny=48, nt=3):
+    data = np.arange(nt * ny * nx, dtype=float).reshape(nt, ny, nx)
+    array, tracker = tracked_array(data, chunks=(1, 16, 16))
+    dataarray = xarray.DataArray(
+        array,
+        dims=['time', 'y', 'x'],
+        coords={'time': np.arange(nt),
+                'y': np.arange(ny) * 1000.0,
+                'x': np.arange(nx) * 1000.0},
+        name='o3',
+    )
+    return dataarray, tracker
+
+
+class TestRenderGrid:
+    def test_dynamic(self, tracked_array):
+        dataarray, tracker = make_dataarray(tracked_array)
+        dmap = render_map.Map(dataarray).render_grid('x', 'y', 'time')
+        assert isinstance(dmap, hv.DynamicMap)
+        assert dmap.kdims[0].values == [0, 1, 2]
+
+        # Nothing is read until it is drawn
+        assert tracker.reads == []
+        image = dmap[1]
+        assert isinstance(image, hv.Image)
+        assert image.data['o3'].shape == (48, 64)
+
+        # And then only the time step drawn
+        assert tracker.reads
+        assert all(key[0] in (1, slice(1, 2)) for key in tracker.reads)
+
+    def test_thinned(self, tracked_array):
+        dataarray, _ = make_dataarray(tracked_array)
+        image = render_map.Map(dataarray, width=16, height=12).grid_image(
+            'x', 'y', 'time', 2)
+        assert image.data['o3'].shape == (12, 16)
+        np.testing.assert_array_equal(image.data['o3'],
+                                      dataarray[2, ::4, ::4])
+
+    def test_range(self, tracked_array):
+        dataarray, tracker = make_dataarray(tracked_array)
+        image = render_map.Map(dataarray).grid_image(
+            'x', 'y', 'time', 0, x_range=(2000, 10000),
+            y_range=(3000, 5000))
+        assert image.data['o3'].shape == (5, 11)
+
+        # Only the corner of the grid in view is read
+        assert all(key[1].start < 16 and key[2].start < 16
+                   for key in tracker.reads)
+
+    def test_no_time(self, tracked_array):
+        dataarray, _ = make_dataarray(tracked_array)
+        dmap = render_map.Map(dataarray[0]).render_grid('x', 'y')
+        assert dmap.kdims == []
+        assert isinstance(dmap[()], hv.Image)
@@ -0,0 +1,134 @@
+"""
+Unit tests for render_plot.py
+"""
+
+import dask.array as da
+import holoviews as hv
+import numpy as np
+import pandas as pd
+import pytest
+import xarray
+
+from clean_air.visualise import render_plot
+
+
+def make_series(n=10000, chunks=None, calendar=None):
+    rng = np.random.default_rng(0)
+    values = np.cumsum(rng.normal(size=n))
+    if chunks:
+        values = da.from_array(values, chunks=chunks)
+    if calendar:
+        times = xarray.date_range('2020-01-01', periods=n, freq='min',
+                                  calendar=calendar, use_cftime=True)
+    else:
+        times = pd.date_range('2020-01-01', periods=n, freq='min')
+    return xarray.DataArray(values, dims=['time'], coords={'time': times},
+                            name='no2')
+
+
+def brute_force_m4(times, values, n_bins, t_range):
+    # Simple loop over each bin
+    start, end = t_range
+    bins = np.clip(((times - start) / (end - start) * n_bins).astype(int),
+                   0, n_bins - 1)
+    keep = set()
+    for b in np.unique(bins):
+        indices = np.flatnonzero(bins == b)
+        keep.update([indices[0], indices[-1],
+                     indices[np.argmin(values[indices])],
+                     indices[np.argmax(values[indices])]])
+    return sorted(keep)
+
+
+class TestM4:
+    def test_matches_brute_force(self):
+        series = make_series(2000)
+        times = series.time.values.astype('int64').astype(float)
+        values = series.values
+        t_range = times[0], times[-1]
+        keep = render_plot.m4_indices(times, values, 37, t_range)
+        assert list(keep) == brute_force_m4(times, values, 37, t_range)
+
+    def test_nan(self):
+        values = np.array([1.0, np.nan, 3.0, np.nan])
+        keep = render_plot.m4_indices(np.arange(4.0), values, 1, (0, 3))
+        assert list(keep) == [0, 2]
+
+
+class TestDecimate:
+    def test_size(self):
+        times, values = render_plot.decimate(make_series(), 50)
+        assert len(times) <= 200
+        assert np.issubdtype(times.dtype, np.datetime64)
+
+    def test_extremes_kept(self):
+        series = make_series()
+        times, values = render_plot.decimate(series, 50)
+        assert values.min() == series.values.min()
+        assert values.max() == series.values.max()
+        assert times[0] == series.time.values[0]
+        assert times[-1] == series.time.values[-1]
+
+    def test_chunked(self):
+        # Should not matter how the data is read
+        whole = render_plot.decimate(make_series(), 50)
+        lazy = make_series(chunks=777)
+        chunked = render_plot.decimate(lazy, 50)
+        assert np.array_equal(chunked[0], whole[0])
+        assert np.array_equal(chunked[1], whole[1])
+        assert isinstance(lazy.data, da.Array)
+
+    def test_range(self):
+        series = make_series()
+        t_range = (series.time.values[1000], series.time.values[1999])
+        times, values = render_plot.decimate(series, 1000, t_range)
+        # Zoomed in to one point per pixel, so everything is kept
+        assert np.array_equal(times, series.time.values[1000:2000])
+
+    def test_empty_range(self):
+        t_range = (np.datetime64('2030-01-01'), np.datetime64('2030-01-02'))
+        times, values = render_plot.decimate(make_series(), 10, t_range)
+        assert len(times) == len(values) == 0
+
+    def test_cftime(self):
+        # Such as for data on a 360 day calendar
+        series = make_series(calendar='360_day')
+        assert series.time.dtype == object
+        times, values = render_plot.decimate(series, 50)
+        expected = render_plot.decimate(make_series(), 50)
+        assert np.array_equal(values, expected[1])
+        assert times[0] == series.time.values[0]
+
+        t_range = (series.time.values[1000], series.time.values[1999])
+        times, values = render_plot.decimate(series, 1000, t_range)
+        assert np.array_equal(times, series.time.values[1000:2000])
+
+
+class TestRenderTimeseries:
+    def test_dynamic(self):
+        plot = render_plot.Plot(make_series(chunks=1000), width=100)
+        dmap = plot.render_timeseries()
+        assert isinstance(dmap, hv.DynamicMap)
+        curve = dmap[()]
+        assert isinstance(curve, hv.Curve)
+        assert len(curve) <= 400
+
+    def test_cftime(self):
+        plot = render_plot.Plot(make_series(calendar='noleap'), width=100)
+        curve = plot.render_timeseries()[()]
+        assert isinstance(curve, hv.Curve)
+        assert len(curve) <= 400
+
+    def test_dataset(self):
+        plot = render_plot.Plot(make_series().to_dataset(), width=100)
+        assert isinstance(plot.render_timeseries(), hv.DynamicMap)
+
+    def test_scalar(self):
+        plot = render_plot.Plot(make_series()[:1])
+        with pytest.raises(ValueError):
+            plot.render_timeseries()
+
+    def test_2d(self):
+        series = make_series(n=10).expand_dims(station=2)
+        with pytest.raises(ValueError):
+            render_plot.Plot(series).render_timeseries()